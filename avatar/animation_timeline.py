@@ -0,0 +1,94 @@
+# animation_timeline.py
+"""
+Local animation playback for the avatar display
+Takes an animation once and wakes up exactly at each pose boundary
+"""
+
+import math
+import time
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSignal
+
+class AnimationTimeline(QObject):
+    """Plays one animation with a single-shot timer armed for the next pose change"""
+    pose_changed = pyqtSignal(str, int)  # pose name, pose index since start
+    finished = pyqtSignal()
+
+    def __init__(self, animation, parent=None):
+        super().__init__(parent)
+        self.animation_id = animation.get('id', 'unknown')
+        # Get sequence from either 'sequence' or 'frames' field
+        self.sequence = list(animation.get('sequence') or animation.get('frames') or [])
+        self.loop = animation.get('loop', False)
+
+        # Get duration_per_pose or calculate from fps
+        fps = animation.get('fps', 2)
+        if 'duration_per_pose' in animation:
+            self.duration_per_pose = animation['duration_per_pose']
+        elif fps and fps > 0:
+            self.duration_per_pose = 1.0 / fps
+        else:
+            self.duration_per_pose = 2.0  # Default 2 seconds
+        if not self.duration_per_pose or self.duration_per_pose <= 0:
+            self.duration_per_pose = 2.0
+
+        self.start_time = None
+        self.index = -1
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.on_boundary)
+
+    @property
+    def total_duration(self):
+        """Length of one pass through the sequence in seconds"""
+        return len(self.sequence) * self.duration_per_pose
+
+    @property
+    def running(self):
+        return self.start_time is not None
+
+    @property
+    def elapsed(self):
+        """Seconds since the animation started"""
+        return time.monotonic() - self.start_time if self.running else 0.0
+
+    @property
+    def pose(self):
+        """Pose currently shown, or None before the first boundary"""
+        if self.index < 0 or not self.sequence:
+            return None
+        return self.sequence[self.index % len(self.sequence)]
+
+    def start(self):
+        """Show the first pose and schedule the next boundary"""
+        self.start_time = time.monotonic()
+        self.index = -1
+        self.on_boundary()
+
+    def stop(self):
+        """Cancel playback without emitting finished"""
+        self.timer.stop()
+        self.start_time = None
+
+    def on_boundary(self):
+        """Emit the pose due now and arm the timer for the next one"""
+        if not self.running:
+            return
+
+        elapsed = self.elapsed
+        index = int(elapsed / self.duration_per_pose)
+
+        if not self.sequence or (not self.loop and index >= len(self.sequence)):
+            # Leave start_time set so listeners can still read elapsed
+            self.timer.stop()
+            self.finished.emit()
+            return
+
+        if index != self.index:
+            self.index = index
+            self.pose_changed.emit(self.sequence[index % len(self.sequence)], index)
+
+        # An early wake-up keeps the same index and simply re-arms
+        next_boundary = (index + 1) * self.duration_per_pose
+        self.timer.start(max(0, math.ceil((next_boundary - elapsed) * 1000)))
@@ -0,0 +1,518 @@
+# async_state_server.py
+"""
+asyncio implementation of the avatar state server
+Same endpoints, bodies and headers as the Flask server in avatar_state_server.py,
+on the standard library only. Each connection is a coroutine instead of a
+thread, so hundreds of /state/stream and /wait clients cost next to nothing.
+
+Start with: python avatar_state_server.py --async
+(avatar_display.py --embedded runs it on a thread next to the display)
+"""
+
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+import state_service as core
+from state_model import StateError, dumps
+
+# Largest request body accepted (bytes)
+MAX_BODY = 1024 * 1024
+
+class HttpError(Exception):
+    """Request that cannot be served - answered with the status
+
+    Raised while reading a request, the connection is closed after the answer.
+    """
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+class Request:
+    """One parsed HTTP request"""
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.args = parse_qsl(url.query, keep_blank_values=True)
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def arg(self, name, default=None, type=str):
+        """First query argument with that name, converted; default if missing or invalid"""
+        for key, value in self.args:
+            if key == name:
+                try:
+                    return type(value)
+                except ValueError:
+                    return default
+        return default
+
+    def json(self, silent=True):
+        """Request body as JSON (None when empty or invalid, like get_json(silent=True))
+
+        With silent=False it answers like Flask's get_json(): 415 unless the
+        body is declared JSON, 400 when it does not parse.
+        """
+        if not silent:
+            mimetype = self.headers.get('content-type', '').split(';')[0].strip().lower()
+            if mimetype != 'application/json' and not (mimetype.startswith('application/')
+                                                       and mimetype.endswith('+json')):
+                raise HttpError(415)
+        try:
+            return json.loads(self.body) if self.body or not silent else None
+        except ValueError:
+            if silent:
+                return None
+            raise HttpError(400)
+
+    @property
+    def if_none_match(self):
+        """ETags from If-None-Match, without quotes or weak prefixes"""
+        header = self.headers.get('if-none-match', '')
+        tags = (tag.strip() for tag in header.split(','))
+        return {(tag[2:] if tag.startswith('W/') else tag).strip('"') for tag in tags if tag}
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+def response_head(status, headers):
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+class Response:
+    """JSON (or empty) response; raw is an already encoded body"""
+
+    def __init__(self, body=None, status=200, etag=None, raw=None, content_type='application/json'):
+        self.status = status
+        if raw is None and body is not None:
+            raw = dumps(body)
+        self.payload = raw or b''
+        self.headers = {'Content-Type': content_type} if raw is not None else {}
+        if etag:
+            self.headers['ETag'] = f'"{etag}"'
+
+    def encode(self, keep_alive):
+        headers = dict(self.headers)
+        headers['Content-Length'] = str(len(self.payload))
+        headers['Access-Control-Allow-Origin'] = '*'
+        if not keep_alive:
+            headers['Connection'] = 'close'
+        return response_head(self.status, headers) + self.payload
+
+def error(message, status=400):
+    return Response({'status': 'error', 'error': message}, status)
+
+class StreamHub:
+    """The only store subscriber of the async server
+
+    Snapshots arrive from whichever thread wrote them, are encoded once as an
+    SSE event, and are fanned out on the event loop to every stream and wait.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.listeners = set()
+
+    def put(self, snapshot):
+        # Called with the store's writer lock held - hand over and return
+        self.loop.call_soon_threadsafe(self.publish, snapshot)
+
+    def publish(self, snapshot):
+        event = encode_event(snapshot)
+        for listener in self.listeners:
+            if listener.full():
+                listener.get_nowait()  # Not delivered yet and superseded - every event is the full state
+            listener.put_nowait((snapshot, event))
+
+    def listen(self):
+        listener = asyncio.Queue(maxsize=1)
+        self.listeners.add(listener)
+        return listener
+
+    def unlisten(self, listener):
+        self.listeners.discard(listener)
+
+def chunk(data):
+    """One chunk of a chunked response - clients read streamed events chunk by chunk"""
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+def encode_event(snapshot):
+    """One Server-Sent Event for a snapshot, as a response chunk"""
+    payload = snapshot.encoded().rstrip(b'\n')
+    return chunk(b'id: %s\ndata: %s\n\n' % (core.state_etag(snapshot.version).encode(), payload))
+
+KEEPALIVE_EVENT = chunk(b': keep-alive\n\n')
+
+class AsyncStateServer:
+    """HTTP/1.1 server (keep-alive, SSE) over a StateStore"""
+
+    def __init__(self, store, history=None):
+        self.store = store
+        self.history = history if history is not None else core.history  # Must be subscribed to store
+        self.hub = None
+        self.server = None
+        self.unix_server = None
+        self.connections = set()  # Open connection tasks, cancelled on close
+        self.routes = {
+            ('GET', '/state'): self.get_state,
+            ('POST', '/state'): self.update_state,
+            ('GET', '/state/stream'): self.stream_state,
+            ('GET', '/events'): self.get_events,
+            ('GET', '/wait'): self.wait,
+            ('GET', '/health'): self.health_check,
+            ('GET', '/metrics'): self.get_metrics,
+            ('POST', '/batch'): self.batch,
+            ('POST', '/play_animation'): self.play_animation,
+            ('DELETE', '/animate'): self.stop_animation,
+            ('POST', '/show_gif'): self.show_gif,
+            ('POST', '/hide_gif'): self.hide_gif,
+            ('GET', '/queue'): self.get_queue,
+            ('POST', '/queue'): self.enqueue,
+            ('DELETE', '/queue'): self.clear_queue,
+            ('GET', '/admin/logging'): self.get_logging,
+            ('POST', '/admin/logging'): self.configure_logging
+        }
+        self.paths = {path for _, path in self.routes}
+
+    async def start(self, host, port):
+        """Start listening; returns the bound port"""
+        self.hub = StreamHub(asyncio.get_running_loop())
+        self.store.subscribe(self.hub)
+        self.server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start_unix(self, path):
+        """Also listen on a Unix domain socket (call after start)"""
+        self.unix_server = await asyncio.start_unix_server(self.handle_connection, path, backlog=1024)
+        os.chmod(path, 0o600)  # Same user only - the socket skips the network entirely
+
+    async def close(self):
+        """Stop listening and drop open connections (streams never end on their own)"""
+        self.store.unsubscribe(self.hub)
+        self.server.close()
+        if self.unix_server:
+            self.unix_server.close()
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests on one connection until it closes"""
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HttpError as e:
+                    writer.write(error(HTTPStatus(e.status).phrase, e.status).encode(keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                started = time.perf_counter()
+                handler = self.routes.get((request.method, request.path))
+                route = request.path if handler or request.method == 'OPTIONS' and request.path in self.paths \
+                    else 'unmatched'
+                if request.method == 'OPTIONS' and request.path in self.paths:
+                    writer.write(preflight(request))
+                    status = 200
+                elif handler is None:
+                    status = 405 if request.path in self.paths else 404
+                    writer.write(error(HTTPStatus(status).phrase, status).encode(request.keep_alive))
+                elif handler == self.stream_state:
+                    core.metrics.observe_request(route, request.method, 200, time.perf_counter() - started)
+                    await self.stream_state(request, writer)
+                    break
+                else:
+                    try:
+                        response = await handler(request)
+                    except HttpError as e:
+                        response = error(HTTPStatus(e.status).phrase, e.status)
+                    except Exception:
+                        core.request_log.exception("Error handling %s %s", request.method, request.path)
+                        response = error(HTTPStatus.INTERNAL_SERVER_ERROR.phrase, 500)
+                    writer.write(response.encode(request.keep_alive))
+                    status = response.status
+                core.metrics.observe_request(route, request.method, status, time.perf_counter() - started)
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # Client went away, or the server is closing
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    # Endpoints - same behaviour and logging as the Flask routes
+
+    async def get_metrics(self, request):
+        return Response(raw=core.metrics.render(self.store.version).encode(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    async def get_state(self, request):
+        core.metrics.state_delivered(core.Metrics.client(request.headers.get('user-agent')))
+        snapshot = self.store.snapshot
+        etag = core.state_etag(snapshot.version)
+        if etag in request.if_none_match or '*' in request.if_none_match:
+            return Response(status=304, etag=etag)
+
+        since = request.arg('since', type=int)
+        if since is None:
+            return Response(raw=snapshot.encoded(), etag=etag)
+        version, changes = self.store.changes_since(since)
+        return Response({'version': version, 'changes': changes}, etag=core.state_etag(version))
+
+    async def stream_state(self, request, writer):
+        """Server-Sent Events: full state on connect, then one event per change"""
+        listener = self.hub.listen()
+        client = core.Metrics.client(request.headers.get('user-agent'))
+        core.metrics.stream_opened(client)
+        snapshot = self.store.snapshot
+        last_version = snapshot.version
+        try:
+            writer.write(response_head(200, {'Content-Type': 'text/event-stream; charset=utf-8',
+                                             'Cache-Control': 'no-cache',
+                                             'Access-Control-Allow-Origin': '*',
+                                             'Transfer-Encoding': 'chunked',
+                                             'Connection': 'close'}))
+            writer.write(encode_event(snapshot))
+            core.metrics.state_delivered(client)
+            await writer.drain()
+            while True:
+                try:
+                    snapshot, event = await asyncio.wait_for(listener.get(), core.STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    writer.write(KEEPALIVE_EVENT)
+                    await writer.drain()
+                    continue
+                if snapshot.version <= last_version:
+                    continue  # Published before this stream took its first snapshot
+                last_version = snapshot.version
+                core.metrics.state_delivered(client)
+                writer.write(event)
+                await writer.drain()
+        finally:
+            core.metrics.stream_closed(client)
+            self.hub.unlisten(listener)
+
+    async def get_events(self, request):
+        events, gap, seq = self.history.since(request.arg('since', 0, type=int))
+        return Response({'seq': seq, 'gap': gap, 'events': events}, etag=core.state_etag(seq))
+
+    async def wait(self, request):
+        timeout = request.arg('timeout', core.WAIT_TIMEOUT, type=float)
+        since = request.arg('since', -1, type=int)
+        if not math.isfinite(timeout) or timeout < 0:
+            return error("'timeout' must be a non-negative number")
+        predicates = core.parse_predicates(request.args)
+
+        def matches(snapshot):
+            return snapshot.version > since and core.predicates_match(snapshot.state, predicates)
+
+        listener = self.hub.listen()
+        try:
+            snapshot = self.store.snapshot
+            deadline = time.monotonic() + min(timeout, core.WAIT_TIMEOUT_MAX)
+            while not matches(snapshot):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    snapshot = self.store.snapshot
+                    return Response({'matched': False, 'version': snapshot.version, 'state': snapshot.state},
+                                    etag=core.state_etag(snapshot.version))
+                try:
+                    snapshot, _ = await asyncio.wait_for(listener.get(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.hub.unlisten(listener)
+        return Response({'matched': True, 'version': snapshot.version, 'state': snapshot.state},
+                        etag=core.state_etag(snapshot.version))
+
+    async def update_state(self, request):
+        data = request.json(silent=False)
+        core.request_log.debug("Received state update: %s", data, extra={'fields': data})
+        if data:
+            try:
+                with self.store.transaction() as state:
+                    core.apply_update(state, data)
+            except StateError as e:
+                return error(str(e))
+            core.log_update(data)
+        return Response({'status': 'ok'})
+
+    async def health_check(self, request):
+        return Response({'status': 'running'})
+
+    async def batch(self, request):
+        data = request.json() or {}
+        operations = data.get('operations') if isinstance(data, dict) else data
+        try:
+            snapshot = self.store.apply(core.apply_batch, operations)
+        except core.BatchError as e:
+            return error(str(e))
+        core.log_batch(operations)
+        return Response({'status': 'ok', 'version': snapshot.version, 'state': snapshot.state},
+                        etag=core.state_etag(snapshot.version))
+
+    async def play_animation(self, request):
+        data = request.json(silent=False)
+        if data:
+            try:
+                self.store.apply(core.play_animation_command, data)
+            except core.QueueError as e:
+                return error(str(e))
+            core.animation_log.info("Playing animation: %s", data.get('name', data.get('id')))
+        return Response({'status': 'ok'})
+
+    async def stop_animation(self, request):
+        with self.store.transaction() as state:
+            core.apply_stop_animation(state)
+        core.animation_log.info("Animation stopped")
+        return Response({'status': 'ok'})
+
+    async def show_gif(self, request):
+        data = request.json(silent=False)
+        if data and 'url' in data:
+            try:
+                self.store.apply(core.show_gif_command, data)
+            except core.QueueError as e:
+                return error(str(e))
+            core.gif_log.info("Showing GIF: %s", data.get('url'))
+        return Response({'status': 'ok'})
+
+    async def hide_gif(self, request):
+        with self.store.transaction() as state:
+            core.apply_hide_gif(state)
+        core.gif_log.info("GIF hidden, avatar restored")
+        return Response({'status': 'ok'})
+
+    async def get_queue(self, request):
+        snapshot = self.store.snapshot
+        return Response(core.queue_view(snapshot), etag=core.state_etag(snapshot.version))
+
+    async def enqueue(self, request):
+        data = request.json()
+        try:
+            snapshot = self.store.apply(core.apply_enqueue, data)
+        except core.QueueError as e:
+            return error(str(e))
+        core.log_enqueue(data)
+        return Response(dict(core.queue_view(snapshot), status='ok'))
+
+    async def clear_queue(self, request):
+        with self.store.transaction() as state:
+            core.apply_clear_queue(state)
+        core.queue_log.info("Queue cleared")
+        return Response({'status': 'ok'})
+
+    async def get_logging(self, request):
+        return Response(core.event_log.settings())
+
+    async def configure_logging(self, request):
+        data = request.json() or {}
+        try:
+            settings = core.event_log.configure(data.get('level'), data.get('rates'), data.get('jsonl'))
+        except (ValueError, AttributeError) as e:
+            return error(str(e))
+        return Response(dict(settings, status='ok'))
+
+async def read_request(reader):
+    """Read one request; None when the client closed the connection"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(400)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n'):
+            break
+        if not line or len(headers) > 100:
+            raise HttpError(400)
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HttpError(400)
+    if length > MAX_BODY:
+        raise HttpError(413)
+    body = await reader.readexactly(length) if length else b''
+    return Request(method, target, version, headers, body)
+
+def preflight(request):
+    """CORS preflight answer (what flask_cors sends)"""
+    headers = {'Access-Control-Allow-Origin': '*',
+               'Access-Control-Allow-Methods': 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT',
+               'Content-Length': '0'}
+    if 'access-control-request-headers' in request.headers:
+        headers['Access-Control-Allow-Headers'] = request.headers['access-control-request-headers']
+    return response_head(200, headers)
+
+def run(store, host='0.0.0.0', port=3338, unix_path=None):
+    """Serve until interrupted, also on a Unix socket when unix_path is given"""
+    async def main():
+        server = AsyncStateServer(store)
+        await server.start(host, port)
+        if unix_path:
+            await server.start_unix(unix_path)
+        await server.server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+class BackgroundStateServer:
+    """AsyncStateServer on its own event loop thread, for embedded mode
+
+    Listening starts before the constructor returns, so a port that is
+    already taken raises OSError here instead of in the thread. With
+    serve=False requests wait in the backlog until serve() is called.
+    """
+
+    def __init__(self, store, host='0.0.0.0', port=3338, unix_path=None, serve=True):
+        self.loop = asyncio.new_event_loop()
+        self.server = AsyncStateServer(store)
+        try:
+            self.port = self.loop.run_until_complete(self.server.start(host, port))
+        except OSError:
+            store.unsubscribe(self.server.hub)
+            self.loop.close()
+            raise
+        if unix_path:
+            self.loop.run_until_complete(self.server.start_unix(unix_path))
+        self.thread = threading.Thread(target=self.loop.run_forever, name='state-server', daemon=True)
+        if serve:
+            self.serve()
+
+    def serve(self):
+        """Start answering requests"""
+        self.thread.start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,33 @@
+# avatar_config.py
+"""
+Configuration for the avatar display
+Values come from avatar_config.ini, with built-in defaults for anything missing
+"""
+
+import configparser
+import os
+
+AVATAR_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(AVATAR_DIR, 'avatar_config.ini')
+
+DEFAULTS = {
+    'gif_cache': {
+        'memory_mb': '32',
+        'disk_mb': '256',
+        'directory': 'cache/gifs'
+    },
+    'gif_playback': {
+        'memory_mb': '48'
+    }
+}
+
+def load_config(path=CONFIG_FILE):
+    """Read the config file on top of the defaults"""
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULTS)
+    config.read(path)
+    return config
+
+def avatar_path(relative):
+    """Resolve a path from the config relative to the avatar folder"""
+    return relative if os.path.isabs(relative) else os.path.join(AVATAR_DIR, relative)
@@ -7,50 +7,133 @@ Shows Mimi with selected pose or animated GIFs
 import sys
 import os
 import json
-import tempfile
+import argparse
+import atexit
+import threading
 from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout
-from PyQt5.QtCore import Qt, QTimer, QPoint, QUrl, QByteArray, QBuffer, QSize
-from PyQt5.QtGui import QPixmap, QCursor, QMovie
+from PyQt5.QtCore import Qt, QTimer, QPoint, QUrl, QByteArray, QSize, pyqtSignal
+from PyQt5.QtGui import QCursor
 from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
 import requests
 from requests.exceptions import ConnectionError
 import time
 
+from state_client import StateClient, PositionPublisher, BACKOFF_MIN, BACKOFF_MAX, CLIENT_HEADERS
+from animation_timeline import AnimationTimeline
+from sprite_cache import SpriteCache, SpriteLoader
+from gif_cache import GifCache
+from gif_player import GifPlayer
+import local_socket
+from local_socket import state_session
+from shared_state import SharedStateReader
+import state_journal
+from avatar_config import load_config
+
+# Set by start_all.py: the file to create once the first frame is shown
+READY_ENV = 'MAID_READY_FILE'
+
+def signal_ready():
+    """Tell the launcher the display is up"""
+    path = os.environ.get(READY_ENV)
+    if path:
+        try:
+            with open(path, 'w') as f:
+                f.write(str(os.getpid()))
+        except OSError:
+            pass  # The launcher stopped waiting
+
+class StoreSubscription:
+    """Store subscriber for embedded mode: hands the newest snapshot to the GUI thread
+
+    put() runs on the writing thread with the store's lock held, so it only
+    keeps the snapshot and wakes the GUI once; a burst of writes is applied once.
+    """
+    
+    def __init__(self, notify):
+        self.notify = notify
+        self.latest = None
+        self.lock = threading.Lock()
+        
+    def put(self, snapshot):
+        with self.lock:
+            pending = self.latest is not None
+            self.latest = snapshot
+        if not pending:
+            self.notify()
+            
+    def take(self):
+        """Newest snapshot not yet taken, or None"""
+        with self.lock:
+            snapshot, self.latest = self.latest, None
+        return snapshot
+
 class AvatarWindow(QWidget):
-    def __init__(self):
+    # Emitted from the stream thread, delivered on the GUI thread
+    state_received = pyqtSignal(str, dict)
+    stream_lost = pyqtSignal()
+    # Emitted by the store subscription in embedded mode
+    store_changed = pyqtSignal()
+    
+    def __init__(self, store=None):
         super().__init__()
+        self.startup_time = time.perf_counter()  # For time-to-first-frame
+        self.config = load_config()
+        self.first_frame_shown = False
         self.state_url = "http://localhost:3338"
         self.current_pose = "idle"
         self.current_animation_id = None
         self.current_gif_url = None
-        self.sprites = {}
+        self.sprites = {}  # Decoded sprites, filled in the background
+        self.sprite_paths = {}  # Every sprite in the library, by pose name
+        
+        # Store original window size
+        self.normal_width = 200
+        self.normal_height = 300
+        
+        self.sprite_loader = SpriteLoader(self.sprites, self.normal_height)
+        self.sprite_cache = SpriteCache()  # Scaled pixmaps keyed by (pose, size)
         self.dragging = False
         self.drag_position = QPoint()
         self.mouse_press_pos = None
         self.has_moved = False
-        self.animation_start_times = {}  # Track animation start times locally
-        self.last_pose_indices = {}  # Track last pose index for each animation
+        self.timeline = None  # Local playback of the current animation
+        self.timeline_key = None  # (id, start_time) of the last animation started
+        self.last_state = None  # Most recent state from the server
+        self.state_etag = None  # Version of last_state (server ETag)
+        self.stream_active = False  # True while /state/stream is delivering
+        self.stream_stop = threading.Event()
+        self.poll_pending = False  # A /state poll is in flight
+        self.shared_state = None  # Reader for the server's shared memory segment, if it has one
+        self.shared_state_retry = 0  # Next time to look for the segment
+        self.poll_timer = None
+        self.store = store  # The state store itself when the service runs in this process
+        self.store_subscription = None
+        
+        # All GUI-side requests go through the network thread
+        self.client = StateClient(self.state_url)
+        self.position_publisher = PositionPublisher(self.client)  # Coalesced drag updates
         
         # Network manager for downloading GIFs
         self.network_manager = QNetworkAccessManager()
         self.network_manager.finished.connect(self.on_gif_downloaded)
         
-        # Movie for GIF playback
-        self.movie = None
+        # GIF playback
+        self.gif_player = None
         self.gif_data = None
-        self.gif_timer = None
+        self.gif_memory_budget = int(self.config['gif_playback'].getfloat('memory_mb') * 1024 * 1024)
+        self.gif_cache = GifCache.from_config(self.config)
         self.playing_gif = False
         
-        # Store original window size
-        self.normal_width = 200
-        self.normal_height = 300
-        
         self.init_ui()
         self.load_sprites()
-        self.start_state_polling()
+        if self.store is not None:
+            self.start_store_subscription()
+        else:
+            self.start_state_polling()
+            self.start_state_stream()
         
-        # Set initial sprite after window is fully initialized
-        QTimer.singleShot(50, lambda: self.set_sprite("idle"))
+        # Set initial sprite once the event loop is running
+        QTimer.singleShot(0, lambda: self.set_sprite("idle"))
         
     def init_ui(self):
         """Initialize the UI"""
@@ -85,7 +168,7 @@ class AvatarWindow(QWidget):
         self.setMouseTracking(True)
         
     def load_sprites(self):
-        """Load all available sprites"""
+        """Find all sprites, decode idle now and the rest in the background"""
         library_path = os.path.join(os.path.dirname(__file__), "library")
         if not os.path.exists(library_path):
             print(f"Library path not found: {library_path}")
@@ -94,19 +177,41 @@ class AvatarWindow(QWidget):
         for filename in os.listdir(library_path):
             if filename.endswith('.png'):
                 sprite_name = filename.replace('.png', '')
-                filepath = os.path.join(library_path, filename)
-                pixmap = QPixmap(filepath)
-                if not pixmap.isNull():
-                    # Store original pixmap without scaling
-                    self.sprites[sprite_name] = pixmap
-                    print(f"Loaded sprite: {sprite_name}")
+                self.sprite_paths[sprite_name] = os.path.join(library_path, filename)
+        
+        # Idle first so the window can show right away
+        if 'idle' in self.sprite_paths:
+            self.sprite_loader.load_now('idle', self.sprite_paths['idle'])
+        
+        self.sprite_loader.loaded.connect(self.on_sprite_loaded)
+        self.sprite_loader.finished.connect(self.on_sprites_finished)
+        self.sprite_loader.load_async(self.sprite_paths)
+        print(f"Found {len(self.sprite_paths)} sprites, decoding in background")
+        
+    def on_sprite_loaded(self, name):
+        """A background-decoded sprite is ready"""
+        print(f"Loaded sprite: {name}")
+        
+    def on_sprites_finished(self):
+        """Log when every sprite has been decoded"""
+        elapsed = (time.perf_counter() - self.startup_time) * 1000
+        print(f"[STARTUP] All {len(self.sprites)} sprites loaded after {elapsed:.0f} ms")
+        
+    def report_first_frame(self):
+        """Log time-to-first-frame (runs after the first sprite has been painted)"""
+        elapsed = (time.perf_counter() - self.startup_time) * 1000
+        print(f"[STARTUP] First frame after {elapsed:.0f} ms")
+        signal_ready()
         
     def set_sprite(self, pose_name, animation_id=None):
         """Change the displayed sprite"""
         # Stop any playing GIF
-        if self.movie:
-            self.movie.stop()
-            self.movie = None
+        if self.gif_player:
+            self.stop_gif_player()
+            
+        # Decode on demand if the background loader hasn't got to it yet
+        if pose_name not in self.sprites and pose_name in self.sprite_paths:
+            self.sprite_loader.load_now(pose_name, self.sprite_paths[pose_name])
             
         if pose_name in self.sprites:
             # Get the original pixmap
@@ -118,11 +223,8 @@ class AvatarWindow(QWidget):
             
             # Only scale if window has valid size
             if target_width > 0 and target_height > 0:
-                scaled_pixmap = pixmap.scaled(
-                    target_width, target_height,
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                )
+                scaled_pixmap = self.sprite_cache.get(pose_name, target_width,
+                                                      target_height, pixmap)
                 self.sprite_label.setPixmap(scaled_pixmap)
             else:
                 # Use original if window not ready
@@ -130,17 +232,28 @@ class AvatarWindow(QWidget):
                 
             self.current_pose = pose_name
             
+            if not self.first_frame_shown:
+                self.first_frame_shown = True
+                QTimer.singleShot(0, self.report_first_frame)
+            
             if animation_id and animation_id != self.current_animation_id:
                 self.current_animation_id = animation_id
         else:
             print(f"Sprite not found: {pose_name}")
             
     def download_gif(self, url):
-        """Download a GIF from URL"""
+        """Download a GIF from URL, or play it straight from the cache"""
         if url == self.current_gif_url:
             return  # Already downloading or downloaded
             
         self.current_gif_url = url
+        cached = self.gif_cache.get(QUrl(url).toString())
+        if cached is not None:
+            print(f"GIF from cache: {url}")
+            self.gif_data = QByteArray(cached)
+            self.show_gif()
+            return
+            
         request = QNetworkRequest(QUrl(url))
         self.network_manager.get(request)
         print(f"Downloading GIF: {url}")
@@ -148,8 +261,13 @@ class AvatarWindow(QWidget):
     def on_gif_downloaded(self, reply):
         """Handle downloaded GIF data"""
         if reply.error() == QNetworkReply.NoError:
-            self.gif_data = reply.readAll()
-            self.show_gif()
+            data = reply.readAll()
+            url = reply.request().url().toString()
+            self.gif_cache.put(url, data.data())
+            # Only show it if it is still the GIF the server wants
+            if self.current_gif_url and QUrl(self.current_gif_url).toString() == url:
+                self.gif_data = data
+                self.show_gif()
         else:
             print(f"Error downloading GIF: {reply.errorString()}")
         reply.deleteLater()
@@ -162,91 +280,56 @@ class AvatarWindow(QWidget):
         # Temporarily double the width for GIF display
         self.resize(self.normal_width * 2, self.normal_height)
         
-        # Save GIF to temporary file - sometimes QMovie works better with files
-        try:
-            with tempfile.NamedTemporaryFile(suffix='.gif', delete=False) as tmp_file:
-                tmp_file.write(self.gif_data)
-                self.temp_gif_path = tmp_file.name
-        except Exception as e:
-            print(f"Error saving temp GIF: {e}")
-            return
+        # Replace any GIF that is already playing
+        if self.gif_player:
+            self.stop_gif_player()
             
-        # Create a movie from the file
-        self.movie = QMovie(self.temp_gif_path)
-        
-        # For large GIFs, reduce quality to improve performance
-        gif_size = os.path.getsize(self.temp_gif_path)
-        if gif_size > 500000:  # If GIF is larger than 500KB
-            print(f"Large GIF detected ({gif_size} bytes), optimizing for performance")
-            # Don't cache all frames for large GIFs
-            self.movie.setCacheMode(QMovie.CacheNone)
-        else:
-            # Force cache mode for smoother playback on small GIFs
-            self.movie.setCacheMode(QMovie.CacheAll)
-        
-        # Set a reasonable cache limit
-        self.movie.setScaledSize(QSize())  # Use original size, no scaling
-        
-        # Don't scale at all - let GIF play at original size
-        # Center it in the label instead
+        # Frames are decoded ahead on a worker thread, downscaled to fit the
+        # window, within the configured memory budget - no temporary file
+        gif_size = self.gif_data.size()
+        self.gif_player = GifPlayer(self.gif_data.data(), QSize(self.normal_width * 2, self.normal_height),
+                                    self.gif_memory_budget, self)
+        self.gif_player.frame_changed.connect(self.sprite_label.setPixmap)
+        self.gif_player.opened.connect(self.on_gif_opened)
+        
+        # Centre the frames in the label
         self.sprite_label.setScaledContents(False)
         self.sprite_label.setAlignment(Qt.AlignCenter)
+        self.gif_player.start()
         
-        # Set the movie to the label
-        self.sprite_label.setMovie(self.movie)
+        # ENTER GIF MODE - the server clears the GIF when its duration is up
+        self.stop_timeline()
+        self.playing_gif = True
         
-        # Connect frame updates to force widget updates
-        # Commenting out aggressive frame updates - this might cause hiccups
-        # self.movie.frameChanged.connect(self.on_gif_frame_changed)
+        print(f"GIF loaded from memory: {gif_size} bytes")
+        print("Entered GIF MODE")
         
-        # Start playing at natural speed
-        self.movie.setSpeed(100)  # Explicitly set to normal speed
-        self.movie.start()
+    def on_gif_opened(self, frame_count, capacity, all_in_memory):
+        """Log how the GIF fits the frame memory budget"""
+        mode = "looping from memory" if all_in_memory else "streaming through the frame buffer"
+        print(f"GIF frame count: {frame_count or 'unknown'}, buffer {capacity} frames, {mode}")
         
-        # ENTER GIF MODE - Stop state polling for smooth playback
-        self.poll_timer.stop()
-        self.playing_gif = True
+    def stop_gif_player(self):
+        """Stop GIF playback and log its frame timing metrics"""
+        self.gif_player.stop()
+        print(self.gif_player.stats())
+        self.gif_player.deleteLater()
+        self.gif_player = None
         
-        # Clear any pending animations on the server and set pose to None
-        try:
-            requests.post(f"{self.state_url}/state", 
-                        json={'animation': None, 'pose': None},
-                        timeout=0.05)
-        except:
-            pass
-        
-        # Start a timer to check GIF duration
-        # Duration comes from the server state
-        self.gif_timer = QTimer()
-        self.gif_timer.timeout.connect(self.check_gif_duration)
-        self.gif_timer.start(1000)  # Check every second
-        
-        # Log the movie speed to debug
-        print(f"GIF playing - Speed: {self.movie.speed()}% (100% is normal)")
-        print(f"GIF frame count: {self.movie.frameCount()}")
-        print(f"GIF loaded from temp file: {self.temp_gif_path}")
-        print("Entered GIF MODE - State polling paused")
-        
-    def hide_gif(self):
-        """Hide the GIF and restore avatar"""
+    def hide_gif(self, notify_server=True):
+        """Hide the GIF and restore avatar
+
+        notify_server is False when the server already cleared the GIF.
+        """
         # Prevent multiple calls
-        if not self.movie and not self.playing_gif:
+        if not self.gif_player and not self.playing_gif:
             return  # Already hidden
             
-        if self.movie:
-            # Stop the movie
-            self.movie.stop()
-            self.movie = None
+        if self.gif_player:
+            self.stop_gif_player()
             self.current_gif_url = None
             self.gif_data = None
             
-        # Clean up temporary file
-        if hasattr(self, 'temp_gif_path') and os.path.exists(self.temp_gif_path):
-            try:
-                os.unlink(self.temp_gif_path)
-            except:
-                pass
-            
         # Restore scaled contents setting for sprites
         self.sprite_label.setScaledContents(False)
         
@@ -256,170 +339,261 @@ class AvatarWindow(QWidget):
         # Restore the avatar sprite with proper scaling
         self.set_sprite("idle")
         
-        # Stop GIF duration timer if running
-        if hasattr(self, 'gif_timer') and self.gif_timer:
-            self.gif_timer.stop()
-            self.gif_timer = None
-            
-        # EXIT GIF MODE - Restart state polling for animations
+        # EXIT GIF MODE
         self.playing_gif = False
         
-        # Notify server to set pose back to idle
-        try:
-            requests.post(f"{self.state_url}/state", 
-                        json={'pose': 'idle'},
-                        timeout=0.1)
-        except:
-            pass
+        # Notify server - pose back to idle and GIF cleared in one step
+        if notify_server:
+            self.client.post('/batch', {'operations': [{'op': 'set', 'pose': 'idle'},
+                                                       {'op': 'hide_gif'}]})
             
         # Wait a moment before restarting polling to ensure state is updated
         QTimer.singleShot(100, self.restart_polling)
-        
-        # Notify server
-        try:
-            requests.post(f"{self.state_url}/hide_gif", timeout=0.1)
-        except:
-            pass
             
     def start_state_polling(self):
-        """Start polling for state changes"""
+        """Start polling for state changes (shared memory if offered, else HTTP while the stream is down)"""
         self.poll_timer = QTimer()
         self.poll_timer.timeout.connect(self.check_state)
         self.poll_timer.start(50)  # Check every 50ms for smoother animations
         
+    def start_state_stream(self):
+        """Subscribe to pushed state changes from /state/stream"""
+        self.state_received.connect(self.on_stream_state)
+        self.stream_lost.connect(self.on_stream_lost)
+        thread = threading.Thread(target=self.stream_worker, daemon=True)
+        thread.start()
+        
+    def start_store_subscription(self):
+        """Follow the in-process store (embedded mode) - no HTTP, no JSON"""
+        self.store_changed.connect(self.on_store_changed, Qt.QueuedConnection)
+        self.store_subscription = self.store.subscribe(StoreSubscription(self.store_changed.emit))
+        
+    def on_store_changed(self):
+        """Apply the newest snapshot of the in-process store"""
+        snapshot = self.store_subscription.take()
+        if snapshot is None:
+            return
+        # Shared with the store and never modified - apply_state only reads it
+        self.last_state = snapshot.state
+        self.apply_state(snapshot.state)
+        
+    def stream_worker(self):
+        """Read Server-Sent Events in a background thread, reconnecting on failure"""
+        backoff = BACKOFF_MIN
+        while not self.stream_stop.is_set():
+            try:
+                with state_session(self.state_url) as session, \
+                        session.get(f"{self.state_url}/state/stream", headers=CLIENT_HEADERS,
+                                    stream=True, timeout=(1, 30)) as response:
+                    backoff = BACKOFF_MIN
+                    event_id = ''
+                    for line in response.iter_lines(decode_unicode=True):
+                        if self.stream_stop.is_set():
+                            return
+                        if line and line.startswith('id: '):
+                            event_id = line[4:]
+                        elif line and line.startswith('data: '):
+                            self.state_received.emit(event_id, json.loads(line[6:]))
+            except (ConnectionError, requests.RequestException, ValueError):
+                pass
+            self.stream_lost.emit()
+            # Retry with exponential backoff while the server is down
+            self.stream_stop.wait(backoff)
+            backoff = min(backoff * 2, BACKOFF_MAX)
+            
+    def on_stream_state(self, etag, state):
+        """Apply a pushed state and switch off polling"""
+        if not self.stream_active:
+            self.stream_active = True
+            self.shared_state_retry = 0
+            if not self.attach_shared_state():
+                self.poll_timer.stop()
+                print("State stream connected - polling paused")
+        if etag and etag == self.state_etag:
+            return  # Snapshot on reconnect that we already applied
+        self.state_etag = etag
+        self.last_state = state
+        self.apply_state(state)
+        
+    def on_stream_lost(self):
+        """Fall back to polling while the stream is down"""
+        if self.stream_active:
+            self.stream_active = False
+            print("State stream lost - falling back to polling")
+        if self.shared_state is not None:
+            # The server is gone - a restarted one may publish a new segment
+            self.shared_state.close()
+            self.shared_state = None
+        if not self.poll_timer.isActive():
+            self.poll_timer.start(50)
+            
     def check_state(self):
         """Check for state updates from the server"""
         if self.dragging:
             return
             
-        # Skip ALL state checking during GIF playback
-        # This ensures smooth GIF performance
-        if self.playing_gif:
+        if self.read_shared_state():
             return
             
-        try:
-            response = requests.get(f"{self.state_url}/state", timeout=0.05)  # 50ms timeout for faster polling
-            if response.status_code == 200:
+        # Only one poll in flight - a slow server must not pile up requests
+        if self.poll_pending:
+            return
+        self.poll_pending = True
+        
+        headers = {'If-None-Match': f'"{self.state_etag}"'} if self.state_etag else {}
+        self.client.get('/state', self.on_state_response, headers)
+        
+    def attach_shared_state(self):
+        """Look for the server's shared memory segment (at most once a second); True if attached"""
+        if self.shared_state is None:
+            now = time.monotonic()
+            if now < self.shared_state_retry:
+                return False
+            self.shared_state_retry = now + 1
+            self.shared_state = SharedStateReader.open()
+            if self.shared_state is None:
+                return False
+            print("Reading state from shared memory")
+        return True
+        
+    def read_shared_state(self):
+        """Take the state from shared memory; False when there is no segment (poll HTTP instead)"""
+        if not self.attach_shared_state():
+            return False
+            
+        # One counter compare when nothing changed
+        result = self.shared_state.read()
+        if result is None:
+            return True
+        etag, state = result
+        if state is None:
+            return False  # Too large for the segment - this tick polls HTTP
+        if etag != self.state_etag:
+            self.state_etag = etag
+            self.last_state = state
+            self.apply_state(state)
+        return True
+        
+    def on_state_response(self, response):
+        """Handle a /state poll answer on the GUI thread"""
+        self.poll_pending = False
+        if response is None:
+            return  # Server down - the client is backing off
+            
+        # 304 means nothing moved on the server - the timeline runs on its own
+        if response.status_code == 200:
+            try:
                 state = response.json()
+            except ValueError:
+                return
+            self.state_etag = response.headers.get('ETag', '').strip('"') or None
+            self.last_state = state
+            self.apply_state(state)
+            
+    def apply_state(self, state):
+        """Apply a server state to the window"""
+        if self.dragging:
+            return
+            
+        # In GIF mode only watch for the server clearing or replacing the GIF
+        if self.playing_gif:
+            gif_info = state.get('gif')
+            if not gif_info or gif_info.get('url') != self.current_gif_url:
+                print("GIF cleared by the server")
+                self.hide_gif(notify_server=False)
+            return
+            
+        # Check visibility
+        visible = state.get('visible', True)
+        if visible and not self.isVisible():
+            self.show()
+        elif not visible and self.isVisible():
+            self.hide()
+        
+        # Check for GIF
+        gif_info = state.get('gif')
+        if gif_info:
+            # GIF is active - the server removes it when its duration is up
+            gif_url = gif_info.get('url')
+            
+            # Download and show GIF if not already showing
+            if gif_url and gif_url != self.current_gif_url:
+                self.download_gif(gif_url)
+        else:
+            # No GIF, handle normal avatar display
+            if self.gif_player:
+                self.hide_gif()
+                return  # Exit early since we just hid the GIF
+            # Cleared while it was still downloading - the download must not start GIF mode
+            self.current_gif_url = None
+            self.gif_data = None
+            
+            # Handle animation
+            animation = state.get('animation')
+            if animation:
+                self.follow_animation(animation)
+            else:
+                # Animation cancelled or finished on the server
+                self.stop_timeline()
                 
-                # Check visibility
-                visible = state.get('visible', True)
-                if visible and not self.isVisible():
-                    self.show()
-                elif not visible and self.isVisible():
-                    self.hide()
-                
-                # Check for GIF
-                gif_info = state.get('gif')
-                if gif_info:
-                    # GIF is active
-                    gif_url = gif_info.get('url')
-                    duration = gif_info.get('duration', 5)
-                    self.gif_duration = duration
-                    self.gif_start_time = gif_info.get('start_time', time.time())
-                    
-                    # Download and show GIF if not already showing
-                    if gif_url and gif_url != self.current_gif_url:
-                        self.download_gif(gif_url)
-                    
-                    # Check if GIF duration has expired
-                    elapsed = time.time() - self.gif_start_time
-                    if elapsed >= self.gif_duration:
-                        self.hide_gif()
-                        print(f"GIF duration expired ({self.gif_duration}s)")
-                        return  # Exit early since we just hid the GIF
-                else:
-                    # No GIF, handle normal avatar display
-                    if self.movie:
-                        self.hide_gif()
-                        return  # Exit early since we just hid the GIF
-                    
-                    # Handle animation
-                    animation = state.get('animation')
-                    if animation:
-                        # Get sequence from either 'sequence' or 'frames' field
-                        sequence = animation.get('sequence') or animation.get('frames', [])
-                        if sequence:
-                            # Animation logic
-                            animation_id = animation.get('id', 'unknown')
-                            fps = animation.get('fps', 2)
-                            loop = animation.get('loop', False)
-                        
-                        # Use local start time tracking
-                        if animation_id not in self.animation_start_times:
-                            # First time seeing this animation, set start time
-                            self.animation_start_times[animation_id] = time.time()
-                            start_time = self.animation_start_times[animation_id]
-                            print(f"\n[ANIMATION START] {animation_id}")
-                            print(f"  Sequence: {sequence}")
-                            print(f"  Total poses: {len(sequence)}")
-                            # Use duration_per_pose if available, otherwise default to 2 seconds
-                            duration_per_pose = animation.get('duration_per_pose', 2.0)
-                            print(f"  Duration per pose: {duration_per_pose}s")
-                            print(f"  Total duration: {len(sequence) * duration_per_pose:.1f}s")
-                        else:
-                            start_time = self.animation_start_times[animation_id]
-                        
-                        elapsed = time.time() - start_time
-                        total_poses = len(sequence)
-                        
-                        # Get duration_per_pose or calculate from fps
-                        if 'duration_per_pose' in animation:
-                            duration_per_pose = animation['duration_per_pose']
-                        elif fps > 0:
-                            duration_per_pose = 1.0 / fps
-                        else:
-                            duration_per_pose = 2.0  # Default 2 seconds
-                            
-                        current_pose_index = int(elapsed / duration_per_pose)
-                        time_in_current_pose = elapsed % duration_per_pose
-                        
-                        # Detailed pose logging (only log significant changes)
-                        last_index = self.last_pose_indices.get(animation_id, -1)
-                        if current_pose_index != last_index and current_pose_index < len(sequence):
-                            pose_name = sequence[current_pose_index] if current_pose_index < len(sequence) else "unknown"
-                            print(f"[POSE] {animation_id}: showing pose {current_pose_index} ({pose_name}) at {elapsed:.1f}s")
-                            self.last_pose_indices[animation_id] = current_pose_index
-                        
-                        if loop:
-                            # For looping animations, wrap around
-                            current_pose_index = current_pose_index % total_poses
-                            pose = sequence[current_pose_index]
-                            if pose != self.current_pose:
-                                print(f"  -> Setting pose: {pose} (pose {current_pose_index})")
-                                self.set_sprite(pose, animation_id)
-                        elif current_pose_index < total_poses:
-                            # For non-looping, show current pose
-                            pose = sequence[current_pose_index]
-                            if pose != self.current_pose:
-                                print(f"  -> Setting pose: {pose} (pose {current_pose_index})")
-                                self.set_sprite(pose, animation_id)
-                        else:
-                            # Animation complete
-                            print(f"\n[ANIMATION COMPLETE] {animation_id} after {elapsed:.3f}s")
-                            # Clear local tracking
-                            if animation_id in self.animation_start_times:
-                                del self.animation_start_times[animation_id]
-                            if animation_id in self.last_pose_indices:
-                                del self.last_pose_indices[animation_id]
-                            requests.post(f"{self.state_url}/state", 
-                                        json={'animation': None, 'pose': 'idle'},
-                                        timeout=0.1)
-                            self.set_sprite('idle')
-                    else:
-                        # Regular pose
-                        new_pose = state.get('pose', 'idle')
-                        if new_pose and new_pose != self.current_pose and not self.movie:
-                            self.set_sprite(new_pose)
-                
-                # Update position
-                if 'position' in state:
-                    x = state['position'].get('x', self.x())
-                    y = state['position'].get('y', self.y())
-                    self.move(x, y)
-                    
-        except (ConnectionError, requests.RequestException):
-            pass
+                # Regular pose
+                new_pose = state.get('pose', 'idle')
+                if new_pose and new_pose != self.current_pose and not self.gif_player:
+                    self.set_sprite(new_pose)
+        
+        # Update position (the window itself is the source of truth mid-drag)
+        if 'position' in state and not self.dragging:
+            x = state['position'].get('x', self.x())
+            y = state['position'].get('y', self.y())
+            self.move(x, y)
+            
+    def follow_animation(self, animation):
+        """Start local playback of an animation the first time it appears"""
+        key = (animation.get('id', 'unknown'), animation.get('start_time'))
+        if key == self.timeline_key:
+            return  # Already playing (or already finished) this one
+            
+        self.stop_timeline()
+        self.timeline_key = key
+        self.timeline = AnimationTimeline(animation, self)
+        self.timeline.pose_changed.connect(self.on_timeline_pose)
+        self.timeline.finished.connect(self.on_timeline_finished)
+        
+        print(f"\n[ANIMATION START] {self.timeline.animation_id}")
+        print(f"  Sequence: {self.timeline.sequence}")
+        print(f"  Total poses: {len(self.timeline.sequence)}")
+        print(f"  Duration per pose: {self.timeline.duration_per_pose}s")
+        print(f"  Total duration: {self.timeline.total_duration:.1f}s")
+        # Scale the poses this animation will need before they are due
+        self.sprite_cache.warm(set(self.timeline.sequence), self.width(),
+                               self.height(), self.sprites)
+        self.timeline.start()
+        
+    def stop_timeline(self):
+        """Cancel local animation playback"""
+        if self.timeline:
+            self.timeline.stop()
+            self.timeline.deleteLater()
+            self.timeline = None
+            
+    def on_timeline_pose(self, pose, index):
+        """Show the pose the timeline just reached"""
+        animation_id = self.timeline.animation_id
+        print(f"[POSE] {animation_id}: showing pose {index} ({pose}) at {self.timeline.elapsed:.1f}s")
+        if self.dragging or self.playing_gif:
+            return  # Shown again when the drag ends
+        if pose != self.current_pose:
+            print(f"  -> Setting pose: {pose} (pose {index % len(self.timeline.sequence)})")
+            self.set_sprite(pose, animation_id)
+            
+    def on_timeline_finished(self):
+        """Return to idle when an animation completes (the server expires it too)"""
+        print(f"\n[ANIMATION COMPLETE] {self.timeline.animation_id} after {self.timeline.elapsed:.3f}s")
+        self.stop_timeline()
+        # Don't replay the finished animation from the cached state
+        if self.last_state:
+            self.last_state = dict(self.last_state, animation=None, pose='idle')
+        self.set_sprite('idle')
             
     # Mouse event handlers
     def mousePressEvent(self, event):
@@ -432,12 +606,7 @@ class AvatarWindow(QWidget):
         elif event.button() == Qt.RightButton:
             # Right-click to hide
             self.hide()
-            try:
-                requests.post(f"{self.state_url}/state", 
-                            json={'visible': False},
-                            timeout=0.1)
-            except:
-                pass
+            self.client.post('/state', {'visible': False})
             
     def mouseMoveEvent(self, event):
         """Handle mouse move - drag window"""
@@ -447,42 +616,33 @@ class AvatarWindow(QWidget):
                 if move_distance > 5:
                     self.has_moved = True
                     self.dragging = True
-                    if "pick_up" in self.sprites and not self.movie:
+                    if "pick_up" in self.sprite_paths and not self.gif_player:
                         self.set_sprite("pick_up")
             
             if self.dragging:
                 self.move(event.globalPos() - self.drag_position)
-                
-                try:
-                    requests.post(f"{self.state_url}/state", 
-                                json={'position': {'x': self.x(), 'y': self.y()}},
-                                timeout=0.1)
-                except:
-                    pass
+                self.position_publisher.publish(self.x(), self.y())
                 
     def mouseReleaseEvent(self, event):
         """Handle mouse release"""
         if event.button() == Qt.LeftButton:
             if not self.has_moved and self.mouse_press_pos:
                 # Click - cancel animation or hide GIF
-                if self.movie:
+                if self.gif_player:
                     self.hide_gif()
                     print("Left-click: GIF hidden")
                 else:
-                    try:
-                        # Clear any animation tracking when cancelling
-                        self.animation_start_times.clear()
-                        self.last_pose_indices.clear()
-                        requests.post(f"{self.state_url}/state", 
-                                    json={'pose': 'idle', 'animation': None},
-                                    timeout=0.1)
-                        self.set_sprite('idle')
-                        self.current_animation_id = None
-                        print("Left-click: Animation cancelled")
-                    except:
-                        pass
+                    # Stop local playback when cancelling
+                    self.stop_timeline()
+                    self.client.post('/state', {'pose': 'idle', 'animation': None})
+                    self.set_sprite('idle')
+                    self.current_animation_id = None
+                    print("Left-click: Animation cancelled")
             elif self.dragging:
                 self.dragging = False
+                self.position_publisher.finish(self.x(), self.y())
+                if self.timeline and self.timeline.pose:
+                    self.set_sprite(self.timeline.pose, self.timeline.animation_id)
                 self.check_state()
             
             self.mouse_press_pos = None
@@ -496,10 +656,27 @@ class AvatarWindow(QWidget):
     def resizeEvent(self, event):
         """Handle window resize events"""
         super().resizeEvent(event)
+        # Scaled sprites for the old size are no longer useful
+        self.sprite_cache.invalidate(self.width(), self.height())
         # Refresh current sprite when window is resized
-        if self.current_pose and not self.movie:
+        if self.current_pose and not self.gif_player:
             self.set_sprite(self.current_pose)
             
+    def closeEvent(self, event):
+        """Stop the state stream and network threads on close"""
+        self.stream_stop.set()
+        if self.poll_timer is not None:
+            self.poll_timer.stop()
+        if self.store_subscription is not None:
+            self.store.unsubscribe(self.store_subscription)
+        self.client.stop()
+        if self.shared_state is not None:
+            self.shared_state.close()
+            self.shared_state = None
+        print(self.sprite_cache.stats())
+        print(self.gif_cache.stats())
+        super().closeEvent(event)
+        
     def keyPressEvent(self, event):
         """ESC key to close"""
         if event.key() == Qt.Key_Escape:
@@ -512,53 +689,26 @@ class AvatarWindow(QWidget):
         self.update()
         
     def restart_polling(self):
-        """Restart state polling after GIF mode"""
-        # Clear any animation tracking since we were in GIF mode
-        self.animation_start_times.clear()
-        self.last_pose_indices.clear()
+        """Catch up with the server state after GIF mode"""
+        # Any animation from before GIF mode is over
+        self.stop_timeline()
         
-        self.poll_timer.start(50)  # Resume at 50ms for smooth animations
-        print("Exited GIF MODE - State polling resumed")
+        # Stream and polling keep running in GIF mode - re-apply the latest state
+        following = "store" if self.store is not None else "stream" if self.stream_active else "polling"
+        print("Exited GIF MODE - Following state " + following)
+        if self.last_state:
+            self.apply_state(self.last_state)
         
         # Log current state
-        try:
-            response = requests.get(f"{self.state_url}/state", timeout=0.05)
-            if response.status_code == 200:
-                state = response.json()
-                animation = state.get('animation')
-                print(f"State after GIF: animation={animation}, pose={state.get('pose', 'unknown')}")
-        except:
-            pass
-        
-    def check_gif_duration(self):
-        """Check if GIF duration has expired"""
-        # Only check if we're actually playing a GIF
-        if not self.playing_gif or not self.movie:
-            # Stop the timer if GIF already ended
-            if self.gif_timer:
-                self.gif_timer.stop()
-            return
-            
-        # Get the latest state to check duration
-        try:
-            response = requests.get(f"{self.state_url}/state", timeout=0.05)
-            if response.status_code == 200:
-                state = response.json()
-                gif_info = state.get('gif')
-                if gif_info:
-                    duration = gif_info.get('duration', 5)
-                    start_time = gif_info.get('start_time', time.time())
-                    elapsed = time.time() - start_time
-                    if elapsed >= duration:
-                        self.hide_gif()
-                        print(f"GIF duration expired ({duration}s)")
-                else:
-                    # GIF was removed from state
-                    self.hide_gif()
-                    print("GIF removed from state")
-        except:
-            pass
-            
+        self.client.get('/state', self.log_state_after_gif)
+        
+    def log_state_after_gif(self, response):
+        """Print the server state once GIF mode has ended"""
+        if response is not None and response.status_code == 200:
+            state = response.json()
+            animation = state.get('animation')
+            print(f"State after GIF: animation={animation}, pose={state.get('pose', 'unknown')}")
+        
     def enterEvent(self, event):
         """Mouse enters window"""
         self.setCursor(QCursor(Qt.OpenHandCursor))
@@ -567,13 +717,52 @@ class AvatarWindow(QWidget):
         """Mouse leaves window"""
         self.setCursor(QCursor(Qt.ArrowCursor))
 
+def start_embedded_service(port=3338, persist=None):
+    """Run the state service in this process; its store, or None when a server is already running
+
+    The HTTP API (and the Unix socket where there is one) is served for
+    external producers from a background thread by the asyncio server, so
+    Flask is never imported. persist is a state_journal durability, or None.
+    """
+    # Only embedded displays load the service
+    import state_service
+    from async_state_server import BackgroundStateServer
+    
+    unix_path = local_socket.SOCKET_PATH if local_socket.supported() and local_socket.claim() else None
+    try:
+        # Bound but not answering yet: a producer connecting early must not be overwritten by the restore
+        server = BackgroundStateServer(state_service.store, port=port, unix_path=unix_path, serve=False)
+    except OSError as e:
+        print(f"Embedded state server not started ({e}) - following the running server instead")
+        return None
+    if unix_path:
+        atexit.register(local_socket.release)
+    state_service.event_log.start()
+    if persist:
+        journal = state_journal.StateJournal(durability=persist)
+        restored = journal.attach(state_service.store)
+        atexit.register(journal.close)
+        print(f"Persisting state ({persist})" + (f" - restored {', '.join(restored)}" if restored else ""))
+    state_service.ExpiryScheduler(state_service.store).start()
+    server.serve()
+    print(f"Embedded state server running on http://localhost:{port}" + (f" and {unix_path}" if unix_path else ""))
+    return state_service.store
+
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Maid avatar display")
+    parser.add_argument('--embedded', action='store_true',
+                        help="run the state server inside the display process instead of avatar_state_server.py")
+    parser.add_argument('--persist', nargs='?', const='interval', choices=state_journal.DURABILITY,
+                        help="with --embedded: keep visibility, pose and position across restarts")
+    args, qt_args = parser.parse_known_args()
+    
+    app = QApplication(sys.argv[:1] + qt_args)
     
     app.setApplicationName("Maid Avatar with GIF")
     app.setQuitOnLastWindowClosed(True)
     
-    avatar = AvatarWindow()
+    store = start_embedded_service(persist=args.persist) if args.embedded else None
+    avatar = AvatarWindow(store)
     avatar.show()
     
     avatar.setToolTip("Left-click to cancel animation/hide GIF | Right-click to hide | Double-click to close\nDrag to move | ESC to close\nGIFs display in expanded window")
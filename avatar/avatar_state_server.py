@@ -4,11 +4,33 @@ Simple state server for avatar coordination
 Runs on http://localhost:3338
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
+from werkzeug.serving import make_server
+import argparse
+import atexit
 import logging
+import math
+import os
+import queue
+import threading
 import time
 
+import local_socket
+import state_journal
+import state_log
+from shared_state import SEGMENT_NAME, SharedStatePublisher
+from state_model import StateError
+from state_store import LatestSnapshot
+# The service itself; this module puts the Flask endpoints in front of it
+from state_service import (
+    STREAM_KEEPALIVE, WAIT_TIMEOUT, WAIT_TIMEOUT_MAX, BatchError, ExpiryScheduler, Metrics, QueueError,
+    animation_log, apply_batch, apply_clear_queue, apply_enqueue, apply_hide_gif, apply_stop_animation,
+    apply_update, event_log, gif_log, history, log_batch, log_enqueue, log_update, metrics, parse_predicates,
+    play_animation_command, predicates_match, queue_log, queue_view, request_log, show_gif_command, state_etag,
+    store,
+)
+
 app = Flask(__name__)
 CORS(app)
 
@@ -16,46 +38,125 @@ CORS(app)
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
-# Global state
-avatar_state = {
-    'visible': True,
-    'pose': 'idle',
-    'position': {'x': 1000, 'y': 100},
-    'last_update': None,
-    'animation': None,  # Animation data
-    'gif': None  # GIF data
-}
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Count the request and its latency under its route (for streams: time to the headers)"""
+    if 'started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - g.started)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text format metrics"""
+    return Response(metrics.render(store.version), mimetype='text/plain; version=0.0.4')
 
 @app.route('/state', methods=['GET'])
 def get_state():
-    """Get current avatar state"""
-    return jsonify(avatar_state)
+    """Get current avatar state
+
+    Supports If-None-Match (304 when unchanged) and ?since=<version>,
+    which returns only the fields changed after that version.
+    """
+    metrics.state_delivered(Metrics.client(request.user_agent.string))
+    snapshot = store.snapshot
+    etag = state_etag(snapshot.version)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    since = request.args.get('since', type=int)
+    if since is None:
+        # Encoded once per version, shared by every GET and stream
+        response = Response(snapshot.encoded(), mimetype='application/json')
+    else:
+        version, changes = store.changes_since(since)
+        etag = state_etag(version)
+        response = jsonify({'version': version, 'changes': changes})
+    
+    response.set_etag(etag)
+    return response
+
+@app.route('/state/stream', methods=['GET'])
+def stream_state():
+    """Server-Sent Events stream: full state on connect, then one event per change"""
+    subscriber = store.subscribe(LatestSnapshot())
+    client = Metrics.client(request.user_agent.string)
+
+    def events():
+        metrics.stream_opened(client)
+        try:
+            while True:
+                try:
+                    snapshot = subscriber.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                payload = snapshot.encoded().rstrip(b'\n')
+                metrics.state_delivered(client)
+                yield b'id: %s\ndata: %s\n\n' % (state_etag(snapshot.version).encode(), payload)
+        finally:
+            metrics.stream_closed(client)
+            store.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    """State changes after ?since=<seq> (seq is the state version), oldest first
+
+    "gap": true means some of those changes are no longer held (or since is
+    from before a restart) - re-read GET /state, then continue from its version.
+    """
+    since = request.args.get('since', 0, type=int)
+    events, gap, seq = history.since(since)
+    response = jsonify({'seq': seq, 'gap': gap, 'events': events})
+    response.set_etag(state_etag(seq))
+    return response
+
+@app.route('/wait', methods=['GET'])
+def wait():
+    """Long-poll until the state matches, e.g. /wait?gif=null&pose=idle&timeout=10
+
+    since=<version> additionally waits for a version newer than that one.
+    Answers as soon as a change makes the predicates true, or with
+    matched=false when the timeout passes.
+    """
+    timeout = request.args.get('timeout', WAIT_TIMEOUT, type=float)
+    since = request.args.get('since', -1, type=int)
+    if not math.isfinite(timeout) or timeout < 0:
+        return jsonify({'status': 'error', 'error': "'timeout' must be a non-negative number"}), 400
+    predicates = parse_predicates(request.args.items(multi=True))
+
+    snapshot = store.wait_for(lambda snapshot: snapshot.version > since and
+                              predicates_match(snapshot.state, predicates),
+                              min(timeout, WAIT_TIMEOUT_MAX))
+    matched = snapshot is not None
+    if not matched:
+        snapshot = store.snapshot
+    response = jsonify({'matched': matched, 'version': snapshot.version, 'state': snapshot.state})
+    response.set_etag(state_etag(snapshot.version))
+    return response
 
 @app.route('/state', methods=['POST'])
 def update_state():
     """Update avatar state"""
-    global avatar_state
-    
     data = request.get_json()
-    print(f"[DEBUG] Received state update: {data}")  # Debug log
+    request_log.debug("Received state update: %s", data, extra={'fields': data})
     
     if data:
-        # Handle animation clearing explicitly
-        if 'animation' in data and data['animation'] is None:
-            avatar_state['animation'] = None
-            print("Animation cleared")
-        
-        avatar_state.update(data)
-        
-        # Log state changes
-        if 'pose' in data:
-            print(f"Avatar pose changed to: {data['pose']}")
-        if 'visible' in data:
-            print(f"Avatar visibility: {data['visible']}")
-        if 'position' in data:
-            print(f"Avatar moved to: {data['position']}")
-        if 'animation' in data and data['animation'] is not None:
-            print(f"Animation updated: {data['animation']}")
+        try:
+            with store.transaction() as state:
+                apply_update(state, data)
+        except StateError as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
+        log_update(data)
     
     return jsonify({'status': 'ok'})
 
@@ -64,89 +165,200 @@ def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'running'})
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Apply several operations atomically with a single version bump
+
+    Body: {"operations": [{"op": "set", "pose": "idle"}, {"op": "hide_gif"}, ...]}
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations') if isinstance(data, dict) else data
+    try:
+        snapshot = store.apply(apply_batch, operations)
+    except BatchError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
+    
+    log_batch(operations)
+    
+    response = jsonify({'status': 'ok', 'version': snapshot.version, 'state': snapshot.state})
+    response.set_etag(state_etag(snapshot.version))
+    return response
+
 @app.route('/play_animation', methods=['POST'])
 def play_animation():
-    """Play an animation with clean logging"""
-    global avatar_state
-    
+    """Play an animation with clean logging
+
+    Plays immediately unless the body sets a queue 'policy' / 'priority'.
+    """
     data = request.get_json()
     if data:
-        # Store animation data with current time
-        avatar_state['animation'] = {
-            'id': data.get('id'),
-            'name': data.get('name'),
-            'sequence': data.get('frames', []),
-            'frames': data.get('frames', []),  # Include both for compatibility
-            'fps': data.get('fps', 2),  # Keep for backwards compatibility
-            'duration_per_pose': data.get('duration_per_pose', 2.0),  # New: seconds per pose
-            'loop': data.get('loop', False),
-            'current_frame': 0,
-            'start_time': time.time()
-        }
-        
-        # Make avatar visible when animation starts
-        avatar_state['visible'] = True
+        try:
+            store.apply(play_animation_command, data)
+        except QueueError as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
         
         # Clean log - just the animation name
-        print(f"Playing animation: {data.get('name', data.get('id'))}")
+        animation_log.info("Playing animation: %s", data.get('name', data.get('id')))
     
     return jsonify({'status': 'ok'})
 
 @app.route('/animate', methods=['DELETE'])
 def stop_animation():
     """Stop current animation"""
-    global avatar_state
+    with store.transaction() as state:
+        apply_stop_animation(state)
     
-    avatar_state['animation'] = None
-    avatar_state['pose'] = 'idle'  # Return to idle
-    
-    print("Animation stopped")
+    animation_log.info("Animation stopped")
     
     return jsonify({'status': 'ok'})
 
 @app.route('/show_gif', methods=['POST'])
 def show_gif():
-    """Show a GIF in the avatar window"""
-    global avatar_state
-    
+    """Show a GIF in the avatar window
+
+    Shows immediately unless the body sets a queue 'policy' / 'priority'.
+    """
     data = request.get_json()
     if data and 'url' in data:
-        # Store GIF data
-        avatar_state['gif'] = {
-            'url': data.get('url'),
-            'duration': data.get('duration', 5),  # Default 5 seconds
-            'start_time': time.time()
-        }
-        
-        # Hide the current avatar sprite
-        avatar_state['animation'] = None
-        avatar_state['pose'] = None
-        avatar_state['visible'] = True
+        try:
+            store.apply(show_gif_command, data)
+        except QueueError as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
         
-        print(f"Showing GIF: {data.get('url')}")
+        gif_log.info("Showing GIF: %s", data.get('url'))
     
     return jsonify({'status': 'ok'})
 
 @app.route('/hide_gif', methods=['POST'])
 def hide_gif():
     """Hide the GIF and restore avatar"""
-    global avatar_state
+    with store.transaction() as state:
+        apply_hide_gif(state)
+    
+    gif_log.info("GIF hidden, avatar restored")
+    
+    return jsonify({'status': 'ok'})
+
+@app.route('/queue', methods=['GET'])
+def get_queue():
+    """What is playing and the commands waiting after it"""
+    snapshot = store.snapshot
+    response = jsonify(queue_view(snapshot))
+    response.set_etag(state_etag(snapshot.version))
+    return response
+
+@app.route('/queue', methods=['POST'])
+def enqueue():
+    """Queue an animation or GIF
+
+    Body: {"type": "animation" | "gif", "policy": "append" | "replace" | "interrupt",
+           "priority": "low" | "normal" | "high", ...play_animation / show_gif fields}
+    """
+    data = request.get_json(silent=True)
+    try:
+        snapshot = store.apply(apply_enqueue, data)
+    except QueueError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
     
-    avatar_state['gif'] = None
-    avatar_state['pose'] = 'idle'
+    log_enqueue(data)
+    
+    return jsonify(dict(queue_view(snapshot), status='ok'))
+
+@app.route('/queue', methods=['DELETE'])
+def clear_queue():
+    """Drop every queued command"""
+    with store.transaction() as state:
+        apply_clear_queue(state)
     
-    print("GIF hidden, avatar restored")
+    queue_log.info("Queue cleared")
     
     return jsonify({'status': 'ok'})
 
+@app.route('/admin/logging', methods=['GET'])
+def get_logging():
+    """Current log level, category rates, JSONL log and queue depth"""
+    return jsonify(event_log.settings())
+
+@app.route('/admin/logging', methods=['POST'])
+def configure_logging():
+    """Change logging at runtime
+
+    Body (all optional): {"level": "debug", "rates": {"position": 0}, "jsonl": true}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        settings = event_log.configure(data.get('level'), data.get('rates'), data.get('jsonl'))
+    except (ValueError, AttributeError) as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
+    return jsonify(dict(settings, status='ok'))
+
 if __name__ == '__main__':
-    print("Avatar State Server running on http://localhost:3338")
+    parser = argparse.ArgumentParser(description="Avatar state server")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="serve with the asyncio server (many streams, lower overhead)")
+    parser.add_argument('--log-level', default='info', choices=[level.lower() for level in state_log.LEVELS],
+                        help="debug also logs every received update")
+    parser.add_argument('--log-jsonl', action='store_true',
+                        help=f"also write events to {state_log.JSONL_PATH} (rotated)")
+    parser.add_argument('--shared-memory', action='store_true',
+                        help="also publish the state to shared memory for a display on this machine")
+    parser.add_argument('--unix-socket', action='store_true',
+                        help=f"also serve the same API on {local_socket.SOCKET_PATH} for local clients")
+    parser.add_argument('--persist', nargs='?', const='interval', choices=state_journal.DURABILITY,
+                        help="keep visibility, pose and position across restarts in journal/ "
+                             "(durability: fast, interval (default) or strict)")
+    args = parser.parse_args()
+    
+    event_log.configure(level=args.log_level)
+    event_log.start(jsonl=args.log_jsonl)
+    
+    print("Avatar State Server running on http://localhost:3338" + (" (asyncio)" if args.use_async else ""))
     print("Endpoints:")
-    print("  GET  /state - Get current state")
+    print("  GET  /state - Get current state (ETag / If-None-Match, ?since=<version>)")
+    print("  GET  /state/stream - Stream state changes (Server-Sent Events)")
     print("  POST /state - Update state")
+    print("  GET  /events - State changes since a sequence number (?since=<seq>)")
+    print("  GET  /wait - Wait until the state matches (?field=value&timeout=<s>)")
     print("  GET  /health - Health check")
+    print("  GET  /metrics - Request, mutation and stream metrics (Prometheus text format)")
+    print("  POST /batch - Apply several operations atomically")
     print("  POST /play_animation - Play animation")
     print("  DELETE /animate - Stop animation")
     print("  POST /show_gif - Show a GIF")
     print("  POST /hide_gif - Hide GIF and restore avatar")
-    app.run(host='0.0.0.0', port=3338, debug=False)
+    print("  GET  /queue - Current item and queued animations / GIFs")
+    print("  POST /queue - Queue an animation or GIF (policy, priority)")
+    print("  DELETE /queue - Clear the queue")
+    print("  GET/POST /admin/logging - Show or change logging (level, rates, jsonl)")
+    print("GIFs and non-looping animations expire on the server")
+    if args.persist:
+        started = time.perf_counter()
+        journal = state_journal.StateJournal(durability=args.persist)
+        restored = journal.attach(store)
+        atexit.register(journal.close)
+        print(f"Persisting state to {journal.directory} ({args.persist})" +
+              (f" - restored {', '.join(restored)} in {(time.perf_counter() - started) * 1000:.1f} ms" if restored else ""))
+    ExpiryScheduler(store).start()
+    if args.shared_memory:
+        publisher = store.subscribe(SharedStatePublisher(state_etag))
+        atexit.register(lambda: (store.unsubscribe(publisher), publisher.close()))
+        print(f"Publishing state to shared memory segment {SEGMENT_NAME}")
+    unix_path = None
+    if args.unix_socket:
+        if not local_socket.supported():
+            print("Unix domain sockets are not available here - serving TCP only")
+        elif not local_socket.claim():
+            print(f"Another server is listening on {local_socket.SOCKET_PATH} - serving TCP only")
+        else:
+            unix_path = local_socket.SOCKET_PATH
+            atexit.register(local_socket.release)
+            print(f"Also listening on {unix_path}")
+    if args.use_async:
+        import async_state_server
+        async_state_server.run(store, host='0.0.0.0', port=3338, unix_path=unix_path)
+    else:
+        if unix_path:
+            unix_server = make_server(f'unix://{unix_path}', 0, app, threaded=True)
+            os.chmod(unix_path, 0o600)  # Same user only - the socket skips the network entirely
+            threading.Thread(target=unix_server.serve_forever, daemon=True).start()
+        app.run(host='0.0.0.0', port=3338, debug=False, threaded=True)
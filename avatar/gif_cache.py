@@ -0,0 +1,134 @@
+# gif_cache.py
+"""
+GIF cache for the avatar display
+Bounded in-memory LRU on top of a content-addressed folder on disk,
+so repeated reactions start without any network or temp-file I/O
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from avatar_config import avatar_path
+
+class GifCache:
+    """GIF bytes by URL: memory first, then disk (files named by SHA-256)"""
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory, memory_limit, disk_limit):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()  # content hash -> bytes
+        self.memory_bytes = 0
+        self.urls = {}  # url -> content hash, persisted in index.json
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, self.INDEX_FILE), 'r', encoding='utf-8') as f:
+                self.urls = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def from_config(cls, config):
+        section = config['gif_cache']
+        return cls(avatar_path(section.get('directory')),
+                   int(section.getfloat('memory_mb') * 1024 * 1024),
+                   int(section.getfloat('disk_mb') * 1024 * 1024))
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, f"{digest}.gif")
+
+    def get(self, url):
+        """Cached GIF bytes for a URL, or None"""
+        digest = self.urls.get(url)
+        if digest is None:
+            self.misses += 1
+            return None
+
+        data = self.memory.get(digest)
+        if data is not None:
+            self.memory.move_to_end(digest)
+            self.hits += 1
+            return data
+
+        path = self.blob_path(digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Most recently used survives disk eviction
+        except OSError:
+            data = None
+        if data is None or hashlib.sha256(data).hexdigest() != digest:
+            # Evicted or damaged on disk - forget it
+            del self.urls[url]
+            self.misses += 1
+            return None
+
+        self.remember(digest, data)
+        self.hits += 1
+        return data
+
+    def put(self, url, data):
+        """Store downloaded GIF bytes for a URL"""
+        data = bytes(data)
+        digest = hashlib.sha256(data).hexdigest()
+        self.urls[url] = digest
+        self.remember(digest, data)
+
+        try:
+            path = self.blob_path(digest)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            self.evict_disk()
+            self.save_index()
+        except OSError as e:
+            print(f"GIF cache not written: {e}")
+
+    def remember(self, digest, data):
+        """Keep bytes in memory, evicting least recently used beyond the limit"""
+        if len(data) > self.memory_limit:
+            return
+        if digest not in self.memory:
+            self.memory[digest] = data
+            self.memory_bytes += len(data)
+        self.memory.move_to_end(digest)
+        while self.memory_bytes > self.memory_limit:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def evict_disk(self):
+        """Delete least recently used files until the folder fits the disk limit"""
+        blobs = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.gif'):
+                stat = os.stat(os.path.join(self.directory, filename))
+                blobs.append((stat.st_mtime, stat.st_size, filename[:-4]))
+        total = sum(size for _, size, _ in blobs)
+        removed = set()
+        for _, size, digest in sorted(blobs):
+            if total <= self.disk_limit:
+                break
+            os.remove(self.blob_path(digest))
+            total -= size
+            removed.add(digest)
+        if removed:
+            self.urls = {url: digest for url, digest in self.urls.items() if digest not in removed}
+
+    def save_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.urls, f)
+        os.replace(f"{path}.tmp", path)
+
+    def stats(self):
+        """One-line summary of the cache counters"""
+        return (f"GIF cache: {self.hits} hits, {self.misses} misses, "
+                f"{self.memory_bytes // 1024} KB in memory, {len(self.urls)} URLs on disk")
@@ -0,0 +1,185 @@
+# gif_player.py
+"""
+GIF playback for the avatar display
+Frames are decoded ahead on a worker thread, downscaled to the window and kept
+in a ring buffer sized from a memory budget. Small GIFs are decoded once and
+looped from memory; large ones stream through the buffer.
+"""
+
+import threading
+import time
+from collections import deque
+from PyQt5.QtCore import QBuffer, QByteArray, QObject, QSize, QTimer, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QPixmap
+
+# GIFs with a 0-10 ms frame delay play at 10 fps, like browsers do
+DEFAULT_FRAME_DELAY = 100
+# A frame shown more than this many ms after its deadline counts as late
+LATE_THRESHOLD_MS = 15
+
+class GifPlayer(QObject):
+    """Plays GIF bytes as a sequence of pre-decoded, pre-scaled pixmaps"""
+    frame_changed = pyqtSignal(QPixmap)
+    # Emitted from the decoder thread once the GIF has been opened
+    opened = pyqtSignal(int, int, bool)  # frame count (0 if unknown), buffer capacity, all frames kept
+
+    def __init__(self, data, max_size, memory_budget, parent=None):
+        super().__init__(parent)
+        self.data = bytes(data)
+        self.max_size = QSize(max_size)
+        self.memory_budget = memory_budget
+
+        self.frames = deque()  # (QImage, delay ms) waiting to be shown
+        self.all_frames = []  # Every frame, when the whole GIF fits the budget
+        self.capacity = 2
+        self.keep_all = False
+        self.all_decoded = False
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.decoder = None
+
+        self.position = 0  # Next index into all_frames
+        self.deadline = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.advance)
+
+        # Frame timing metrics
+        self.frames_shown = 0
+        self.late_frames = 0
+        self.underruns = 0
+        self.decoded_frames = 0
+        self.decode_ms_total = 0.0
+        self.decode_ms_max = 0.0
+
+    def start(self):
+        """Start decoding and show the first frame as soon as it is ready"""
+        self.decoder = threading.Thread(target=self.decode_loop, daemon=True)
+        self.decoder.start()
+        self.timer.start(0)
+
+    def stop(self):
+        """Stop playback and the decoder thread"""
+        self.timer.stop()
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def open_reader(self):
+        buffer = QBuffer()
+        buffer.setData(QByteArray(self.data))
+        buffer.open(QBuffer.ReadOnly)
+        reader = QImageReader(buffer, QByteArray(b'gif'))
+        return buffer, reader
+
+    def target_size(self, size):
+        """Frame size scaled down (never up) to fit the window"""
+        if size.width() <= self.max_size.width() and size.height() <= self.max_size.height():
+            return size
+        return size.scaled(self.max_size, Qt.KeepAspectRatio)
+
+    def decode_loop(self):
+        """Decoder thread: keep the ring buffer full until stopped"""
+        buffer, reader = self.open_reader()
+        frame_count = reader.imageCount()
+        size = self.target_size(reader.size())
+        frame_bytes = max(1, size.width() * size.height() * 4)
+        self.capacity = max(2, self.memory_budget // frame_bytes)
+        self.keep_all = 0 < frame_count <= self.capacity
+        try:
+            if not self.stopped.is_set():
+                self.opened.emit(frame_count, self.capacity, self.keep_all)
+        except RuntimeError:
+            return  # Player was deleted before the GIF opened
+
+        index = 0
+        while not self.stopped.is_set():
+            with self.condition:
+                while len(self.frames) >= self.capacity and not self.stopped.is_set():
+                    self.condition.wait()
+            if self.stopped.is_set():
+                break
+
+            started = time.perf_counter()
+            image = reader.read()
+            if image.isNull():
+                if index == 0:
+                    print(f"GIF could not be decoded: {reader.errorString()}")
+                    break
+                if self.keep_all:
+                    self.all_decoded = True
+                    break  # Looping continues from memory
+                buffer, reader = self.open_reader()  # Loop: decode from the top
+                continue
+            delay = reader.nextImageDelay()
+            if image.size() != size:
+                image = image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            decode_ms = (time.perf_counter() - started) * 1000
+
+            self.decoded_frames += 1
+            self.decode_ms_total += decode_ms
+            self.decode_ms_max = max(self.decode_ms_max, decode_ms)
+            frame = (image, delay if delay > 10 else DEFAULT_FRAME_DELAY)
+            with self.condition:
+                if self.keep_all:
+                    self.all_frames.append(frame)
+                self.frames.append(frame)
+            index += 1
+
+    def next_frame(self):
+        """Next frame to show, or None if the decoder has fallen behind"""
+        with self.condition:
+            if self.frames:
+                self.position += 1
+                frame = self.frames.popleft()
+                self.condition.notify()
+                return frame
+            if self.all_decoded and self.all_frames:
+                # Whole GIF is in memory - loop without decoding again
+                frame = self.all_frames[self.position % len(self.all_frames)]
+                self.position += 1
+                return frame
+        return None
+
+    def advance(self):
+        """Show the next frame and schedule the one after it"""
+        if self.stopped.is_set():
+            return
+        frame = self.next_frame()
+        now = time.perf_counter()
+        if frame is None:
+            if self.deadline is not None:
+                self.underruns += 1
+            self.timer.start(5)  # Decoder is behind - check again shortly
+            return
+
+        if self.deadline is not None and (now - self.deadline) * 1000 > LATE_THRESHOLD_MS:
+            self.late_frames += 1
+        image, delay = frame
+        self.frame_changed.emit(QPixmap.fromImage(image))
+        self.frames_shown += 1
+        self.deadline = now + delay / 1000
+        self.timer.start(delay)
+
+    def metrics(self):
+        """Frame timing metrics for this playback"""
+        return {
+            'frames_shown': self.frames_shown,
+            'late_frames': self.late_frames,
+            'underruns': self.underruns,
+            'decoded_frames': self.decoded_frames,
+            'decode_ms_avg': self.decode_ms_total / self.decoded_frames if self.decoded_frames else 0.0,
+            'decode_ms_max': self.decode_ms_max,
+            'buffer_capacity': self.capacity,
+            'all_frames_in_memory': self.keep_all
+        }
+
+    def stats(self):
+        """One-line summary of the frame timing metrics"""
+        m = self.metrics()
+        return (f"GIF playback: {m['frames_shown']} frames shown, {m['late_frames']} late, "
+                f"{m['underruns']} underruns, decode avg {m['decode_ms_avg']:.1f} ms / "
+                f"max {m['decode_ms_max']:.1f} ms, buffer {m['buffer_capacity']} frames"
+                f"{' (all in memory)' if m['all_frames_in_memory'] else ''}")
@@ -0,0 +1,114 @@
+# local_socket.py
+"""
+Unix domain socket transport for the avatar state server
+The server can also listen on SOCKET_PATH with the same HTTP API. Python
+clients get a requests session that sends http://localhost:3338 requests
+through the socket while it exists, and over TCP otherwise - callers keep
+using the same URLs. Where the platform has no AF_UNIX (Windows builds of
+Python), everything stays on TCP.
+"""
+
+import os
+import socket
+import tempfile
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import NewConnectionError
+
+STATE_URL = 'http://localhost:3338'
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'avatar_state_3338.sock')
+
+def supported():
+    """True when this Python can use Unix domain sockets"""
+    return hasattr(socket, 'AF_UNIX')
+
+def listening(path=SOCKET_PATH):
+    """True when a server accepts connections on the socket"""
+    if not supported() or not os.path.exists(path):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+
+def claim(path=SOCKET_PATH):
+    """Free the socket path for a new server; False if a running server owns it"""
+    if listening(path):
+        return False
+    if os.path.exists(path):
+        os.unlink(path)  # Left behind by a server that did not shut down cleanly
+    return True
+
+def release(path=SOCKET_PATH):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
+
+    def __init__(self, *args, socket_path, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is None or isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise NewConnectionError(self, f"Failed to connect to {self.socket_path}: {e}") from e
+        return sock
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+class UnixSocketAdapter(HTTPAdapter):
+    """Sends requests through the socket; TCP when it is missing or refuses connections
+
+    Only failures to connect fall back, so a request is never sent twice.
+    """
+
+    def __init__(self, path=SOCKET_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.socket_path = path
+        self.pool = UnixHTTPConnectionPool('localhost', maxsize=self._pool_maxsize, socket_path=path)
+        self.tcp = HTTPAdapter()
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def send(self, request, **kwargs):
+        if os.path.exists(self.socket_path):
+            try:
+                return super().send(request, **kwargs)
+            except requests.ConnectionError as e:
+                if not isinstance(getattr(e.args[0], 'reason', None), NewConnectionError):
+                    raise
+        return self.tcp.send(request, **kwargs)
+
+    def close(self):
+        self.pool.close()
+        self.tcp.close()
+        super().close()
+
+def state_session(base_url=STATE_URL, path=None):
+    """requests session for the state server, preferring the Unix socket
+
+    SOCKET_PATH belongs to the server on STATE_URL; a session for another
+    URL only uses a socket when given its path.
+    """
+    if path is None and base_url.rstrip('/') == STATE_URL:
+        path = SOCKET_PATH
+    session = requests.Session()
+    if supported() and path:
+        session.mount(base_url.rstrip('/') + '/', UnixSocketAdapter(path))
+    return session
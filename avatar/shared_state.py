@@ -0,0 +1,120 @@
+# shared_state.py
+"""
+Shared-memory state channel between the state server and a display on the same machine
+The server publishes every snapshot into a named shared memory segment guarded
+by a seqlock; the display checks one counter per tick and only copies and
+parses the state when it moved. When the segment is missing the display keeps
+using HTTP. The seqlock relies on CPython's in-order stores (x86 / x64
+Windows and Linux); a torn copy is caught by the sequence re-check.
+
+Segment layout (little endian):
+    0   uint64  sequence - odd while the server is writing, bumped twice per publish
+    8   uint64  state version
+    16  uint32  payload length (OVERFLOW when the state did not fit)
+    24  payload: ETag line, then the state JSON
+"""
+
+import json
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+SEGMENT_NAME = 'avatar_state_3338'
+SEGMENT_SIZE = 1024 * 1024
+
+HEADER = struct.Struct('<QQI')
+SEQUENCE = struct.Struct('<Q')
+DATA_OFFSET = 24
+OVERFLOW = 0xFFFFFFFF
+
+# Torn reads retried before giving up for this tick
+READ_RETRIES = 100
+
+class SharedStatePublisher:
+    """Writes each published snapshot into the segment (a store subscriber)"""
+
+    def __init__(self, etag, name=SEGMENT_NAME, size=SEGMENT_SIZE):
+        self.etag = etag  # version -> ETag, so both transports name versions alike
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+            self.sequence = 0
+        except FileExistsError:
+            # Left by an earlier server (a display may still have it mapped) - keep counting from it
+            self.shm = shared_memory.SharedMemory(name)
+            self.sequence = SEQUENCE.unpack_from(self.shm.buf, 0)[0] + 1 & ~1
+        self.capacity = self.shm.size - DATA_OFFSET
+
+    def put(self, snapshot):
+        """Publish a snapshot; called with the store's writer lock held, so one writer at a time"""
+        payload = self.etag(snapshot.version).encode() + b'\n' + snapshot.encoded()
+        buf = self.shm.buf
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.sequence)  # Odd: readers retry
+        if len(payload) <= self.capacity:
+            buf[DATA_OFFSET:DATA_OFFSET + len(payload)] = payload
+            HEADER.pack_into(buf, 0, self.sequence, snapshot.version, len(payload))
+        else:
+            HEADER.pack_into(buf, 0, self.sequence, snapshot.version, OVERFLOW)
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.sequence)
+
+    def close(self):
+        """Remove the segment; attached displays fall back to HTTP"""
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+class SharedStateReader:
+    """Reads the latest snapshot from the segment"""
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.sequence = None  # Last sequence read
+
+    @classmethod
+    def open(cls, name=SEGMENT_NAME, track=False):
+        """Attach to the server's segment; None when it does not exist
+
+        Leave track False unless this process also created the segment (tests).
+        """
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return None
+        if os.name == 'posix' and not track:
+            # Python tracks attached segments too and would unlink the server's segment when we exit
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm)
+
+    def changed(self):
+        """True when the server published since the last read"""
+        return SEQUENCE.unpack_from(self.shm.buf, 0)[0] != self.sequence
+
+    def read(self):
+        """(etag, state) if the state changed since the last read, else None
+
+        state is None when the snapshot was too large for the segment - fetch
+        it over HTTP. Returns None too if every retry met a write in progress.
+        """
+        buf = self.shm.buf
+        for _ in range(READ_RETRIES):
+            sequence = SEQUENCE.unpack_from(buf, 0)[0]
+            if sequence == self.sequence or sequence == 0:
+                return None  # Unchanged, or nothing published yet
+            if sequence & 1:
+                continue  # Write in progress
+            _, version, length = HEADER.unpack_from(buf, 0)
+            payload = bytes(buf[DATA_OFFSET:DATA_OFFSET + length]) if length != OVERFLOW else None
+            if SEQUENCE.unpack_from(buf, 0)[0] != sequence:
+                continue  # Overwritten while copying
+            self.sequence = sequence
+            if payload is None:
+                return '', None
+            etag, _, data = payload.partition(b'\n')
+            return etag.decode(), json.loads(data)
+        return None
+
+    def close(self):
+        self.shm.close()
@@ -0,0 +1,161 @@
+# sprite_cache.py
+"""
+Sprite loading and caching for the avatar display
+Sprites decode in parallel on a thread pool, scaled pixmaps live in a bounded LRU
+"""
+
+from collections import OrderedDict
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, Qt, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QImage, QPixmap
+
+from sprite_derivatives import load_image
+
+class DecodeJob(QRunnable):
+    """Decodes one sprite PNG into a QImage off the GUI thread"""
+
+    def __init__(self, loader, name, path, target_height):
+        super().__init__()
+        self.loader = loader
+        self.name = name
+        self.path = path
+        self.target_height = target_height
+
+    def run(self):
+        image = load_image(self.path, self.target_height)
+        self.loader.decoded.emit(self.name, image)
+
+class SpriteLoader(QObject):
+    """Decodes sprite files in parallel; pixmaps are created on the GUI thread"""
+    decoded = pyqtSignal(str, QImage)
+    # Emitted on the GUI thread once a sprite is ready to use
+    loaded = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, sprites, target_height):
+        super().__init__()
+        self.sprites = sprites  # name -> QPixmap, filled in as decodes finish
+        self.target_height = target_height  # Picks the on-disk derivative level
+        self.pending = {}  # name -> path still decoding
+        self.pool = QThreadPool()
+        self.decoded.connect(self.on_decoded)
+
+    def load_now(self, name, path):
+        """Decode a sprite synchronously (first frame or on-demand)"""
+        pixmap = QPixmap.fromImage(load_image(path, self.target_height))
+        if pixmap.isNull():
+            return False
+        self.sprites[name] = pixmap
+        return True
+
+    def load_async(self, paths):
+        """Queue every sprite that is not loaded yet for background decoding"""
+        for name, path in paths.items():
+            if name in self.sprites or name in self.pending:
+                continue
+            self.pending[name] = path
+            self.pool.start(DecodeJob(self, name, path, self.target_height))
+
+    @pyqtSlot(str, QImage)
+    def on_decoded(self, name, image):
+        """Turn a decoded image into a pixmap unless it was loaded on demand meanwhile"""
+        self.pending.pop(name, None)
+        if name not in self.sprites and not image.isNull():
+            self.sprites[name] = QPixmap.fromImage(image)
+            self.loaded.emit(name)
+        if not self.pending:
+            self.finished.emit()
+
+class ScaleJob(QRunnable):
+    """Smooth-scales one sprite image off the GUI thread"""
+
+    def __init__(self, cache, pose, width, height, image):
+        super().__init__()
+        self.cache = cache
+        self.pose = pose
+        self.width = width
+        self.height = height
+        self.image = image
+
+    def run(self):
+        scaled = self.image.scaled(self.width, self.height,
+                                   Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        # Queued back to the GUI thread, where the pixmap is created
+        self.cache.warmed.emit(self.pose, self.width, self.height, scaled)
+
+class SpriteCache(QObject):
+    """Bounded LRU of scaled sprite pixmaps"""
+    warmed = pyqtSignal(str, int, int, QImage)
+
+    def __init__(self, max_entries=32):
+        super().__init__()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.pending = set()  # Keys being scaled in the background
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.warmed.connect(self.on_warmed)
+
+        # Not the global pool: Qt's smooth scaling fans out onto that one
+        # and would starve if our jobs occupied all of its threads
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(2)
+
+    def get(self, pose, width, height, source):
+        """Scaled pixmap for a pose, scaling (and caching) on a miss"""
+        key = (pose, width, height)
+        pixmap = self.entries.get(key)
+        if pixmap is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return pixmap
+
+        self.misses += 1
+        pixmap = source.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self.store(key, pixmap)
+        return pixmap
+
+    def warm(self, poses, width, height, sources):
+        """Scale the given poses in the background so later gets are hits"""
+        for pose in poses:
+            key = (pose, width, height)
+            if key in self.entries or key in self.pending or pose not in sources:
+                continue
+            self.pending.add(key)
+            job = ScaleJob(self, pose, width, height, sources[pose].toImage())
+            self.pool.start(job)
+
+    @pyqtSlot(str, int, int, QImage)
+    def on_warmed(self, pose, width, height, image):
+        """Store a background-scaled sprite unless the size has moved on"""
+        key = (pose, width, height)
+        if key not in self.pending:
+            return  # Invalidated while it was being scaled
+        self.pending.discard(key)
+        if key not in self.entries:
+            self.store(key, QPixmap.fromImage(image))
+
+    def invalidate(self, width=None, height=None):
+        """Drop cached pixmaps, keeping only those for the given size"""
+        for key in list(self.entries):
+            if key[1:] != (width, height):
+                del self.entries[key]
+        self.pending = {key for key in self.pending if key[1:] == (width, height)}
+
+    def store(self, key, pixmap):
+        self.entries[key] = pixmap
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """One-line summary of the cache counters"""
+        return (f"sprite cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate:.0%} hit rate), {self.evictions} evictions, "
+                f"{len(self.entries)}/{self.max_entries} entries")
@@ -0,0 +1,142 @@
+# sprite_derivatives.py
+"""
+Downscaled sprite derivatives (mip levels) cached on disk
+The window is only 300px tall, so decoding the 1024x1536 library PNGs on every
+launch is wasted work. Derivatives live in library/.derived and are rebuilt
+automatically when a source PNG changes.
+
+Run directly to build every derivative ahead of time:
+    python sprite_derivatives.py
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "library")
+DERIVED_DIR = ".derived"
+
+# Standard derivative heights in pixels
+LEVELS = (150, 300, 600)
+
+def pick_level(target_height):
+    """Smallest standard level that is at least target_height, or None for the original"""
+    for level in LEVELS:
+        if level >= target_height:
+            return level
+    return None
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def derived_paths(source_path):
+    """Sidecar metadata path and per-level image paths for a source sprite"""
+    folder = os.path.join(os.path.dirname(source_path), DERIVED_DIR)
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    meta_path = os.path.join(folder, f"{name}.json")
+    level_paths = {level: os.path.join(folder, f"{name}@{level}.png") for level in LEVELS}
+    return meta_path, level_paths
+
+def read_meta(meta_path):
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_atomic(path, write):
+    """Write via a temporary file so readers never see half a file
+
+    Each call gets its own temporary file: the GUI thread and a decode job
+    may build the same sprite at once.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def write_png(path, image):
+    def write(tmp_path):
+        if not image.save(tmp_path, 'PNG'):
+            raise OSError(f"could not write {path}")
+    write_atomic(path, write)
+
+def write_meta(meta_path, meta):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+    write_atomic(meta_path, write)
+
+def ensure_derivatives(source_path):
+    """Build the derivatives for a source sprite if missing or stale
+
+    Staleness is checked by mtime and size first; only when those moved is
+    the source hashed, so a touched-but-identical file is not rebuilt.
+    Returns True if anything was rebuilt.
+    """
+    meta_path, level_paths = derived_paths(source_path)
+    stat = os.stat(source_path)
+    meta = read_meta(meta_path)
+    outputs_exist = all(os.path.exists(path) for path in level_paths.values())
+
+    if meta and outputs_exist and meta.get('levels') == list(LEVELS):
+        if meta.get('mtime_ns') == stat.st_mtime_ns and meta.get('size') == stat.st_size:
+            return False
+        sha1 = file_sha1(source_path)
+        if meta.get('sha1') == sha1:
+            meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            write_meta(meta_path, meta)
+            return False
+    else:
+        sha1 = file_sha1(source_path)
+
+    image = QImage(source_path)
+    if image.isNull():
+        return False
+
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    for level, path in level_paths.items():
+        write_png(path, image.scaledToHeight(min(level, image.height()), Qt.SmoothTransformation))
+
+    # Only once every level is saved - the sidecar vouches for all of them
+    write_meta(meta_path, {'sha1': sha1, 'mtime_ns': stat.st_mtime_ns,
+                           'size': stat.st_size, 'levels': list(LEVELS)})
+    return True
+
+def load_image(source_path, target_height):
+    """Decode the nearest derivative for a target height, falling back to the original"""
+    level = pick_level(target_height)
+    if level is not None:
+        try:
+            ensure_derivatives(source_path)
+            image = QImage(derived_paths(source_path)[1][level])
+            if not image.isNull():
+                return image
+        except OSError as e:
+            print(f"Sprite derivative unavailable for {source_path}: {e}")
+    return QImage(source_path)
+
+def build_all(library_path=LIBRARY_PATH):
+    """Build derivatives for every sprite in the library"""
+    rebuilt = 0
+    for filename in sorted(os.listdir(library_path)):
+        if filename.endswith('.png'):
+            if ensure_derivatives(os.path.join(library_path, filename)):
+                print(f"Built derivatives: {filename}")
+                rebuilt += 1
+    print(f"{rebuilt} sprite(s) rebuilt, levels: {', '.join(map(str, LEVELS))}px")
+
+if __name__ == '__main__':
+    build_all()
@@ -0,0 +1,146 @@
+# state_client.py
+"""
+Non-blocking client for the avatar state server
+Requests run on a worker QThread with a keep-alive session, results come back as Qt signals
+"""
+
+import time
+import requests
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
+
+from local_socket import state_session
+from state_metrics import DISPLAY_AGENT
+
+# Exponential backoff while the state server is unreachable (seconds)
+BACKOFF_MIN = 0.25
+BACKOFF_MAX = 8.0
+
+# Identifies the display's requests in the server's /metrics
+CLIENT_HEADERS = {'User-Agent': DISPLAY_AGENT}
+
+# Drag positions are sent at most this many times per second
+POSITION_RATE = 30
+
+class NetworkWorker(QObject):
+    """Performs state server requests on the network thread"""
+    # callback, response (None if the request failed or was skipped)
+    finished = pyqtSignal(object, object)
+
+    def __init__(self, base_url, timeout):
+        super().__init__()
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = None
+        self.backoff = 0
+        self.retry_at = 0
+
+    @pyqtSlot(str, str, object, object, object)
+    def perform(self, method, path, payload, headers, callback):
+        """Run one request, skipping the network while backing off"""
+        if self.session is None:
+            # Created here so the session lives on the network thread; prefers the Unix socket
+            self.session = state_session(self.base_url)
+            self.session.headers.update(CLIENT_HEADERS)
+
+        response = None
+        if time.monotonic() >= self.retry_at:
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}",
+                                                json=payload, headers=headers,
+                                                timeout=self.timeout)
+                if self.backoff:
+                    print("State server reachable again")
+                self.backoff = 0
+            except requests.RequestException:
+                if not self.backoff:
+                    print("State server unreachable - backing off")
+                self.backoff = min(self.backoff * 2 or BACKOFF_MIN, BACKOFF_MAX)
+                self.retry_at = time.monotonic() + self.backoff
+
+        if callback:
+            self.finished.emit(callback, response)
+
+class StateClient(QObject):
+    """GUI-thread facade: fire-and-forget posts and callback-based gets"""
+    submit = pyqtSignal(str, str, object, object, object)
+
+    def __init__(self, base_url, timeout=1.0):
+        super().__init__()
+        self.thread = QThread()
+        self.worker = NetworkWorker(base_url, timeout)
+        self.worker.moveToThread(self.thread)
+        # Both connections cross threads, so Qt queues them
+        self.submit.connect(self.worker.perform)
+        self.worker.finished.connect(self.deliver)
+        self.thread.start()
+
+    def post(self, path, payload=None, callback=None):
+        """Send a POST without waiting for the answer; callback(response) is optional"""
+        self.submit.emit('POST', path, payload, None, callback)
+
+    def get(self, path, callback, headers=None):
+        """Send a GET; callback(response) runs on the GUI thread, response is None on failure"""
+        self.submit.emit('GET', path, None, headers, callback)
+
+    @pyqtSlot(object, object)
+    def deliver(self, callback, response):
+        """Hand a finished request back to its callback"""
+        callback(response)
+
+    @property
+    def backing_off(self):
+        """True while the server is considered down"""
+        return self.worker.backoff > 0
+
+    def stop(self):
+        """Stop the network thread"""
+        self.thread.quit()
+        self.thread.wait(1000)
+
+class PositionPublisher(QObject):
+    """Coalesces window positions while dragging
+
+    Only the latest position is kept. It is sent at most POSITION_RATE times
+    a second, with at most one request in flight, so a fast drag never piles
+    up requests behind the network thread.
+    """
+
+    def __init__(self, client, rate=POSITION_RATE):
+        super().__init__()
+        self.client = client
+        self.pending = None  # Latest position not yet sent
+        self.in_flight = False
+        self.sent = 0
+        self.timer = QTimer(self)
+        self.timer.setInterval(max(1, round(1000 / rate)))
+        self.timer.timeout.connect(self.flush)
+
+    def publish(self, x, y):
+        """Record a new position; the first one of a burst goes out immediately"""
+        self.pending = (x, y)
+        if not self.timer.isActive():
+            self.flush()
+            self.timer.start()
+
+    def flush(self):
+        """Send the latest position, unless the previous one is still on its way"""
+        if self.pending is None:
+            self.timer.stop()  # Idle until the next publish
+            return
+        if self.in_flight:
+            return
+        self.send(*self.pending, callback=self.on_sent)
+        self.in_flight = True
+
+    def on_sent(self, response):
+        self.in_flight = False
+
+    def finish(self, x, y):
+        """Send the final position now (on release), dropping anything older"""
+        self.timer.stop()
+        self.send(x, y)
+
+    def send(self, x, y, callback=None):
+        self.pending = None
+        self.sent += 1
+        self.client.post('/state', {'position': {'x': x, 'y': y}}, callback)
@@ -0,0 +1,56 @@
+# state_history.py
+"""
+Bounded history of state changes for GET /events?since=<seq>
+Subscribed to the store, it records one event per published version: the
+sequence number (the state version), when it was published and the fields
+it changed. Only the newest events are kept; asking for older ones reports a gap.
+"""
+
+import itertools
+import threading
+import time
+from collections import deque
+
+# Events kept in memory
+HISTORY_SIZE = 1000
+
+class EventHistory:
+    """Ring buffer of state change events, fed as a store subscriber"""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.events = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.baseline = None  # Version the history started from
+        self.seq = None  # Newest version seen
+
+    def put(self, snapshot):
+        """Store subscriber: record the fields each new version changed"""
+        with self.lock:
+            if self.baseline is None:
+                # The store queues its current snapshot on subscribe - history starts there
+                self.baseline = self.seq = snapshot.version
+                return
+            if snapshot.version <= self.seq:
+                return
+            self.seq = snapshot.version
+            patch = {field: snapshot.state.get(field)
+                     for field, changed_at in snapshot.field_versions.items()
+                     if changed_at == snapshot.version}
+            self.events.append({'seq': snapshot.version, 'time': round(time.time(), 3), 'patch': patch})
+
+    def since(self, seq):
+        """Events after seq, oldest first: (events, gap, current seq)
+
+        gap is True when events after seq are no longer held - evicted, from
+        before the history started, or a seq from before a server restart -
+        and the client should re-read the whole state.
+        """
+        with self.lock:
+            current = self.seq if self.seq is not None else 0
+            oldest = self.events[0]['seq'] if self.events else current + 1
+            if seq > current:
+                return [], True, current
+            gap = seq + 1 < oldest and seq < current
+            # Versions are consecutive, so the position of seq + 1 is known
+            start = max(seq + 1 - oldest, 0)
+            return list(itertools.islice(self.events, start, None)), gap, current
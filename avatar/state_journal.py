@@ -0,0 +1,212 @@
+# state_journal.py
+"""
+Write-behind state journal, so a restarted server keeps where the avatar was
+Subscribed to the store, it hands each snapshot to a journal thread that
+appends the persisted fields that changed as one JSON line; request threads
+never touch the file. Every COMPACT_EVERY lines the journal is folded into a
+snapshot file and started afresh. On startup the snapshot plus the journal
+after it are replayed into the store.
+
+Durability (what a crash can lose):
+    fast      lines reach the OS after every batch - survives a killed server, not a power cut
+    interval  as fast, plus fsync at most SYNC_INTERVAL after a write (default)
+    strict    fsync after every batch
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+import state_log
+from state_model import PERSISTED_FIELDS, StateError, dumps, validate_patch
+
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal')
+SNAPSHOT_FILE = 'state_snapshot.json'
+JOURNAL_FILE = 'state_journal.jsonl'
+
+DURABILITY = ('fast', 'interval', 'strict')
+
+journal_log = state_log.logger('journal')
+
+# Seconds unsynced lines may wait for fsync in 'interval' mode
+SYNC_INTERVAL = 1.0
+
+# Journal lines written before they are folded into the snapshot
+COMPACT_EVERY = 1000
+
+def read_json(path):
+    """Parsed file contents, or None when it is missing or unreadable"""
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def load(directory=JOURNAL_DIR):
+    """(generation, persisted fields) from the snapshot and the journal after it
+
+    Journal lines only count when the journal's header names the snapshot's
+    generation - an older journal is already folded into the snapshot. A
+    torn last line (a crash mid-write) ends the replay.
+    """
+    saved = read_json(os.path.join(directory, SNAPSHOT_FILE))
+    if not isinstance(saved, dict) or not isinstance(saved.get('state'), dict):
+        return 0, {}
+    generation, state = saved.get('generation', 0), dict(saved['state'])
+    try:
+        with open(os.path.join(directory, JOURNAL_FILE), 'rb') as f:
+            lines = iter(f)
+            header = json.loads(next(lines, b'{}'))
+            if header.get('generation') == generation:
+                for line in lines:
+                    state.update(json.loads(line)['p'])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return generation, state
+
+def write_file(path, data, sync):
+    """Replace path with data in one step (write a temporary file, then rename)"""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+class StateJournal(threading.Thread):
+    """Journal thread fed as a store subscriber"""
+
+    def __init__(self, directory=JOURNAL_DIR, durability='interval', compact_every=COMPACT_EVERY):
+        super().__init__(name='state-journal', daemon=True)
+        if durability not in DURABILITY:
+            raise ValueError(f"durability must be one of {', '.join(DURABILITY)}")
+        self.directory = directory
+        self.durability = durability
+        self.compact_every = compact_every
+        self.pending = queue.SimpleQueue()
+        self.store = None
+        self.file = None
+        self.generation = 0
+        self.lines = 0  # Journal lines since the last compaction
+        self.sync_due = None  # When unsynced lines must be synced ('interval')
+
+    def attach(self, store):
+        """Replay the saved fields into the store, then journal its changes
+
+        Returns the restored fields (empty when nothing usable was saved).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.generation, restored = load(self.directory)
+        try:
+            if restored:
+                store.update(validate_patch(restored))
+        except StateError:
+            restored = {}  # Saved by a build with another state model - start from the defaults
+        self.store = store
+        store.subscribe(self)
+        self.start()
+        return restored
+
+    def put(self, snapshot):
+        """Store subscriber: called under the writer lock, so only queue the snapshot"""
+        self.pending.put(snapshot)
+
+    def run(self):
+        try:
+            self.journal()
+        except OSError:
+            # Stop taking snapshots rather than queue them for a writer that is gone
+            journal_log.exception("State journal stopped - changes are no longer persisted")
+            self.store.unsubscribe(self)
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+
+    def journal(self):
+        """Write queued snapshots until close() queues None"""
+        while True:
+            try:
+                batch = [self.pending.get(timeout=self.sync_timeout())]
+            except queue.Empty:
+                self.sync(force=True)
+                continue
+            # Everything published meanwhile goes out as one line
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in batch
+            self.write([snapshot for snapshot in batch if snapshot is not None])
+            if closing:
+                if self.file is not None:
+                    self.sync(force=True)
+                    self.file.close()
+                return
+
+    def write(self, snapshots):
+        """Append one line for a batch of snapshots; compact when the journal is long"""
+        if not snapshots:
+            return
+        if self.file is None:
+            self.compact(snapshots[0])  # The store's current snapshot, queued on subscribe
+        patch = {}
+        for snapshot in snapshots:
+            for field in PERSISTED_FIELDS:
+                if snapshot.field_versions.get(field) == snapshot.version:
+                    patch[field] = snapshot.state.get(field)
+        if patch:
+            self.file.write(dumps({'v': snapshots[-1].version, 'p': patch}))
+            self.lines += 1
+        if self.lines >= self.compact_every:
+            self.compact(snapshots[-1])
+        elif patch:
+            self.sync()
+
+    def compact(self, snapshot):
+        """Write the snapshot file and start an empty journal for the next generation"""
+        self.generation += 1
+        sync = self.durability != 'fast'
+        state = {field: snapshot.state.get(field) for field in PERSISTED_FIELDS}
+        write_file(os.path.join(self.directory, SNAPSHOT_FILE),
+                   dumps({'generation': self.generation, 'version': snapshot.version, 'state': state}), sync)
+        journal_path = os.path.join(self.directory, JOURNAL_FILE)
+        write_file(journal_path, dumps({'generation': self.generation}), sync)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(journal_path, 'ab')
+        self.lines = 0
+        self.sync_due = None
+
+    def sync_timeout(self):
+        """How long the thread may wait for snapshots before unsynced lines are due"""
+        if self.sync_due is None:
+            return None
+        return max(self.sync_due - time.monotonic(), 0)
+
+    def sync(self, force=False):
+        """Hand written lines to the OS, and to the disk as durability asks"""
+        if self.file is None:
+            return
+        self.file.flush()
+        if self.durability == 'fast':
+            return
+        if force or self.durability == 'strict':
+            if force and self.sync_due is None and self.durability == 'interval':
+                return  # Nothing written since the last fsync
+            os.fsync(self.file.fileno())
+            self.sync_due = None
+        elif self.sync_due is None:
+            self.sync_due = time.monotonic() + SYNC_INTERVAL
+
+    def close(self):
+        """Stop journaling: write what is queued, sync and close the file"""
+        if self.is_alive():
+            self.store.unsubscribe(self)
+            self.pending.put(None)
+            self.join()
@@ -0,0 +1,208 @@
+# state_log.py
+"""
+Queued, levelled logging for the state server
+Request threads only put records on a queue; one writer thread formats them
+and writes the console and the optional rotating JSONL event log. Busy
+categories (position updates during a drag) are rate limited, and the number
+of records dropped is reported on the next one that gets through.
+
+Log through category loggers: state_log.logger('position').info('Moved to %s', pos)
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOGGER = 'avatar_state'
+
+# Records per second each category may write (0 = unlimited); warnings and errors always pass
+DEFAULT_RATES = {'position': 2}
+
+# Records waiting for the writer thread; beyond this new records are dropped, not waited on
+QUEUE_SIZE = 10000
+
+# Rotating JSONL event log
+JSONL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'state_events.jsonl')
+JSONL_MAX_BYTES = 5 * 1024 * 1024
+JSONL_BACKUPS = 3
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+def logger(category):
+    """Logger for one category (position, pose, queue, ...)"""
+    return logging.getLogger(LOGGER).getChild(category)
+
+def category_of(record):
+    return record.name[len(LOGGER) + 1:] or 'server'
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most rate records per second through for each category"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self.windows = {}  # category -> [window start, passed, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        category = category_of(record)
+        rate = self.rates.get(category, 0)
+        if not rate or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(category, [now, 0, 0])
+            if now - window[0] >= 1:
+                if window[2]:
+                    record.suppressed = window[2]
+                window[:] = [now, 0, 0]
+            if window[1] >= rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """Enqueues records without formatting them or ever blocking the caller"""
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Records stay in this process, so formatting is left to the writer thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{self.formatTime(record, '%H:%M:%S')} {record.levelname:<7} [{category_of(record)}] {record.getMessage()}"
+        if getattr(record, 'suppressed', 0):
+            line += f" (+{record.suppressed} suppressed)"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+class JsonlFormatter(logging.Formatter):
+    """One JSON object per line: time, level, category, message and the record's fields"""
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'category': category_of(record),
+            'message': record.getMessage()
+        }
+        if getattr(record, 'fields', None):
+            entry['fields'] = record.fields
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        return json.dumps(entry, default=str)
+
+class EventLog:
+    """Owns the queue, the writer thread and the runtime settings"""
+
+    def __init__(self, level='INFO', rates=DEFAULT_RATES, jsonl_path=JSONL_PATH, stream=None):
+        self.records = queue.Queue(QUEUE_SIZE)
+        self.handler = QueuedHandler(self.records)
+        self.limiter = RateLimitFilter(rates)
+        self.handler.addFilter(self.limiter)
+        self.console = logging.StreamHandler(stream or sys.stdout)
+        self.console.setFormatter(ConsoleFormatter())
+        self.jsonl_path = jsonl_path
+        self.jsonl = None
+        self.listener = None
+        self.lock = threading.Lock()
+        self.level = self.check_level(level)
+
+    @staticmethod
+    def check_level(level):
+        level = str(level).upper()
+        if level not in LEVELS:
+            raise ValueError(f"level must be one of {', '.join(LEVELS).lower()}")
+        return level
+
+    def start(self, jsonl=False):
+        """Route the avatar_state loggers through the queue and start the writer thread"""
+        root = logging.getLogger(LOGGER)
+        root.setLevel(self.level)
+        root.propagate = False
+        root.addHandler(self.handler)
+        with self.lock:
+            self.set_jsonl(jsonl)
+            self.start_listener()
+        return self
+
+    def stop(self):
+        """Write out everything queued, then detach"""
+        logging.getLogger(LOGGER).removeHandler(self.handler)
+        with self.lock:
+            self.stop_listener()
+            self.set_jsonl(False)
+
+    def start_listener(self):
+        handlers = (self.console,) + ((self.jsonl,) if self.jsonl else ())
+        self.listener = logging.handlers.QueueListener(self.records, *handlers)
+        self.listener.start()
+
+    def stop_listener(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+    def set_jsonl(self, enabled):
+        if enabled and not self.jsonl:
+            os.makedirs(os.path.dirname(self.jsonl_path) or '.', exist_ok=True)
+            self.jsonl = logging.handlers.RotatingFileHandler(
+                self.jsonl_path, maxBytes=JSONL_MAX_BYTES, backupCount=JSONL_BACKUPS, encoding='utf-8')
+            self.jsonl.setFormatter(JsonlFormatter())
+        elif not enabled and self.jsonl:
+            self.jsonl.close()
+            self.jsonl = None
+
+    def configure(self, level=None, rates=None, jsonl=None):
+        """Change settings while running; raises ValueError and changes nothing if one is invalid"""
+        if level is not None:
+            level = self.check_level(level)
+        if rates is not None:
+            if not isinstance(rates, dict) or not all(
+                    isinstance(rate, (int, float)) and not isinstance(rate, bool) and rate >= 0
+                    for rate in rates.values()):
+                raise ValueError("rates must map categories to records per second (0 = unlimited)")
+        if jsonl is not None and not isinstance(jsonl, bool):
+            raise ValueError("jsonl must be true or false")
+
+        if level is not None:
+            self.level = level
+            logging.getLogger(LOGGER).setLevel(level)
+        if rates is not None:
+            with self.limiter.lock:
+                self.limiter.rates.update(rates)
+        if jsonl is not None:
+            with self.lock:
+                # Swapping handlers needs the writer stopped; it drains the queue first
+                running = self.listener is not None
+                self.stop_listener()
+                self.set_jsonl(jsonl)
+                if running:
+                    self.start_listener()
+        return self.settings()
+
+    def settings(self):
+        return {
+            'level': self.level.lower(),
+            'rates': dict(self.limiter.rates),
+            'jsonl': self.jsonl_path if self.jsonl else None,
+            'queued': self.records.qsize(),
+            'dropped': self.handler.dropped
+        }
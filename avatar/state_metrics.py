@@ -0,0 +1,137 @@
+# state_metrics.py
+"""
+In-process metrics for the state server, served as Prometheus text on GET /metrics
+Plain counters behind one lock - recording a request costs a bisect and a few
+increments. Both server modes record into the same Metrics object.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+# Request latency histogram bucket bounds (seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# User-Agent the avatar display sends, so its polls can be told apart
+DISPLAY_AGENT = 'avatar-display'
+
+class Histogram:
+    """Fixed-bucket histogram; counts are per bucket, made cumulative when rendered"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            yield bound, total
+
+def label_text(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+def number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metrics:
+    """Request, mutation, stream and display counters for one state server
+
+    Subscribe it to the store (store.subscribe(metrics)) to count mutations by field.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = {}  # (route, method, status) -> count
+        self.latency = {}  # (route, method) -> Histogram
+        self.mutations = {}  # field -> count
+        self.streams = {}  # client -> open streams
+        self.display_polled = None  # monotonic time the display last got state
+
+    def observe_request(self, route, method, status, seconds):
+        with self.lock:
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((route, method))
+            if histogram is None:
+                histogram = self.latency[(route, method)] = Histogram()
+            histogram.observe(seconds)
+
+    def put(self, snapshot):
+        """Store subscriber: count the fields changed in each published version"""
+        changed = [field for field, version in snapshot.field_versions.items() if version == snapshot.version]
+        with self.lock:
+            for field in changed:
+                self.mutations[field] = self.mutations.get(field, 0) + 1
+
+    @staticmethod
+    def client(user_agent):
+        return 'display' if (user_agent or '').startswith(DISPLAY_AGENT) else 'other'
+
+    def stream_opened(self, client):
+        with self.lock:
+            self.streams[client] = self.streams.get(client, 0) + 1
+
+    def stream_closed(self, client):
+        with self.lock:
+            self.streams[client] -= 1
+
+    def state_delivered(self, client):
+        """The display polled GET /state or received a stream event"""
+        if client == 'display':
+            self.display_polled = time.monotonic()
+
+    def render(self, version):
+        """Everything in Prometheus text exposition format"""
+        now = time.monotonic()
+        with self.lock:
+            requests = sorted(self.requests.items())
+            latency = sorted((key, list(histogram.cumulative()), histogram.sum)
+                             for key, histogram in self.latency.items())
+            mutations = sorted(self.mutations.items())
+            streams = dict(self.streams)
+        streams.setdefault('display', 0)
+        streams.setdefault('other', 0)
+        poll_age = now - self.display_polled if self.display_polled is not None else math.nan
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                labels = f"{{{label_text(labels)}}}" if labels else ''
+                lines.append(f"{name}{suffix}{labels} {number(value)}")
+
+        metric('avatar_http_requests_total', 'counter', "Requests handled, by route, method and status",
+               [('', (('route', route), ('method', method), ('status', status)), count)
+                for (route, method, status), count in requests])
+        samples = []
+        for (route, method), buckets, total in latency:
+            labels = (('route', route), ('method', method))
+            samples += [('_bucket', labels + (('le', number(float(bound))),), count) for bound, count in buckets]
+            samples += [('_sum', labels, total), ('_count', labels, buckets[-1][1])]
+        metric('avatar_http_request_duration_seconds', 'histogram',
+               "Time to handle a request (streams: time to the response headers)", samples)
+        metric('avatar_state_mutations_total', 'counter', "State versions that changed each field",
+               [('', (('field', field),), count) for field, count in mutations])
+        metric('avatar_state_version', 'gauge', "Current state version", [('', (), version)])
+        metric('avatar_stream_subscribers', 'gauge', "Open /state/stream connections",
+               [('', (('client', client),), count) for client, count in sorted(streams.items())])
+        metric('avatar_display_poll_age_seconds', 'gauge',
+               "Seconds since the display last got state (GET /state poll or stream event); NaN if never",
+               [('', (), round(poll_age, 3))])
+        metric('avatar_uptime_seconds', 'gauge', "Seconds since the server started",
+               [('', (), round(now - self.started, 3))])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,102 @@
+# state_model.py
+"""
+Typed avatar state model
+Declares the state fields, validates patches before they reach the store,
+and encodes state to JSON (orjson when installed, json otherwise)
+"""
+
+import json
+import math
+from dataclasses import asdict, dataclass, field, fields
+from typing import Optional, Union, get_args, get_origin
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+@dataclass
+class Position:
+    x: int = 1000  # Screen pixels; patches with fractions are rounded
+    y: int = 100
+
+@dataclass
+class AvatarState:
+    """Every field of the avatar state, with its initial value"""
+    visible: bool = True
+    pose: Optional[str] = 'idle'
+    position: Position = field(default_factory=Position)
+    last_update: Optional[float] = None
+    animation: Optional[dict] = None  # Built by play_animation
+    gif: Optional[dict] = None  # Built by show_gif
+    queue: list = field(default_factory=list)  # Managed through /queue
+
+    def to_dict(self):
+        return asdict(self)
+
+def json_types(annotation):
+    """Types a JSON value may have for a field annotation (a nested dataclass arrives as a dict)"""
+    types = get_args(annotation) if get_origin(annotation) is Union else (annotation,)
+    accepted = []
+    for t in types:
+        if t is Position:
+            accepted.append(dict)
+        elif t is float:
+            accepted.extend((int, float))
+        else:
+            accepted.append(t)
+    return tuple(accepted)
+
+# Fields only the server writes
+READ_ONLY_FIELDS = frozenset({'queue'})
+
+# Types a patch (POST /state, batch 'set') may give each writable field
+PATCH_TYPES = {f.name: json_types(f.type) for f in fields(AvatarState) if f.name not in READ_ONLY_FIELDS}
+FIELDS = frozenset(f.name for f in fields(AvatarState))
+
+# Fields state_journal.py keeps across restarts; animations, GIFs and the queue are playback in progress
+PERSISTED_FIELDS = ('visible', 'pose', 'position')
+POSITION_FIELDS = frozenset(f.name for f in fields(Position))
+
+class StateError(ValueError):
+    """A patch does not fit the state model - nothing is applied"""
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate_patch(patch):
+    """Check a patch against the model; raises StateError naming the first problem
+
+    Returns the patch, with position x and y rounded to whole pixels.
+    """
+    if not isinstance(patch, dict):
+        raise StateError("state patch must be an object")
+    unknown = patch.keys() - PATCH_TYPES.keys()
+    if unknown:
+        kind = 'read-only' if unknown <= FIELDS else 'unknown'
+        raise StateError(f"{kind} field(s): {', '.join(sorted(map(str, unknown)))}")
+
+    for name, value in patch.items():
+        types = PATCH_TYPES[name]
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            expected = ' or '.join('null' if t is type(None) else t.__name__ for t in types)
+            raise StateError(f"'{name}' must be {expected}")
+
+    position = patch.get('position')
+    if position is not None:
+        if position.keys() - POSITION_FIELDS:
+            raise StateError("'position' only has x and y")
+        if not all(is_number(value) and math.isfinite(value) for value in position.values()):
+            raise StateError("'position' x and y must be numbers")
+        if not all(isinstance(value, int) for value in position.values()):
+            patch = dict(patch, position={axis: round(value) for axis, value in position.items()})
+    return patch
+
+if orjson is not None:
+    def dumps(value):
+        """Compact, key-sorted JSON bytes with a trailing newline (like Flask's jsonify)"""
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE)
+else:
+    def dumps(value):
+        """Compact, key-sorted JSON bytes with a trailing newline (like Flask's jsonify)"""
+        return (json.dumps(value, sort_keys=True, separators=(',', ':')) + '\n').encode()
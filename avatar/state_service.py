@@ -0,0 +1,400 @@
+# state_service.py
+"""
+The avatar state service without an HTTP framework
+Holds the store and everything the endpoints do to it - state operations,
+the command queue, /batch, expiry, /wait predicates, logging, metrics and
+history - so the Flask app, the asyncio server and a display running the
+service in-process (embedded mode) all share one implementation.
+"""
+
+import json
+import queue
+import threading
+import time
+
+import state_log
+from state_history import EventHistory
+from state_metrics import Metrics
+from state_model import AvatarState, StateError, is_number, validate_patch
+from state_store import StateStore
+
+# Queued, levelled logging; started by the process hosting the service, switchable through /admin/logging
+event_log = state_log.EventLog()
+request_log = state_log.logger('request')
+position_log = state_log.logger('position')
+pose_log = state_log.logger('pose')
+visible_log = state_log.logger('visible')
+animation_log = state_log.logger('animation')
+gif_log = state_log.logger('gif')
+queue_log = state_log.logger('queue')
+batch_log = state_log.logger('batch')
+expiry_log = state_log.logger('expiry')
+
+# Global state - writers go through store.transaction(), readers use store.snapshot
+store = StateStore(AvatarState().to_dict())  # Fields and types are declared in state_model.py
+
+# Request, mutation and stream counters served on GET /metrics
+metrics = Metrics()
+store.subscribe(metrics)
+
+# Recent state changes for GET /events?since=<seq>
+history = EventHistory()
+store.subscribe(history)
+
+# Distinguishes versions across server restarts in ETags
+BOOT_ID = format(int(time.time() * 1000), 'x')
+
+# Send a comment line this often so dead stream clients get detected
+STREAM_KEEPALIVE = 15
+
+# GET /wait timeout in seconds: default and upper limit
+WAIT_TIMEOUT = 30
+WAIT_TIMEOUT_MAX = 300
+
+def state_etag(version):
+    """ETag for a state version"""
+    return f"{BOOT_ID}-{version}"
+
+# State operations - each mutates a draft inside store.transaction()
+
+# Timing fields of each command; the expiry thread does arithmetic with them
+TIMING_FIELDS = {'animation': ('fps', 'duration_per_pose'), 'gif': ('duration',)}
+
+def timing(data, key, default):
+    """data[key] as a positive number, default when absent or null (raises StateError otherwise)"""
+    value = data.get(key)
+    if value is None:
+        return default
+    if not is_number(value) or value <= 0:
+        raise StateError(f"'{key}' must be a positive number")
+    return value
+
+def apply_update(state, data):
+    """Merge posted fields into the state (raises StateError for fields the model lacks)"""
+    patch = validate_patch(data)
+    if 'position' in patch:
+        # x or y alone moves along one axis
+        patch = dict(patch, position=dict(state.get('position') or {}, **patch['position']))
+    state.update(patch)
+
+def apply_play_animation(state, data):
+    """Start an animation and make the avatar visible"""
+    # Store animation data with current time
+    state['animation'] = {
+        'id': data.get('id'),
+        'name': data.get('name'),
+        'sequence': data.get('frames', []),
+        'frames': data.get('frames', []),  # Include both for compatibility
+        'fps': timing(data, 'fps', 2),  # Keep for backwards compatibility
+        'duration_per_pose': timing(data, 'duration_per_pose', 2.0),  # New: seconds per pose
+        'loop': data.get('loop', False),
+        'current_frame': 0,
+        'start_time': time.time()
+    }
+    
+    # Make avatar visible when animation starts
+    state['visible'] = True
+
+def apply_stop_animation(state, data=None):
+    """Stop the current animation and return to idle"""
+    state['animation'] = None
+    state['pose'] = 'idle'
+
+def apply_show_gif(state, data):
+    """Replace the avatar sprite with a GIF"""
+    state['gif'] = {
+        'url': data.get('url'),
+        'duration': timing(data, 'duration', 5),  # Default 5 seconds
+        'start_time': time.time()
+    }
+    
+    # Hide the current avatar sprite
+    state['animation'] = None
+    state['pose'] = None
+    state['visible'] = True
+
+def apply_hide_gif(state, data=None):
+    """Remove the GIF and restore the avatar"""
+    state['gif'] = None
+    state['pose'] = 'idle'
+
+# Command queue - animations and GIFs take turns instead of overwriting each other
+
+PRIORITIES = {'low': 0, 'normal': 1, 'high': 2}
+QUEUE_POLICIES = ('interrupt', 'append', 'replace')
+QUEUE_COMMANDS = {'animation': apply_play_animation, 'gif': apply_show_gif}
+
+class QueueError(Exception):
+    """A queue command is malformed - nothing is queued"""
+
+def make_command(data):
+    """Validate a queue request body into a stored command"""
+    if not isinstance(data, dict) or data.get('type') not in QUEUE_COMMANDS:
+        raise QueueError(f"'type' must be one of {', '.join(QUEUE_COMMANDS)}")
+    policy = data.get('policy', 'append')
+    if policy not in QUEUE_POLICIES:
+        raise QueueError(f"'policy' must be one of {', '.join(QUEUE_POLICIES)}")
+    priority = data.get('priority', 'normal')
+    if priority in PRIORITIES:
+        priority = PRIORITIES[priority]
+    elif not isinstance(priority, int) or isinstance(priority, bool):
+        raise QueueError(f"'priority' must be one of {', '.join(PRIORITIES)} or an integer")
+    if data['type'] == 'gif' and not (isinstance(data.get('url'), str) and data['url']):
+        raise QueueError("a gif command needs a url")
+    if data['type'] == 'animation':
+        frames = data.get('frames', [])
+        if not isinstance(frames, list) or not all(isinstance(pose, str) for pose in frames):
+            raise QueueError("'frames' must be a list of pose names")
+        if data.get('loop') is not None and not isinstance(data['loop'], bool):
+            raise QueueError("'loop' must be true or false")
+    try:
+        for key in TIMING_FIELDS[data['type']]:
+            timing(data, key, None)
+    except StateError as e:
+        raise QueueError(str(e))
+    body = {key: value for key, value in data.items() if key not in ('type', 'policy', 'priority')}
+    return {'type': data['type'], 'priority': priority, 'policy': policy, 'body': body}
+
+def current_item(state):
+    """'gif' or 'animation' while something that ends on its own is playing
+
+    Only what has an expiry deadline counts: a looping animation, an empty
+    one or a GIF without a duration never ends, so it is idle for the queue.
+    """
+    deadlines = expiry_deadlines(state)
+    return next((field for field in ('gif', 'animation') if field in deadlines), None)
+
+def start_command(state, command):
+    """Play a command now, replacing whatever is on screen"""
+    state['gif'] = None
+    state['animation'] = None
+    QUEUE_COMMANDS[command['type']](state, command['body'])
+
+def advance_queue(state, data=None):
+    """Start queued commands while nothing is playing"""
+    while state.get('queue') and not current_item(state):
+        command, state['queue'] = state['queue'][0], state['queue'][1:]
+        start_command(state, command)
+
+def apply_enqueue(state, data):
+    """Queue an animation or GIF command
+
+    interrupt - play now; queued commands stay queued
+    append    - wait behind queued commands of the same or higher priority
+    replace   - drop queued commands of the same or lower priority, then append
+    """
+    command = make_command(data)
+    if command['policy'] == 'interrupt':
+        start_command(state, command)
+        return
+    queue = list(state.get('queue') or [])
+    if command['policy'] == 'replace':
+        queue = [queued for queued in queue if queued['priority'] > command['priority']]
+    position = next((index for index, queued in enumerate(queue)
+                     if queued['priority'] < command['priority']), len(queue))
+    queue.insert(position, command)
+    state['queue'] = queue
+    advance_queue(state)
+
+def apply_clear_queue(state, data=None):
+    """Drop every queued command (what is playing keeps playing)"""
+    state['queue'] = []
+
+def play_animation_command(state, data):
+    """POST /play_animation: an animation command, played now unless the body sets a 'policy'"""
+    apply_enqueue(state, dict(data, type='animation', policy=data.get('policy', 'interrupt')))
+
+def show_gif_command(state, data):
+    """POST /show_gif: a GIF command, shown now unless the body sets a 'policy'"""
+    apply_enqueue(state, dict(data, type='gif', policy=data.get('policy', 'interrupt')))
+
+# Operations accepted by POST /batch - same bodies and command path as the single endpoints
+BATCH_OPERATIONS = {
+    'set': apply_update,
+    'play_animation': play_animation_command,
+    'stop_animation': apply_stop_animation,
+    'show_gif': show_gif_command,
+    'hide_gif': apply_hide_gif,
+    'enqueue': apply_enqueue,
+    'clear_queue': apply_clear_queue
+}
+
+class BatchError(Exception):
+    """A batch operation is malformed - nothing in the batch is applied"""
+
+def apply_batch(state, operations):
+    """Apply a list of {'op': name, ...body} operations to a draft in order"""
+    if not isinstance(operations, list):
+        raise BatchError("'operations' must be a list")
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+            raise BatchError(f"operation {index}: unknown op {operation!r}")
+        data = {key: value for key, value in operation.items() if key != 'op'}
+        try:
+            BATCH_OPERATIONS[operation['op']](state, data)
+        except (QueueError, StateError) as e:
+            raise BatchError(f"operation {index}: {e}")
+
+# Timed state - the server clears GIFs and non-looping animations when they run out
+
+def animation_duration(animation):
+    """Length of one pass through an animation in seconds (same rules as the display)"""
+    sequence = animation.get('sequence') or animation.get('frames') or []
+    if not isinstance(sequence, list):
+        return 0
+    # Animations set through POST /state skip command validation - ignore what is not a positive number
+    fps = animation.get('fps', 2)
+    duration_per_pose = animation.get('duration_per_pose')
+    if not is_number(duration_per_pose) or duration_per_pose <= 0:
+        duration_per_pose = 1.0 / fps if is_number(fps) and fps > 0 else 2.0
+    return len(sequence) * duration_per_pose
+
+def expiry_deadlines(state):
+    """{field: (deadline, token)} for every timed part of a state
+
+    The token identifies what was scheduled, so a GIF or animation that was
+    replaced in the meantime is never cleared by an old deadline.
+    """
+    deadlines = {}
+    gif = state.get('gif')
+    if gif and is_number(gif.get('duration')) and is_number(gif.get('start_time')):
+        deadlines['gif'] = (gif['start_time'] + gif['duration'], (gif.get('url'), gif['start_time']))
+    animation = state.get('animation')
+    if animation and not animation.get('loop') and is_number(animation.get('start_time')):
+        duration = animation_duration(animation)
+        if duration > 0:
+            deadlines['animation'] = (animation['start_time'] + duration,
+                                      (animation.get('id'), animation['start_time']))
+    return deadlines
+
+def apply_expiry(state, expired):
+    """Clear timed fields whose deadline passed, if they are still the same ones
+
+    The next queued command starts in the same transaction, so subscribers
+    never see an idle frame in between.
+    """
+    current = expiry_deadlines(state)
+    for field, token in expired.items():
+        if field in current and current[field][1] == token:
+            if field == 'gif':
+                apply_hide_gif(state)
+            else:
+                apply_stop_animation(state)
+    advance_queue(state)
+
+class ExpiryScheduler(threading.Thread):
+    """Background thread that expires timed state and advances the queue
+
+    Follows the store like a stream client, so GIFs and animations expire
+    however they were set (single endpoints, /batch or POST /state), and the
+    queue moves on when a client cancels what was playing. Both are normal
+    transactions: one version bump, pushed to every subscriber.
+    """
+
+    def __init__(self, store):
+        super().__init__(daemon=True)
+        self.store = store
+        self.stopped = threading.Event()
+
+    def run(self):
+        subscriber = self.store.subscribe()
+        pending = {}
+        try:
+            while not self.stopped.is_set():
+                now = time.time()
+                timeout = min((deadline for deadline, _ in pending.values()), default=now + 1.0) - now
+                try:
+                    snapshot = subscriber.get(timeout=min(max(timeout, 0), 1.0))
+                    while not subscriber.empty():
+                        snapshot = subscriber.get_nowait()  # Only the latest matters
+                    pending = expiry_deadlines(snapshot.state)
+                    if snapshot.state.get('queue') and not current_item(snapshot.state):
+                        self.store.apply(advance_queue)  # Playing item was cancelled
+                        continue
+                except queue.Empty:
+                    pass
+                except Exception:
+                    # One unexpected state must not stop expiry for good
+                    expiry_log.exception("Could not schedule expiry")
+                    pending = {}
+                    continue
+
+                now = time.time()
+                expired = {field: token for field, (deadline, token) in pending.items() if deadline <= now}
+                if expired:
+                    try:
+                        self.store.apply(apply_expiry, expired)
+                        expiry_log.info("Expired: %s", ', '.join(expired), extra={'fields': expired})
+                    except Exception:
+                        expiry_log.exception("Could not expire %s", ', '.join(expired))
+                    for field in expired:
+                        del pending[field]
+        finally:
+            self.store.unsubscribe(subscriber)
+
+    def stop(self):
+        self.stopped.set()
+
+def parse_predicates(args):
+    """Field predicates from /wait query arguments, given as (key, value) pairs
+
+    field=value checks equality, field!=value inequality. Values are read as
+    JSON when they parse (null, true, 3), otherwise as strings; dotted
+    fields reach into objects (position.x=100).
+    """
+    predicates = []
+    for key, raw in args:
+        if key in ('timeout', 'since'):
+            continue
+        negate = key.endswith('!')
+        try:
+            expected = json.loads(raw)
+        except ValueError:
+            expected = raw
+        predicates.append((key.rstrip('!').split('.'), negate, expected))
+    return predicates
+
+def predicates_match(state, predicates):
+    """True when every predicate holds for a state"""
+    for path, negate, expected in predicates:
+        value = state
+        for part in path:
+            value = value.get(part) if isinstance(value, dict) else None
+        if (value == expected) == negate:
+            return False
+    return True
+
+def log_update(data):
+    """Log the fields a POST /state changed"""
+    if 'animation' in data and data['animation'] is None:
+        animation_log.info("Animation cleared")
+    if 'pose' in data:
+        pose_log.info("Avatar pose changed to: %s", data['pose'])
+    if 'visible' in data:
+        visible_log.info("Avatar visibility: %s", data['visible'])
+    if 'position' in data:
+        position_log.info("Avatar moved to: %s", data['position'], extra={'fields': data['position']})
+    if 'animation' in data and data['animation'] is not None:
+        animation_log.debug("Animation updated: %s", data['animation'], extra={'fields': data['animation']})
+
+def log_batch(operations):
+    batch_log.info("Batch applied: %s", ', '.join(op['op'] for op in operations))
+
+def log_enqueue(data):
+    queue_log.info("Queued %s (%s): %s", data['type'], data.get('policy', 'append'),
+                   data.get('id', data.get('url')), extra={'fields': data})
+
+def describe_current(state):
+    """Short description of what is on screen for GET /queue"""
+    if state.get('gif'):
+        return {'type': 'gif', 'url': state['gif'].get('url')}
+    if state.get('animation'):
+        animation = state['animation']
+        return {'type': 'animation', 'id': animation.get('id'), 'loop': animation.get('loop', False)}
+    return None
+
+def queue_view(snapshot):
+    """Body for GET /queue"""
+    return {'version': snapshot.version,
+            'current': describe_current(snapshot.state),
+            'queue': snapshot.state.get('queue') or []}
@@ -0,0 +1,182 @@
+# state_store.py
+"""
+Thread-safe avatar state store
+Writers take a lock and publish a fresh snapshot, readers never lock
+"""
+
+import copy
+import queue
+import threading
+from contextlib import contextmanager
+
+from state_model import dumps
+
+class Snapshot:
+    """One published version of the state
+
+    Snapshots are never modified after they are published, so readers can
+    use them without holding a lock. The JSON encoding is made on first use
+    and then shared by every request and stream that sends this version.
+    """
+    __slots__ = ('version', 'state', 'field_versions', '_encoded')
+
+    def __init__(self, version, state, field_versions):
+        self.version = version
+        self.state = state
+        self.field_versions = field_versions
+        self._encoded = None
+
+    def encoded(self):
+        """State as JSON bytes (compact, sorted keys, trailing newline)"""
+        encoded = self._encoded
+        if encoded is None:
+            # Two threads may both encode once - same bytes, no lock needed
+            encoded = self._encoded = dumps(self.state)
+        return encoded
+
+    def __repr__(self):
+        return f"Snapshot(version={self.version}, state={self.state!r})"
+
+class LatestSnapshot:
+    """Subscriber that keeps only the newest undelivered snapshot
+
+    Every snapshot is the full state, so a stream whose client reads slowly
+    skips to the latest one instead of queueing every version in between.
+    get() works like queue.Queue.get.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._snapshot = None
+
+    def put(self, snapshot):
+        with self._condition:
+            self._snapshot = snapshot
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Take the pending snapshot; raises queue.Empty when none arrives within timeout"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._snapshot is not None, timeout):
+                raise queue.Empty
+            snapshot, self._snapshot = self._snapshot, None
+            return snapshot
+
+class StateStore:
+    """Avatar state with a single writer lock and copy-on-write snapshots"""
+
+    def __init__(self, initial_state):
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)  # Notified on every publish
+        self._snapshot = Snapshot(0, copy.deepcopy(initial_state), {})
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        """Current snapshot - lock-free, treat it as read-only"""
+        return self._snapshot
+
+    @property
+    def version(self):
+        """Current state version"""
+        return self._snapshot.version
+
+    @contextmanager
+    def transaction(self):
+        """Mutate a private copy of the state and publish it atomically
+
+        Yields a draft dict. When the block exits without an exception the
+        draft becomes the new snapshot with a single version bump; if no
+        field changed nothing is published.
+        """
+        with self._lock:
+            current = self._snapshot
+            draft = copy.deepcopy(current.state)
+            yield draft
+
+            changed = [field for field, value in draft.items()
+                       if field not in current.state or current.state[field] != value]
+            if not changed:
+                return
+
+            version = current.version + 1
+            field_versions = dict(current.field_versions)
+            for field in changed:
+                field_versions[field] = version
+
+            # Single reference assignment - readers see the old or new snapshot, never a mix
+            self._snapshot = Snapshot(version, draft, field_versions)
+            self._notify(self._snapshot)
+            self._changed.notify_all()
+
+    def apply(self, operation, *args):
+        """Run operation(draft, *args) in one transaction
+
+        Returns the snapshot that transaction produced, even if other
+        writers publish right after it.
+        """
+        with self._lock:
+            with self.transaction() as state:
+                operation(state, *args)
+            return self._snapshot
+
+    def update(self, patch):
+        """Merge a dict of fields into the state in one transaction"""
+        return self.apply(lambda state: state.update(copy.deepcopy(patch)))
+
+    def changes_since(self, version):
+        """Fields that changed after the given version, with the current version
+
+        A version newer than the current one (from before a restart) gets
+        the whole state back.
+        """
+        snapshot = self._snapshot
+        if version > snapshot.version:
+            return snapshot.version, dict(snapshot.state)
+        changes = {field: snapshot.state.get(field)
+                   for field, changed_at in snapshot.field_versions.items()
+                   if changed_at > version}
+        return snapshot.version, changes
+
+    def wait_for(self, predicate, timeout=None):
+        """Block until predicate(snapshot) is true or the timeout passes
+
+        Waiters sleep on a condition variable that every publish wakes, so
+        nothing polls. Returns the first matching snapshot, or None on timeout.
+        """
+        with self._changed:
+            if self._changed.wait_for(lambda: predicate(self._snapshot), timeout):
+                return self._snapshot
+            return None
+
+    def subscribe(self, subscriber=None):
+        """Register a subscriber queue that receives every new snapshot
+
+        The current snapshot is queued first so the subscriber starts in sync.
+        Any object with a put(snapshot) method can stand in for the queue;
+        put() is called with the writer lock held, so it must not block.
+        """
+        if subscriber is None:
+            subscriber = queue.Queue()
+        with self._lock, self._subscribers_lock:
+            subscriber.put(self._snapshot)
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Remove a subscriber queue"""
+        with self._subscribers_lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    @property
+    def subscriber_count(self):
+        """Number of connected subscribers"""
+        return len(self._subscribers)
+
+    def _notify(self, snapshot):
+        """Queue a snapshot for every subscriber (called with the writer lock held)"""
+        with self._subscribers_lock:
+            for subscriber in self._subscribers:
+                subscriber.put(snapshot)
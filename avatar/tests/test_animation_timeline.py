@@ -0,0 +1,72 @@
+"""
+Tests for the display's local animation playback (animation_timeline.py)
+Short poses on the offscreen platform: poses arrive in order with their
+indices, a one-shot animation finishes, a looping one wraps until stopped
+
+Run with: python -m pytest avatar/tests
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+pytest.importorskip('PyQt5')
+
+from PyQt5.QtWidgets import QApplication
+
+from animation_timeline import AnimationTimeline
+
+app = QApplication.instance() or QApplication([])
+
+POSE_SECONDS = 0.05
+
+def wait_until(condition, timeout=5):
+    """Run the Qt event loop until condition() holds"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.002)
+    return condition()
+
+def record(timeline):
+    """Lists the timeline's signals are appended to"""
+    poses, finished = [], []
+    timeline.pose_changed.connect(lambda pose, index: poses.append((pose, index)))
+    timeline.finished.connect(lambda: finished.append(timeline.elapsed))
+    return poses, finished
+
+def test_poses_arrive_in_order_then_finished_fires():
+    timeline = AnimationTimeline({'id': 'wave', 'frames': ['happy', 'idle', 'love'],
+                                  'duration_per_pose': POSE_SECONDS})
+    poses, finished = record(timeline)
+    timeline.start()
+    assert poses == [('happy', 0)]  # The first pose is shown at once
+    assert wait_until(lambda: finished)
+    assert poses == [('happy', 0), ('idle', 1), ('love', 2)]
+    assert len(finished) == 1 and finished[0] >= timeline.total_duration
+    assert timeline.pose == 'love'
+
+def test_looping_animation_wraps_until_stopped():
+    timeline = AnimationTimeline({'id': 'spin', 'sequence': ['happy', 'idle'], 'loop': True,
+                                  'duration_per_pose': POSE_SECONDS})
+    poses, finished = record(timeline)
+    timeline.start()
+    assert wait_until(lambda: len(poses) >= 5)
+    timeline.stop()
+    assert poses[:5] == [('happy', 0), ('idle', 1), ('happy', 2), ('idle', 3), ('happy', 4)]
+    count = len(poses)
+    wait_until(lambda: False, timeout=3 * POSE_SECONDS)
+    assert len(poses) == count and not finished
+
+def test_fps_sets_the_pose_duration_and_empty_animation_finishes_at_once():
+    assert AnimationTimeline({'frames': ['idle'], 'fps': 4}).duration_per_pose == 0.25
+    assert AnimationTimeline({'frames': ['idle'], 'duration_per_pose': 0}).duration_per_pose == 2.0
+    timeline = AnimationTimeline({'id': 'empty', 'frames': []})
+    poses, finished = record(timeline)
+    timeline.start()
+    assert poses == [] and len(finished) == 1
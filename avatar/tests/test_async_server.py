@@ -0,0 +1,255 @@
+"""
+Wire-compatibility tests and benchmark for the asyncio state server
+Runs the Flask and asyncio servers side by side on real sockets, replays the
+same requests against both, and compares throughput, latency and stream fan-out
+
+Run with: python -m pytest avatar/tests  (or: python test_async_server.py for the benchmark)
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from werkzeug.serving import make_server
+
+import avatar_state_server as server
+import state_service
+from async_state_server import AsyncStateServer, StreamHub
+from state_history import EventHistory
+from state_model import AvatarState
+from state_store import StateStore
+
+class FlaskServer:
+    """The Flask app on a real socket, with its own store"""
+
+    def __init__(self):
+        self.original_store = server.store
+        self.original_history = server.history
+        self.store = server.store = StateStore(AvatarState().to_dict())
+        server.history = self.store.subscribe(EventHistory())
+        self.http = make_server('127.0.0.1', 0, server.app, threaded=True)
+        self.url = f"http://127.0.0.1:{self.http.server_port}"
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.http.shutdown()
+        server.store = self.original_store
+        server.history = self.original_history
+
+class AsyncServer:
+    """The asyncio server on its own event loop thread"""
+
+    def __init__(self):
+        self.store = StateStore(AvatarState().to_dict())
+        self.server = AsyncStateServer(self.store, self.store.subscribe(EventHistory()))
+        self.loop = asyncio.new_event_loop()
+        port = self.loop.run_until_complete(self.server.start('127.0.0.1', 0))
+        self.url = f"http://127.0.0.1:{port}"
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+@pytest.fixture
+def servers():
+    flask_server, async_server = FlaskServer(), AsyncServer()
+    yield flask_server, async_server
+    flask_server.stop()
+    async_server.stop()
+
+def without_times(value):
+    """Drop start_time and event time fields, which differ between two runs"""
+    if isinstance(value, dict):
+        return {key: without_times(item) for key, item in value.items() if key not in ('start_time', 'time')}
+    if isinstance(value, list):
+        return [without_times(item) for item in value]
+    return value
+
+SCRIPT = [
+    ('GET', '/health', None, {}),
+    ('GET', '/state', None, {}),
+    ('GET', '/state', None, {'If-None-Match': 'ETAG'}),
+    ('POST', '/state', {'pose': 'happy', 'position': {'x': 5, 'y': 6}}, {}),
+    ('GET', '/state?since=0', None, {}),
+    ('POST', '/play_animation', {'id': 'wave', 'frames': ['happy', 'idle'], 'duration_per_pose': 5}, {}),
+    ('POST', '/queue', {'type': 'gif', 'url': 'https://example.com/a.gif'}, {}),
+    ('POST', '/queue', {'type': 'gif'}, {}),
+    ('GET', '/queue', None, {}),
+    ('DELETE', '/queue', None, {}),
+    ('DELETE', '/animate', None, {}),
+    ('POST', '/show_gif', {'url': 'https://example.com/b.gif', 'duration': 30}, {}),
+    ('POST', '/hide_gif', None, {}),
+    ('POST', '/batch', {'operations': [{'op': 'set', 'pose': 'love'}, {'op': 'hide_gif'}]}, {}),
+    ('POST', '/batch', {'operations': [{'op': 'explode'}]}, {}),
+    ('GET', '/wait?pose=love&timeout=1', None, {}),
+    ('GET', '/wait?pose=happy&timeout=0.1', None, {}),
+    ('GET', '/state', None, {'If-None-Match': 'ETAG'}),
+    ('GET', '/events?since=0', None, {}),
+    ('GET', '/events?since=3', None, {}),
+    ('GET', '/events?since=99', None, {}),
+    ('PUT', '/state', None, {}),
+]
+
+def replay(url):
+    session = requests.Session()
+    etag = None
+    results = []
+    for method, path, body, headers in SCRIPT:
+        headers = {name: value.replace('ETAG', etag or '') for name, value in headers.items()}
+        response = session.request(method, url + path, json=body, headers=headers)
+        etag = response.headers.get('ETag', '').strip('"') or etag
+        content = response.json() if response.headers.get('Content-Type') == 'application/json' else None
+        if response.status_code < 400 or path == '/batch' or path == '/queue':
+            results.append((method, path, response.status_code, without_times(content),
+                            'ETag' in response.headers))
+        else:
+            results.append((method, path, response.status_code))
+    return results
+
+def test_async_server_answers_like_flask(servers):
+    flask_server, async_server = servers
+    assert replay(async_server.url) == replay(flask_server.url)
+
+def test_bad_bodies_get_the_same_status_as_flask(servers):
+    json_type = {'Content-Type': 'application/json'}
+    posts = [('/state', '{bad', json_type), ('/state', '', json_type), ('/state', '{"pose": "x"}', {}),
+             ('/show_gif', '{bad', json_type), ('/play_animation', '[1]', json_type)]
+    sessions = [requests.Session() for _ in servers]
+    statuses = [[session.post(running.url + path, data=body, headers=headers, timeout=5).status_code
+                 for path, body, headers in posts] for session, running in zip(sessions, servers)]
+    assert statuses[0] == statuses[1] == [400, 400, 415, 400, 500]
+    # A failed handler still answers and leaves the connection usable
+    assert sessions[1].get(f"{servers[1].url}/health", timeout=5).status_code == 200
+    assert servers[1].store.version == 0
+
+def test_slow_stream_listener_keeps_only_the_newest_event():
+    loop = asyncio.new_event_loop()
+    hub = StreamHub(loop)
+    listener = hub.listen()
+    store = StateStore(AvatarState().to_dict())
+    for x in range(30):
+        store.update({'position': {'x': x, 'y': 0}})
+        hub.publish(store.snapshot)
+    assert listener.qsize() == 1
+    assert listener.get_nowait()[0].version == store.version
+    loop.close()
+
+def test_wait_rejects_a_timeout_that_is_not_finite(servers):
+    for running in servers:
+        for timeout in ('nan', 'inf', '-1'):
+            assert requests.get(f"{running.url}/wait?pose=love&timeout={timeout}", timeout=5).status_code == 400
+
+def test_async_stream_sends_state_then_changes(servers):
+    _, async_server = servers
+    with requests.get(f"{async_server.url}/state/stream", stream=True, timeout=5) as response:
+        assert response.headers['Content-Type'].startswith('text/event-stream')
+        lines = response.iter_lines(decode_unicode=True)
+        assert next(lines) == f"id: {server.state_etag(0)}"
+        assert next(lines).startswith('data: ')
+        async_server.store.update({'pose': 'happy'})
+        next(lines)
+        assert next(lines) == f"id: {server.state_etag(1)}"
+        assert '"happy"' in next(lines)
+
+def metric_types(url):
+    response = requests.get(f"{url}/metrics")
+    assert response.headers['Content-Type'].startswith('text/plain')
+    return {line.split()[2]: line.split()[3] for line in response.text.splitlines() if line.startswith('# TYPE')}
+
+def test_async_metrics_match_flask(servers, monkeypatch):
+    metrics = server.Metrics()
+    monkeypatch.setattr(server, 'metrics', metrics)
+    monkeypatch.setattr(state_service, 'metrics', metrics)
+    flask_server, async_server = servers
+    requests.get(f"{async_server.url}/state", headers={'User-Agent': 'avatar-display'})
+    assert metric_types(async_server.url) == metric_types(flask_server.url)
+    text = requests.get(f"{async_server.url}/metrics").text
+    assert 'avatar_http_requests_total{route="/state",method="GET",status="200"}' in text
+    assert 'avatar_display_poll_age_seconds NaN' not in text
+
+def stream_fanout(url, store, streams):
+    """Seconds until every one of `streams` SSE clients has seen one update"""
+    received = threading.Barrier(streams + 1)
+    connected = threading.Barrier(streams + 1)
+
+    def client():
+        with requests.get(f"{url}/state/stream", stream=True, timeout=30) as response:
+            lines = response.iter_lines(decode_unicode=True)
+            next(lines)  # Initial snapshot
+            next(lines)
+            connected.wait()
+            for line in lines:
+                if line.startswith('data: ') and '"fanout"' in line:
+                    break
+            received.wait()
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(streams)]
+    for thread in threads:
+        thread.start()
+    connected.wait(timeout=30)
+    started = time.perf_counter()
+    store.update({'pose': 'fanout'})
+    received.wait(timeout=30)
+    return time.perf_counter() - started
+
+def test_async_server_holds_many_streams(servers):
+    _, async_server = servers
+    assert stream_fanout(async_server.url, async_server.store, 100) < 5
+
+def load(url, clients, requests_per_client):
+    """Mixed polling load: conditional GETs plus position posts; returns (req/s, latencies)"""
+    def worker(seed):
+        session = requests.Session()
+        etag = None
+        latencies = []
+        for i in range(requests_per_client):
+            started = time.perf_counter()
+            if i % 4 == 0:
+                session.post(f"{url}/state", json={'position': {'x': seed, 'y': i}})
+            else:
+                headers = {'If-None-Match': f'"{etag}"'} if etag else {}
+                response = session.get(f"{url}/state", headers=headers)
+                etag = response.headers.get('ETag', '').strip('"') or etag
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        latencies = [latency for result in pool.map(worker, range(clients)) for latency in result]
+    return len(latencies) / (time.perf_counter() - started), sorted(latencies)
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def test_benchmark_runs_on_both_servers(servers):
+    for running in servers:
+        throughput, latencies = load(running.url, clients=4, requests_per_client=25)
+        assert throughput > 0 and len(latencies) == 100
+
+if __name__ == '__main__':
+    CLIENTS, REQUESTS, STREAMS = 8, 250, 200
+    print(f"{CLIENTS} clients x {REQUESTS} requests (3 conditional GET /state : 1 POST /state), "
+          f"then one update fanned out to {STREAMS} /state/stream clients")
+    print(f"{'server':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'fan-out ms':>14}")
+    for name, factory in (('flask', FlaskServer), ('asyncio', AsyncServer)):
+        running = factory()
+        try:
+            throughput, latencies = load(running.url, CLIENTS, REQUESTS)
+            fanout = stream_fanout(running.url, running.store, STREAMS)
+        finally:
+            running.stop()
+        print(f"{name:<10}{throughput:>10.0f}{statistics.median(latencies) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.2f}{fanout * 1000:>14.1f}")
@@ -0,0 +1,114 @@
+"""
+Drag benchmark for position publishing
+Replays a fast drag against a real local state server, once with a blocking
+POST per mouse move (the old behaviour) and once through PositionPublisher,
+and compares request count and time spent blocking the GUI thread
+
+Run with: python -m pytest avatar/tests  (or: python test_drag_publisher.py for the table)
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+pytest.importorskip('PyQt5')
+
+import requests
+from PyQt5.QtWidgets import QApplication
+from werkzeug.serving import make_server
+
+import avatar_state_server as server
+from state_client import StateClient, PositionPublisher, POSITION_RATE
+from state_model import AvatarState
+from state_store import StateStore
+
+app = QApplication.instance() or QApplication([])
+
+MOVES = 500  # Mouse-move events in one drag
+MOVE_INTERVAL = 0.002  # 500 Hz, a typical high-rate mouse
+
+def start_server():
+    server.store = StateStore(dict(AvatarState().to_dict(), position={'x': 0, 'y': 0}))
+    http = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    return http, f"http://127.0.0.1:{http.server_port}"
+
+def drag_blocking(url):
+    """Old behaviour: one synchronous POST per mouse move"""
+    session = requests.Session()
+    blocked = 0.0
+    for i in range(1, MOVES + 1):
+        started = time.perf_counter()
+        session.post(f"{url}/state", json={'position': {'x': i, 'y': i}})
+        blocked += time.perf_counter() - started
+    return blocked
+
+def drag_coalesced(url):
+    """New behaviour: positions go through PositionPublisher"""
+    client = StateClient(url)
+    publisher = PositionPublisher(client)
+    blocked = 0.0
+    for i in range(1, MOVES + 1):
+        started = time.perf_counter()
+        publisher.publish(i, i)
+        app.processEvents()
+        blocked += time.perf_counter() - started
+        time.sleep(MOVE_INTERVAL)
+    started = time.perf_counter()
+    publisher.finish(MOVES, MOVES)
+    blocked += time.perf_counter() - started
+
+    # Let the network thread drain before reading the result
+    deadline = time.monotonic() + 5
+    while server.store.snapshot.state['position']['x'] != MOVES and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.005)
+    client.stop()
+    return blocked, publisher.sent
+
+def run_benchmark():
+    original_store = server.store
+    http, url = start_server()
+    try:
+        blocking_time = drag_blocking(url)
+        blocking_requests = server.store.version
+
+        server.store = StateStore(dict(server.store.snapshot.state, position={'x': 0, 'y': 0}))
+        coalesced_time, coalesced_requests = drag_coalesced(url)
+        final = server.store.snapshot.state['position']
+    finally:
+        http.shutdown()
+        server.store = original_store
+    return {
+        'blocking': (blocking_requests, blocking_time),
+        'coalesced': (coalesced_requests, coalesced_time),
+        'final': final
+    }
+
+def test_drag_is_coalesced_and_final_position_is_sent():
+    result = run_benchmark()
+    blocking_requests, blocking_time = result['blocking']
+    coalesced_requests, coalesced_time = result['coalesced']
+
+    assert blocking_requests == MOVES
+    drag_seconds = MOVES * MOVE_INTERVAL
+    # Rate-limited, allowing for a slow sleep() on a busy machine
+    assert coalesced_requests <= POSITION_RATE * drag_seconds * 3 + 2
+    assert coalesced_requests < blocking_requests / 5
+    assert coalesced_time < blocking_time
+    assert result['final'] == {'x': MOVES, 'y': MOVES}
+
+if __name__ == '__main__':
+    result = run_benchmark()
+    print(f"Drag of {MOVES} mouse moves at {1 / MOVE_INTERVAL:.0f} Hz")
+    print(f"{'':<22}{'requests':>10}{'GUI blocked (ms)':>20}")
+    for name, label in (('blocking', 'POST per move'), ('coalesced', f'Coalesced {POSITION_RATE} Hz')):
+        requests_sent, blocked = result[name]
+        print(f"{label:<22}{requests_sent:>10}{blocked * 1000:>20.1f}")
+    print(f"Final position on server: {result['final']}")
@@ -0,0 +1,210 @@
+"""
+Tests and benchmark for embedded mode (avatar_display.py --embedded)
+The state service runs in the display process: the asyncio server answers
+external producers from a background thread and the window follows the store
+through an in-process subscription. The benchmark compares import cost and
+update delivery with the separate Flask server and its /state/stream
+
+Run with: python -m pytest avatar/tests  (or: python test_embedded.py for the table)
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+AVATAR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AVATAR_DIR)
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+pytest.importorskip('PyQt5')
+
+import requests
+from PyQt5.QtCore import QByteArray, QUrl
+from PyQt5.QtNetwork import QNetworkReply, QNetworkRequest
+from PyQt5.QtWidgets import QApplication
+
+from async_state_server import BackgroundStateServer
+from avatar_display import AvatarWindow, StoreSubscription
+from state_model import AvatarState
+from state_store import StateStore
+
+app = QApplication.instance() or QApplication([])
+
+@pytest.fixture
+def background():
+    store = StateStore(AvatarState().to_dict())
+    running = BackgroundStateServer(store, host='127.0.0.1', port=0)
+    yield store, f"http://127.0.0.1:{running.port}"
+    running.stop()
+
+def wait_until(condition, timeout=5):
+    """Run the Qt event loop until condition() holds"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.005)
+    return condition()
+
+def test_background_server_serves_the_store(background):
+    store, url = background
+    assert requests.post(f"{url}/state", json={'pose': 'happy'}).json() == {'status': 'ok'}
+    assert store.snapshot.state['pose'] == 'happy'
+    assert requests.get(f"{url}/state").json()['pose'] == 'happy'
+
+def test_taken_port_raises_before_the_thread_starts(background):
+    store, url = background
+    subscribers = store.subscriber_count
+    with pytest.raises(OSError):
+        BackgroundStateServer(store, host='127.0.0.1', port=int(url.rsplit(':', 1)[1]))
+    assert store.subscriber_count == subscribers
+
+def test_requests_wait_until_the_server_serves():
+    store = StateStore(AvatarState().to_dict())
+    running = BackgroundStateServer(store, host='127.0.0.1', port=0, serve=False)
+    early = threading.Thread(target=requests.post, args=(f"http://127.0.0.1:{running.port}/state",),
+                             kwargs={'json': {'pose': 'love'}, 'timeout': 5})
+    early.start()
+    time.sleep(0.1)
+    assert store.version == 0  # Not answered yet: restoring state now cannot overwrite it
+    store.update({'pose': 'happy'})
+    running.serve()
+    early.join()
+    assert store.snapshot.state['pose'] == 'love'
+    running.stop()
+
+def test_embedded_service_does_not_import_flask():
+    code = ("import sys, state_service, async_state_server; "
+            "sys.exit('flask' in sys.modules or 'avatar_state_server' in sys.modules)")
+    assert subprocess.run([sys.executable, '-c', code], cwd=AVATAR_DIR).returncode == 0
+
+def test_subscription_wakes_the_gui_once_per_burst():
+    wakeups = []
+    subscription = StoreSubscription(lambda: wakeups.append(1))
+    for version in range(3):
+        subscription.put(version)
+    assert wakeups == [1]
+    assert subscription.take() == 2
+    assert subscription.take() is None
+    subscription.put(3)
+    assert wakeups == [1, 1]
+
+def test_window_follows_the_store_without_http(background):
+    store, url = background
+    subscribers = store.subscriber_count
+    window = AvatarWindow(store)
+    try:
+        assert window.poll_timer is None and not window.stream_active
+        assert wait_until(lambda: window.last_state is not None)
+        store.update({'position': {'x': 321, 'y': 123}})
+        assert wait_until(lambda: window.pos().x() == 321)
+        # Producers reach the same store over HTTP
+        requests.post(f"{url}/state", json={'position': {'x': 42}})
+        assert wait_until(lambda: window.pos().x() == 42)
+        assert window.last_state is store.snapshot.state
+    finally:
+        window.close()
+    assert store.subscriber_count == subscribers
+
+class DownloadedReply:
+    """A finished GIF download, as on_gif_downloaded sees it"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def error(self):
+        return QNetworkReply.NoError
+
+    def readAll(self):
+        return QByteArray(b'GIF89a')
+
+    def request(self):
+        return QNetworkRequest(QUrl(self.url))
+
+    def deleteLater(self):
+        pass
+
+def test_gif_cleared_while_downloading_does_not_start_gif_mode(background):
+    store, _ = background
+    window = AvatarWindow(store)
+    url = f"http://127.0.0.1:9/{uuid.uuid4().hex}.gif"  # Never answers
+    try:
+        store.update({'gif': {'url': url, 'duration': 5, 'start_time': time.time()}})
+        assert wait_until(lambda: window.current_gif_url == url)
+        store.update({'gif': None})
+        assert wait_until(lambda: window.current_gif_url is None)
+        window.on_gif_downloaded(DownloadedReply(url))
+        assert not window.playing_gif and window.gif_player is None
+    finally:
+        window.close()
+
+def import_cost(modules):
+    """(seconds, resident MB) after importing modules in a fresh interpreter (Linux)"""
+    code = ("import time; started = time.perf_counter(); "
+            f"[__import__(name) for name in {modules!r}]; "
+            "rss = [line for line in open('/proc/self/status') if line.startswith('VmRSS')][0].split()[1]; "
+            "print(time.perf_counter() - started, rss)")
+    seconds, rss = subprocess.run([sys.executable, '-c', code], cwd=AVATAR_DIR,
+                                  capture_output=True, text=True, check=True).stdout.split()
+    return float(seconds), int(rss) / 1024
+
+def subscription_latency(updates):
+    """Seconds from store.update to the GUI thread seeing the snapshot, in-process"""
+    store = StateStore(AvatarState().to_dict())
+    seen = threading.Event()
+    subscription = store.subscribe(StoreSubscription(seen.set))
+    latencies = []
+    for i in range(updates):
+        subscription.take()
+        seen.clear()
+        started = time.perf_counter()
+        store.update({'position': {'x': i, 'y': 0}})
+        seen.wait()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def stream_latency(updates):
+    """Seconds from store.update to an SSE client parsing the state, Flask server"""
+    from werkzeug.serving import make_server
+    import avatar_state_server as server
+
+    http = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    latencies = []
+    try:
+        with requests.get(f"http://127.0.0.1:{http.server_port}/state/stream", stream=True) as response:
+            lines = response.iter_lines(decode_unicode=True)
+            next(lines)
+            next(lines)
+            for i in range(updates):
+                started = time.perf_counter()
+                server.store.update({'position': {'x': i + 1, 'y': 0}})
+                for line in lines:
+                    if line.startswith('data: '):
+                        json.loads(line[6:])
+                        break
+                latencies.append(time.perf_counter() - started)
+    finally:
+        http.shutdown()
+    return latencies
+
+if __name__ == '__main__':
+    print("State service footprint (fresh interpreter)")
+    print(f"{'':<36}{'import ms':>10}{'RSS MB':>12}")
+    for name, modules in (('separate server (Flask)', ['avatar_state_server']),
+                          ('embedded (asyncio, no Flask)', ['state_service', 'async_state_server'])):
+        seconds, rss = import_cost(modules)
+        print(f"{name:<36}{seconds * 1000:>10.1f}{rss:>12.1f}")
+    UPDATES = 1000
+    print(f"\nUpdate delivery to the display, {UPDATES} updates")
+    print(f"{'':<36}{'p50 us':>10}{'p99 us':>12}")
+    for name, latencies in (('HTTP /state/stream + JSON', sorted(stream_latency(UPDATES))),
+                            ('in-process subscription', sorted(subscription_latency(UPDATES)))):
+        print(f"{name:<36}{statistics.median(latencies) * 1e6:>10.0f}"
+              f"{latencies[int(len(latencies) * 0.99)] * 1e6:>12.0f}")
@@ -0,0 +1,49 @@
+"""
+Tests for the content-addressed GIF cache
+
+Run with: python -m pytest avatar/tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gif_cache import GifCache
+
+def test_repeat_get_is_served_from_memory(tmp_path):
+    cache = GifCache(str(tmp_path), memory_limit=1024, disk_limit=4096)
+    assert cache.get('https://example.com/a.gif') is None
+    cache.put('https://example.com/a.gif', b'GIF89a-one')
+    assert cache.get('https://example.com/a.gif') == b'GIF89a-one'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_same_content_from_two_urls_is_stored_once(tmp_path):
+    cache = GifCache(str(tmp_path), memory_limit=1024, disk_limit=4096)
+    cache.put('https://example.com/a.gif', b'GIF89a-same')
+    cache.put('https://mirror.example.com/a.gif', b'GIF89a-same')
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.gif')]) == 1
+    assert cache.memory_bytes == len(b'GIF89a-same')
+
+def test_disk_cache_survives_restart(tmp_path):
+    GifCache(str(tmp_path), memory_limit=1024, disk_limit=4096).put('https://example.com/a.gif', b'GIF89a-disk')
+    cache = GifCache(str(tmp_path), memory_limit=1024, disk_limit=4096)
+    assert cache.get('https://example.com/a.gif') == b'GIF89a-disk'
+
+def test_limits_evict_least_recently_used(tmp_path):
+    cache = GifCache(str(tmp_path), memory_limit=20, disk_limit=25)
+    cache.put('https://example.com/1.gif', b'1' * 10)
+    os.utime(cache.blob_path(cache.urls['https://example.com/1.gif']), (1, 1))
+    cache.put('https://example.com/2.gif', b'2' * 10)
+    cache.put('https://example.com/3.gif', b'3' * 10)
+    assert cache.memory_bytes <= 20
+    assert 'https://example.com/1.gif' not in cache.urls
+    assert cache.get('https://example.com/3.gif') == b'3' * 10
+
+def test_damaged_file_is_treated_as_a_miss(tmp_path):
+    cache = GifCache(str(tmp_path), memory_limit=0, disk_limit=4096)
+    cache.put('https://example.com/a.gif', b'GIF89a-good')
+    with open(cache.blob_path(cache.urls['https://example.com/a.gif']), 'wb') as f:
+        f.write(b'broken')
+    assert cache.get('https://example.com/a.gif') is None
+    assert 'https://example.com/a.gif' not in cache.urls
@@ -0,0 +1,76 @@
+"""
+Tests for the memory-budgeted GIF player
+
+Run with: python -m pytest avatar/tests
+"""
+
+import os
+import struct
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+pytest.importorskip('PyQt5')
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtWidgets import QApplication
+from gif_player import GifPlayer
+
+app = QApplication.instance() or QApplication([])
+
+def make_gif(width, height, frame_count, delay_ms=20):
+    """Looping GIF with one solid colour per frame (4-colour palette)"""
+    out = bytearray(b'GIF89a' + struct.pack('<HHBBB', width, height, 0x81, 0, 0))
+    out += bytes([0, 0, 0, 255, 0, 0, 0, 255, 0, 0, 0, 255])
+    out += b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+    for frame in range(frame_count):
+        out += b'\x21\xf9\x04\x00' + struct.pack('<H', delay_ms // 10) + b'\x00\x00'
+        out += b'\x2c' + struct.pack('<HHHHB', 0, 0, width, height, 0)
+        # 3-bit LZW codes: a clear code before every pixel keeps the width fixed
+        codes = [4, frame % 4] * (width * height) + [5]
+        bits = sum(code << (3 * i) for i, code in enumerate(codes))
+        data = bits.to_bytes((3 * len(codes) + 7) // 8, 'little')
+        out += b'\x02'
+        for i in range(0, len(data), 255):
+            chunk = data[i:i + 255]
+            out += bytes([len(chunk)]) + chunk
+        out += b'\x00'
+    return bytes(out + b'\x3b')
+
+def play(player, seconds):
+    frames = []
+    player.frame_changed.connect(frames.append)
+    player.start()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.002)
+    player.stop()
+    return frames
+
+def test_small_gif_is_decoded_once_and_looped_from_memory():
+    player = GifPlayer(make_gif(40, 30, 4), QSize(400, 300), 1024 * 1024)
+    frames = play(player, 0.5)
+    assert player.keep_all
+    assert player.decoded_frames == 4
+    assert player.frames_shown > 4
+    assert frames[0].size() == QSize(40, 30)
+
+def test_large_gif_streams_through_a_bounded_buffer():
+    # Budget for 3 frames of 40x30 ARGB
+    player = GifPlayer(make_gif(40, 30, 6), QSize(400, 300), 3 * 40 * 30 * 4)
+    play(player, 0.5)
+    assert player.capacity == 3
+    assert not player.keep_all
+    assert len(player.frames) <= player.capacity
+    assert player.decoded_frames > 6  # Decoded again on every loop
+    assert player.metrics()['frames_shown'] > 6
+
+def test_frames_are_downscaled_to_fit_the_window():
+    player = GifPlayer(make_gif(80, 40, 2), QSize(40, 40), 1024 * 1024)
+    frames = play(player, 0.2)
+    assert frames[0].size() == QSize(40, 20)
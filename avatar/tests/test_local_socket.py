@@ -0,0 +1,165 @@
+"""
+Tests and benchmark for the Unix domain socket listener
+Serves the state API on a socket and on TCP side by side, checks clients use
+the socket and fall back to TCP, and compares per-call latency (Linux / macOS)
+
+Run with: python -m pytest avatar/tests  (or: python test_local_socket.py for the benchmark)
+"""
+
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server
+
+import avatar_state_server as server
+import local_socket
+from async_state_server import AsyncStateServer
+from state_model import AvatarState
+from state_store import StateStore
+
+pytestmark = pytest.mark.skipif(not local_socket.supported(), reason="no Unix domain sockets")
+
+class FlaskServers:
+    """The Flask app on TCP and on a Unix socket, sharing one store"""
+
+    def __init__(self, path):
+        self.original_store = server.store
+        self.store = server.store = StateStore(AvatarState().to_dict())
+        self.path = path
+        self.servers = [make_server('127.0.0.1', 0, server.app, threaded=True),
+                        make_server(f'unix://{path}', 0, server.app, threaded=True)]
+        self.url = f"http://127.0.0.1:{self.servers[0].server_port}"
+        for http in self.servers:
+            threading.Thread(target=http.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for http in self.servers:
+            http.shutdown()
+            http.server_close()
+        local_socket.release(self.path)
+        server.store = self.original_store
+
+class AsyncServers:
+    """The asyncio server on TCP and on a Unix socket"""
+
+    def __init__(self, path):
+        self.store = StateStore(AvatarState().to_dict())
+        self.path = path
+        self.server = AsyncStateServer(self.store)
+        self.loop = asyncio.new_event_loop()
+        port = self.loop.run_until_complete(self.server.start('127.0.0.1', 0))
+        self.loop.run_until_complete(self.server.start_unix(path))
+        self.url = f"http://127.0.0.1:{port}"
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        local_socket.release(self.path)
+
+@pytest.fixture
+def socket_path():
+    # Short path - socket addresses are limited to ~100 bytes
+    path = os.path.join(tempfile.mkdtemp(), 'state.sock')
+    yield path
+    local_socket.release(path)
+    os.rmdir(os.path.dirname(path))
+
+@pytest.fixture(params=[FlaskServers, AsyncServers], ids=['flask', 'asyncio'])
+def servers(request, socket_path):
+    running = request.param(socket_path)
+    yield running
+    running.stop()
+
+def test_session_uses_the_socket(servers):
+    # Unreachable TCP URL - only the socket can answer
+    session = local_socket.state_session('http://localhost:1', servers.path)
+    assert session.post('http://localhost:1/state', json={'pose': 'happy'}).json() == {'status': 'ok'}
+    assert session.get('http://localhost:1/state').json()['pose'] == 'happy'
+    with session.get('http://localhost:1/state/stream', stream=True, timeout=5) as response:
+        lines = response.iter_lines(decode_unicode=True)
+        next(lines)
+        assert '"happy"' in next(lines)
+
+def test_only_the_default_url_uses_the_default_socket(monkeypatch, socket_path):
+    monkeypatch.setattr(local_socket, 'SOCKET_PATH', socket_path)
+    default = local_socket.state_session()
+    assert isinstance(default.get_adapter(f"{local_socket.STATE_URL}/state"), local_socket.UnixSocketAdapter)
+    # A server on another port must not be reached through the default server's socket
+    other = local_socket.state_session('http://127.0.0.1:4000')
+    assert not isinstance(other.get_adapter('http://127.0.0.1:4000/state'), local_socket.UnixSocketAdapter)
+
+def test_missing_or_stale_socket_falls_back_to_tcp(servers, socket_path):
+    missing = local_socket.state_session(servers.url, socket_path + '.missing')
+    assert missing.get(f"{servers.url}/health").json() == {'status': 'running'}
+
+    stale = socket_path + '.stale'
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(stale)  # Bound but never listening: connections are refused
+        session = local_socket.state_session(servers.url, stale)
+        assert session.get(f"{servers.url}/health").json() == {'status': 'running'}
+    local_socket.release(stale)
+
+def test_claim_keeps_a_live_socket_and_clears_a_stale_one(servers, socket_path):
+    assert local_socket.listening(servers.path)
+    assert not local_socket.claim(servers.path)
+    assert os.path.exists(servers.path)
+
+    stale = socket_path + '.stale'
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(stale)
+    assert local_socket.claim(stale)
+    assert not os.path.exists(stale)
+
+def timed_calls(session, url, calls):
+    """Latencies of conditional GETs and position POSTs, alternating 3:1"""
+    etag = session.get(f"{url}/state").headers['ETag']
+    latencies = []
+    for i in range(calls):
+        started = time.perf_counter()
+        if i % 4 == 0:
+            session.post(f"{url}/state", json={'position': {'x': i, 'y': 0}})
+        else:
+            response = session.get(f"{url}/state", headers={'If-None-Match': etag})
+            etag = response.headers['ETag']
+        latencies.append(time.perf_counter() - started)
+    return sorted(latencies)
+
+def compare(servers, calls):
+    """(socket, tcp) latency lists against the same server"""
+    unix = local_socket.state_session('http://localhost:1', servers.path)
+    tcp = local_socket.state_session(servers.url, servers.path + '.missing')
+    return timed_calls(unix, 'http://localhost:1', calls), timed_calls(tcp, servers.url, calls)
+
+def test_benchmark_runs_over_both_transports(servers):
+    unix, tcp = compare(servers, 40)
+    assert len(unix) == len(tcp) == 40
+
+if __name__ == '__main__':
+    CALLS = 2000
+    print(f"{CALLS} calls per transport (3 conditional GET /state : 1 POST /state), one keep-alive client")
+    print(f"{'server':<10}{'transport':<12}{'p50 us':>10}{'p99 us':>10}{'mean us':>10}")
+    for name, factory in (('flask', FlaskServers), ('asyncio', AsyncServers)):
+        path = os.path.join(tempfile.mkdtemp(), 'state.sock')
+        running = factory(path)
+        try:
+            results = compare(running, CALLS)
+        finally:
+            running.stop()
+            os.rmdir(os.path.dirname(path))
+        for transport, latencies in zip(('unix', 'tcp'), results):
+            print(f"{name:<10}{transport:<12}{statistics.median(latencies) * 1e6:>10.0f}"
+                  f"{latencies[int(len(latencies) * 0.99)] * 1e6:>10.0f}{statistics.mean(latencies) * 1e6:>10.0f}")
@@ -0,0 +1,148 @@
+"""
+Tests and microbenchmark for the shared-memory state channel
+Checks the seqlock hand-off between the server's publisher and a reader, and
+compares a shared memory read with the HTTP poll it replaces
+
+Run with: python -m pytest avatar/tests  (or: python test_shared_state.py for the benchmark)
+"""
+
+import os
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avatar_state_server as server
+from shared_state import SharedStatePublisher, SharedStateReader
+from state_model import AvatarState
+from state_store import StateStore
+
+@pytest.fixture
+def segment():
+    store = StateStore(AvatarState().to_dict())
+    publisher = store.subscribe(SharedStatePublisher(server.state_etag, name=f"avatar_test_{uuid.uuid4().hex[:8]}",
+                                                     size=4096))
+    reader = SharedStateReader.open(publisher.shm.name.lstrip('/'), track=True)
+    yield store, publisher, reader
+    reader.close()
+    store.unsubscribe(publisher)
+    publisher.close()
+
+def test_reader_sees_each_new_version_once(segment):
+    store, _, reader = segment
+    etag, state = reader.read()
+    assert etag == server.state_etag(0)
+    assert state == AvatarState().to_dict()
+    assert reader.read() is None
+    assert not reader.changed()
+
+    store.update({'pose': 'happy'})
+    assert reader.changed()
+    etag, state = reader.read()
+    assert etag == server.state_etag(1)
+    assert state['pose'] == 'happy'
+    assert reader.read() is None
+
+def test_missing_segment_means_http():
+    assert SharedStateReader.open(f"avatar_missing_{uuid.uuid4().hex[:8]}") is None
+
+def test_state_too_large_for_the_segment_asks_for_http(segment):
+    store, _, reader = segment
+    reader.read()
+    store.update({'animation': {'frames': ['idle'] * 2000}})
+    assert reader.read() == ('', None)
+    store.update({'animation': None})
+    assert reader.read()[1]['animation'] is None
+
+def test_restarted_publisher_keeps_counting(segment):
+    store, publisher, reader = segment
+    reader.read()
+    second = SharedStatePublisher(server.state_etag, name=publisher.shm.name.lstrip('/'))
+    assert second.sequence >= publisher.sequence
+    store.subscribe(second)  # Republishes version 0 - must still look new to the reader
+    assert reader.read()[0] == server.state_etag(0)
+    store.unsubscribe(second)
+    second.shm.close()
+
+def test_reads_during_writes_are_never_torn(segment):
+    store, _, reader = segment
+    stop = threading.Event()
+
+    def writer():
+        n = 0
+        while not stop.is_set():
+            n += 1
+            # Both fields change together; a torn read would see them differ
+            store.update({'pose': f'pose-{n}', 'position': {'x': n, 'y': n}})
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    reads = 0
+    last_version = -1
+    deadline = time.monotonic() + 0.5
+    try:
+        while time.monotonic() < deadline:
+            result = reader.read()
+            if result:
+                etag, state = result
+                version = int(etag.rsplit('-', 1)[1])
+                assert version > last_version
+                last_version = version
+                assert state['position']['x'] == state['position']['y']
+                assert state['pose'] == f"pose-{state['position']['x']}" or version == 0
+                reads += 1
+    finally:
+        stop.set()
+        thread.join()
+    assert reads > 1
+
+def benchmark(reads=20000):
+    """Per-read latency and CPU: shared memory (unchanged / changed) against an HTTP 304 poll"""
+    import requests
+    from werkzeug.serving import make_server
+
+    store = StateStore(AvatarState().to_dict())
+    publisher = store.subscribe(SharedStatePublisher(server.state_etag, name=f"avatar_bench_{uuid.uuid4().hex[:8]}"))
+    reader = SharedStateReader.open(publisher.shm.name.lstrip('/'), track=True)
+    original_store, server.store = server.store, store
+    http = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    results = {}
+
+    def measure(name, count, read):
+        started, cpu = time.perf_counter(), time.process_time()
+        for _ in range(count):
+            read()
+        results[name] = ((time.perf_counter() - started) / count * 1e6, (time.process_time() - cpu) / count * 1e6)
+
+    try:
+        reader.read()
+        measure('shm, unchanged', reads, reader.read)
+        updates = iter(range(reads))
+
+        def changed_read():
+            store.update({'position': {'x': next(updates), 'y': 0}})
+            reader.read()
+        measure('shm, changed (incl. publish)', reads // 10, changed_read)
+
+        session = requests.Session()
+        url = f"http://127.0.0.1:{http.server_port}/state"
+        etag = session.get(url).headers['ETag']
+        measure('HTTP GET 304', reads // 20, lambda: session.get(url, headers={'If-None-Match': etag}))
+    finally:
+        http.shutdown()
+        server.store = original_store
+        reader.close()
+        store.unsubscribe(publisher)
+        publisher.close()
+    return results
+
+if __name__ == '__main__':
+    print("Display tick cost (CPU includes the in-process HTTP server)")
+    print(f"{'':<32}{'latency us':>12}{'CPU us':>10}")
+    for name, (latency, cpu) in benchmark().items():
+        print(f"{name:<32}{latency:>12.2f}{cpu:>10.2f}")
@@ -0,0 +1,94 @@
+"""
+Tests for the on-disk sprite derivative cache
+
+Run with: python -m pytest avatar/tests
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('PyQt5')
+
+from PyQt5.QtGui import QColor, QImage
+import sprite_derivatives
+
+def make_sprite(path, color):
+    image = QImage(200, 300, QImage.Format_ARGB32)
+    image.fill(QColor(color))
+    assert image.save(str(path), 'PNG')
+
+def test_builds_every_level_once(tmp_path):
+    source = tmp_path / 'idle.png'
+    make_sprite(source, 'red')
+
+    assert sprite_derivatives.ensure_derivatives(str(source)) is True
+    assert sprite_derivatives.ensure_derivatives(str(source)) is False
+
+    _, level_paths = sprite_derivatives.derived_paths(str(source))
+    for level, path in level_paths.items():
+        # Never upscaled past the source height
+        assert QImage(path).height() == min(level, 300)
+
+def test_touched_but_identical_source_is_not_rebuilt(tmp_path):
+    source = tmp_path / 'idle.png'
+    make_sprite(source, 'red')
+    sprite_derivatives.ensure_derivatives(str(source))
+
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert sprite_derivatives.ensure_derivatives(str(source)) is False
+
+def test_changed_source_is_rebuilt(tmp_path):
+    source = tmp_path / 'idle.png'
+    make_sprite(source, 'red')
+    sprite_derivatives.ensure_derivatives(str(source))
+
+    make_sprite(source, 'blue')
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert sprite_derivatives.ensure_derivatives(str(source)) is True
+    image = sprite_derivatives.load_image(str(source), 150)
+    assert image.height() == 150
+    assert QColor(image.pixel(10, 10)) == QColor('blue')
+
+def test_load_image_falls_back_to_original_above_largest_level(tmp_path):
+    source = tmp_path / 'idle.png'
+    make_sprite(source, 'red')
+    assert sprite_derivatives.pick_level(1000) is None
+    assert sprite_derivatives.load_image(str(source), 1000).height() == 300
+
+def test_concurrent_builds_leave_valid_derivatives(tmp_path):
+    source = tmp_path / 'idle.png'
+    make_sprite(source, 'red')
+    start = threading.Barrier(4)
+
+    def build():
+        start.wait()
+        sprite_derivatives.ensure_derivatives(str(source))
+
+    threads = [threading.Thread(target=build) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    meta_path, level_paths = sprite_derivatives.derived_paths(str(source))
+    assert sorted(os.listdir(os.path.dirname(meta_path))) == sorted(
+        os.path.basename(path) for path in [meta_path, *level_paths.values()])
+    for level, path in level_paths.items():
+        assert QImage(path).height() == min(level, 300)
+
+def test_failed_save_writes_no_metadata(tmp_path, monkeypatch):
+    source = tmp_path / 'idle.png'
+    make_sprite(source, 'red')
+    monkeypatch.setattr(QImage, 'save', lambda self, path, fmt=None: False)
+
+    with pytest.raises(OSError):
+        sprite_derivatives.ensure_derivatives(str(source))
+    meta_path, _ = sprite_derivatives.derived_paths(str(source))
+    assert os.listdir(os.path.dirname(meta_path)) == []  # No sidecar and no temporary files
@@ -0,0 +1,180 @@
+"""
+Tests and benchmark for the write-behind state journal
+Checks that visibility, pose and position survive a restart, that compaction
+and crashes leave a journal that replays, and that writers never wait on the
+disk. The benchmark times store writes per durability and the replay
+
+Run with: python -m pytest avatar/tests  (or: python test_state_journal.py for the table)
+"""
+
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import state_journal
+from state_journal import StateJournal
+from state_model import AvatarState
+from state_store import StateStore
+
+def restart(directory, durability='interval', **kwargs):
+    """A fresh store with the journal in directory replayed into it"""
+    store = StateStore(AvatarState().to_dict())
+    journal = StateJournal(directory, durability, **kwargs)
+    restored = journal.attach(store)
+    return store, journal, restored
+
+@pytest.fixture(params=state_journal.DURABILITY)
+def durability(request):
+    return request.param
+
+def test_first_start_keeps_the_defaults(tmp_path):
+    store, journal, restored = restart(str(tmp_path))
+    journal.close()
+    assert restored == {}
+    assert store.version == 0
+
+def test_persisted_fields_survive_a_restart(tmp_path, durability):
+    store, journal, _ = restart(str(tmp_path), durability)
+    store.update({'position': {'x': 12, 'y': 34}, 'pose': 'happy'})
+    store.update({'visible': False, 'animation': {'id': 'wave', 'frames': ['happy']}})
+    journal.close()
+
+    store, journal, restored = restart(str(tmp_path), durability)
+    journal.close()
+    assert restored == {'visible': False, 'pose': 'happy', 'position': {'x': 12, 'y': 34}}
+    state = store.snapshot.state
+    assert state['position'] == {'x': 12, 'y': 34} and state['pose'] == 'happy' and not state['visible']
+    assert state['animation'] is None  # Playback is not restored
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    directory = str(tmp_path)
+    store, journal, _ = restart(directory, compact_every=10)
+    for i in range(25):
+        store.update({'position': {'x': i, 'y': 0}})
+        time.sleep(0.001)  # Give the journal thread separate batches
+    journal.close()
+    with open(os.path.join(directory, state_journal.JOURNAL_FILE), 'rb') as f:
+        assert len(f.readlines()) <= 11  # Header plus fewer lines than compact_every
+    assert state_journal.load(directory)[1]['position'] == {'x': 24, 'y': 0}
+
+def test_killed_server_replays_what_reached_the_os(tmp_path):
+    directory = str(tmp_path)
+    store, journal, _ = restart(directory, 'fast')
+    store.update({'pose': 'thinking'})
+    deadline = time.monotonic() + 5
+    while state_journal.load(directory)[1].get('pose') != 'thinking' and time.monotonic() < deadline:
+        time.sleep(0.005)
+    # No close(): the process is gone, only the files remain
+    assert state_journal.load(directory)[1]['pose'] == 'thinking'
+    journal.close()
+
+def test_torn_last_line_is_ignored(tmp_path):
+    directory = str(tmp_path)
+    store, journal, _ = restart(directory)
+    store.update({'pose': 'happy'})
+    journal.close()
+    with open(os.path.join(directory, state_journal.JOURNAL_FILE), 'ab') as f:
+        f.write(b'{"v": 9, "p": {"pose": "sle')
+    assert state_journal.load(directory)[1]['pose'] == 'happy'
+
+def test_journal_from_before_the_snapshot_is_ignored(tmp_path):
+    directory = str(tmp_path)
+    store, journal, _ = restart(directory)
+    store.update({'pose': 'happy'})
+    journal.close()
+    _, journal, _ = restart(directory)  # Compacts 'happy' into the snapshot
+    journal.close()
+    generation = state_journal.load(directory)[0]
+    # A crash between writing the snapshot and replacing the journal
+    with open(os.path.join(directory, state_journal.JOURNAL_FILE), 'wb') as f:
+        f.write(b'{"generation": %d}\n{"v": 1, "p": {"pose": "anger"}}\n' % (generation - 1))
+    assert state_journal.load(directory)[1]['pose'] == 'happy'
+
+def test_saved_state_the_model_rejects_starts_from_defaults(tmp_path):
+    directory = str(tmp_path)
+    with open(os.path.join(directory, state_journal.SNAPSHOT_FILE), 'w') as f:
+        json.dump({'generation': 1, 'version': 3, 'state': {'position': 'left'}}, f)
+    store, journal, restored = restart(directory)
+    journal.close()
+    assert restored == {}
+    assert store.snapshot.state['position'] == AvatarState().to_dict()['position']
+
+def test_failed_write_stops_the_journal_and_unsubscribes(tmp_path, monkeypatch, caplog):
+    store, journal, _ = restart(str(tmp_path), compact_every=1)
+    subscribers = store.subscriber_count
+
+    def full_disk(path, data, sync):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(state_journal, 'write_file', full_disk)
+    store.update({'pose': 'happy'})  # Its line triggers a compaction
+    journal.join(5)
+    assert not journal.is_alive()
+    assert store.subscriber_count == subscribers - 1
+    assert "State journal stopped" in caplog.text
+    journal.close()
+
+def test_unknown_durability_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        StateJournal(str(tmp_path), 'eventually')
+
+def write_cost(directory, durability, writes):
+    """Per-write latency of store.update with the journal subscribed (None: no journal)"""
+    store = StateStore(AvatarState().to_dict())
+    journal = None
+    if durability:
+        journal = StateJournal(directory, durability)
+        journal.attach(store)
+    latencies = []
+    for i in range(writes):
+        started = time.perf_counter()
+        store.update({'position': {'x': i, 'y': i}})
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.0005)  # A fast drag, not one giant batch
+    started = time.perf_counter()
+    if journal:
+        journal.close()
+    return sorted(latencies), time.perf_counter() - started
+
+def direct_fsync_cost(directory, writes):
+    """Per-write latency when the writer itself appends and fsyncs (what write-behind avoids)"""
+    latencies = []
+    with open(os.path.join(directory, 'direct.jsonl'), 'ab') as f:
+        for i in range(writes):
+            started = time.perf_counter()
+            f.write(b'{"p":{"position":{"x":%d,"y":%d}}}\n' % (i, i))
+            f.flush()
+            os.fsync(f.fileno())
+            latencies.append(time.perf_counter() - started)
+    return sorted(latencies)
+
+if __name__ == '__main__':
+    WRITES = 2000
+    print(f"store.update latency with {WRITES} position writes")
+    print(f"{'journal':<24}{'p50 us':>10}{'p99 us':>10}{'close ms':>10}")
+    for mode in (None,) + state_journal.DURABILITY:
+        with tempfile.TemporaryDirectory() as directory:
+            latencies, closing = write_cost(directory, mode, WRITES)
+        print(f"{mode or 'none':<24}{statistics.median(latencies) * 1e6:>10.1f}"
+              f"{latencies[int(len(latencies) * 0.99)] * 1e6:>10.1f}{closing * 1000:>10.1f}")
+    with tempfile.TemporaryDirectory() as directory:
+        latencies = direct_fsync_cost(directory, WRITES // 10)
+    print(f"{'fsync in the writer':<24}{statistics.median(latencies) * 1e6:>10.1f}"
+          f"{latencies[int(len(latencies) * 0.99)] * 1e6:>10.1f}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        store, journal, _ = restart(directory, 'fast')
+        for i in range(state_journal.COMPACT_EVERY - 1):
+            store.update({'position': {'x': i, 'y': i}, 'pose': f'pose-{i % 7}'})
+        journal.close()
+        started = time.perf_counter()
+        _, journal, _ = restart(directory)
+        replay = time.perf_counter() - started
+        journal.close()
+    print(f"\nRestart after {state_journal.COMPACT_EVERY - 1} writes (replay and compaction): {replay * 1000:.1f} ms")
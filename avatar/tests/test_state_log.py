@@ -0,0 +1,114 @@
+"""
+Tests for the state server's queued logging
+Checks records reach the console and the JSONL log from the writer thread,
+busy categories are rate limited, and settings can be switched at runtime
+
+Run with: python -m pytest avatar/tests  (or: python test_state_log.py for the caller-cost benchmark)
+"""
+
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avatar_state_server as server
+import state_log
+
+@pytest.fixture
+def event_log(tmp_path):
+    root = logging.getLogger(state_log.LOGGER)
+    level, propagate = root.level, root.propagate
+    running = state_log.EventLog(rates={'position': 5}, jsonl_path=str(tmp_path / 'events.jsonl'),
+                                 stream=io.StringIO())
+    yield running.start()
+    running.stop()
+    root.setLevel(level)
+    root.propagate = propagate
+
+def written(event_log):
+    """Console output once the writer thread has caught up"""
+    event_log.configure(jsonl=bool(event_log.jsonl))  # Restarting the writer drains the queue
+    return event_log.console.stream.getvalue()
+
+def test_records_are_written_by_the_writer_thread(event_log):
+    state_log.logger('pose').info("Avatar pose changed to: %s", 'happy')
+    state_log.logger('request').debug("not shown at info")
+    output = written(event_log)
+    assert '[pose] Avatar pose changed to: happy' in output
+    assert 'not shown' not in output
+
+def test_busy_category_is_rate_limited_and_counts_what_it_dropped(event_log):
+    position = state_log.logger('position')
+    for i in range(100):
+        position.info("Avatar moved to: %s", i)
+    state_log.logger('pose').info("pose is not limited")
+    assert written(event_log).count('Avatar moved to') == 5
+
+    event_log.limiter.windows['position'][0] -= 1  # Next second
+    position.info("Avatar moved to: %s", 'last')
+    assert 'Avatar moved to: last (+95 suppressed)' in written(event_log)
+
+def test_settings_switch_at_runtime(event_log):
+    event_log.configure(level='debug', rates={'position': 0}, jsonl=True)
+    for i in range(20):
+        state_log.logger('position').info("Avatar moved to: %s", i, extra={'fields': {'x': i, 'y': 0}})
+    state_log.logger('request').debug("Received state update")
+    output = written(event_log)
+    assert output.count('Avatar moved to') == 20
+    assert 'Received state update' in output
+
+    with open(event_log.jsonl_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert entries[0]['category'] == 'position'
+    assert entries[19]['fields'] == {'x': 19, 'y': 0}
+
+    with pytest.raises(ValueError):
+        event_log.configure(level='loud', jsonl=False)
+    assert event_log.settings()['jsonl'] == event_log.jsonl_path
+
+def test_admin_endpoint_changes_logging(monkeypatch):
+    monkeypatch.setattr(server, 'event_log', state_log.EventLog(jsonl_path=os.devnull))
+    client = server.app.test_client()
+    root = logging.getLogger(state_log.LOGGER)
+    level = root.level
+    try:
+        assert client.get('/admin/logging').get_json()['level'] == 'info'
+        body = client.post('/admin/logging', json={'level': 'warning', 'rates': {'position': 10}}).get_json()
+        assert body['level'] == 'warning' and body['rates']['position'] == 10
+        assert root.level == logging.WARNING
+        assert client.post('/admin/logging', json={'rates': {'position': -1}}).status_code == 400
+        assert client.post('/admin/logging', json={'jsonl': 'yes'}).status_code == 400
+    finally:
+        root.setLevel(level)
+
+if __name__ == '__main__':
+    # Time spent in the request thread per position log line, against a slow console
+    class SlowConsole(io.StringIO):
+        def write(self, text):
+            time.sleep(0.0002)  # Roughly a Windows console write
+            return super().write(text)
+
+    LINES = 2000
+    console = SlowConsole()
+    started = time.perf_counter()
+    for i in range(LINES):
+        print(f"Avatar moved to: {{'x': {i}, 'y': 0}}", file=console)
+    printed = time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as folder:
+        running = state_log.EventLog(jsonl_path=os.path.join(folder, 'events.jsonl'), stream=SlowConsole()).start()
+        position = state_log.logger('position')
+        started = time.perf_counter()
+        for i in range(LINES):
+            position.info("Avatar moved to: %s", {'x': i, 'y': 0})
+        queued = time.perf_counter() - started
+        running.stop()
+    print(f"{LINES} position updates: print {printed * 1000:.1f} ms, queued + rate limited {queued * 1000:.1f} ms "
+          f"in the request thread")
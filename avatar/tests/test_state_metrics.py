@@ -0,0 +1,111 @@
+"""
+Tests for the state server's /metrics endpoint
+Checks request counts and latency histograms per route, mutations by field,
+stream subscribers and the display poll age in Prometheus text format
+
+Run with: python -m pytest avatar/tests
+"""
+
+import math
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avatar_state_server as server
+from state_metrics import DISPLAY_AGENT, Histogram, Metrics
+from state_model import AvatarState
+from state_store import StateStore
+
+def parse(text):
+    """Samples by 'name{labels}', plus the declared TYPE of each metric"""
+    samples, types = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split()
+            types[name] = kind
+        elif line and not line.startswith('#'):
+            key, value = line.rsplit(' ', 1)
+            samples[key] = float(value)
+    return samples, types
+
+@pytest.fixture
+def client(monkeypatch):
+    store = StateStore(AvatarState().to_dict())
+    metrics = Metrics()
+    store.subscribe(metrics)
+    monkeypatch.setattr(server, 'store', store)
+    monkeypatch.setattr(server, 'metrics', metrics)
+    return server.app.test_client()
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    return parse(response.get_data(as_text=True))
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert list(histogram.cumulative()) == [(0.1, 2), (1.0, 3), (math.inf, 4)]
+    assert histogram.sum == pytest.approx(3.65)
+
+def test_requests_are_counted_per_route_with_latency(client):
+    for _ in range(3):
+        client.get('/state')
+    client.post('/state', json={'mood': 'happy'})
+    client.get('/nowhere')
+    samples, types = scrape(client)
+    assert samples['avatar_http_requests_total{route="/state",method="GET",status="200"}'] == 3
+    assert samples['avatar_http_requests_total{route="/state",method="POST",status="400"}'] == 1
+    assert samples['avatar_http_requests_total{route="unmatched",method="GET",status="404"}'] == 1
+    assert types['avatar_http_request_duration_seconds'] == 'histogram'
+    assert samples['avatar_http_request_duration_seconds_count{route="/state",method="GET"}'] == 3
+    assert samples['avatar_http_request_duration_seconds_bucket{route="/state",method="GET",le="+Inf"}'] == 3
+    assert samples['avatar_http_request_duration_seconds_sum{route="/state",method="GET"}'] > 0
+
+def test_mutations_are_counted_by_field_and_version_reported(client):
+    client.post('/state', json={'pose': 'happy', 'position': {'x': 5}})
+    client.post('/state', json={'pose': 'love'})
+    client.post('/state', json={'pose': 'love'})  # No change, no version
+    samples, _ = scrape(client)
+    assert samples['avatar_state_mutations_total{field="pose"}'] == 2
+    assert samples['avatar_state_mutations_total{field="position"}'] == 1
+    assert samples['avatar_state_version'] == 2
+
+def test_display_poll_age_and_stream_subscribers(client):
+    samples, _ = scrape(client)
+    assert math.isnan(samples['avatar_display_poll_age_seconds'])
+    client.get('/state', headers={'User-Agent': DISPLAY_AGENT})
+    samples, _ = scrape(client)
+    assert 0 <= samples['avatar_display_poll_age_seconds'] < 1
+
+    response = client.get('/state/stream', headers={'User-Agent': DISPLAY_AGENT})
+    events = response.response
+    next(iter(events))  # Stream starts once the first event is read
+    samples, _ = scrape(client)
+    assert samples['avatar_stream_subscribers{client="display"}'] == 1
+    assert samples['avatar_stream_subscribers{client="other"}'] == 0
+    response.close()
+    samples, _ = scrape(client)
+    assert samples['avatar_stream_subscribers{client="display"}'] == 0
+
+def test_concurrent_requests_are_all_counted():
+    metrics = Metrics()
+
+    def worker():
+        for _ in range(1000):
+            metrics.observe_request('/state', 'GET', 200, 0.001)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    samples, _ = parse(metrics.render(0))
+    assert samples['avatar_http_requests_total{route="/state",method="GET",status="200"}'] == 8000
+    assert samples['avatar_http_request_duration_seconds_count{route="/state",method="GET"}'] == 8000
@@ -0,0 +1,271 @@
+"""
+Endpoint tests for the avatar state server (Flask test client, no network)
+
+Run with: python -m pytest avatar/tests
+"""
+
+import os
+import sys
+import threading
+import time
+from dataclasses import fields
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avatar_state_server as server
+from state_history import EventHistory
+from state_model import PATCH_TYPES, AvatarState
+from state_store import StateStore
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, 'store', StateStore(AvatarState().to_dict()))
+    return server.app.test_client()
+
+def test_get_state_answers_if_none_match_with_304(client):
+    first = client.get('/state')
+    assert first.status_code == 200
+    assert client.get('/state', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+    client.post('/state', json={'pose': 'happy'})
+    changed = client.get('/state', headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+    assert changed.get_json()['pose'] == 'happy'
+
+def test_get_state_since_returns_changed_fields_only(client):
+    client.post('/state', json={'pose': 'happy'})
+    client.post('/show_gif', json={'url': 'https://example.com/a.gif'})
+    delta = client.get('/state?since=1').get_json()
+    assert delta['version'] == 2
+    assert set(delta['changes']) == {'gif', 'pose'}
+
+def test_batch_applies_operations_with_one_version_bump(client):
+    client.post('/show_gif', json={'url': 'https://example.com/a.gif'})
+    response = client.post('/batch', json={'operations': [
+        {'op': 'set', 'pose': 'idle'},
+        {'op': 'hide_gif'},
+        {'op': 'set', 'visible': True, 'position': {'x': 5, 'y': 6}},
+        {'op': 'play_animation', 'id': 'wave', 'frames': ['happy', 'idle']}
+    ]})
+    body = response.get_json()
+    assert response.status_code == 200
+    assert body['version'] == 2
+    assert body['state']['gif'] is None
+    assert body['state']['position'] == {'x': 5, 'y': 6}
+    assert body['state']['animation']['id'] == 'wave'
+    assert response.headers['ETag'] == client.get('/state').headers['ETag']
+
+def test_batch_with_bad_operation_applies_nothing(client):
+    response = client.post('/batch', json={'operations': [
+        {'op': 'set', 'pose': 'happy'},
+        {'op': 'explode'}
+    ]})
+    assert response.status_code == 400
+    assert client.get('/state').get_json()['pose'] == 'idle'
+    assert server.store.version == 0
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+@pytest.fixture
+def expiry(client):
+    scheduler = server.ExpiryScheduler(server.store)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+    scheduler.join()
+
+def test_gif_expires_on_the_server_and_is_pushed(client, expiry):
+    subscriber = server.store.subscribe()
+    client.post('/show_gif', json={'url': 'https://example.com/a.gif', 'duration': 0.2})
+    assert wait_for(lambda: server.store.snapshot.state['gif'] is None)
+    state = server.store.snapshot.state
+    assert state['pose'] == 'idle'
+    assert server.store.version == 2
+
+    pushed = [subscriber.get(timeout=1) for _ in range(3)]
+    assert pushed[-1].state['gif'] is None
+    server.store.unsubscribe(subscriber)
+
+def test_non_looping_animation_expires_and_looping_one_does_not(client, expiry):
+    client.post('/play_animation', json={'id': 'wave', 'frames': ['happy', 'idle'], 'duration_per_pose': 0.1})
+    assert wait_for(lambda: server.store.snapshot.state['animation'] is None)
+    assert server.store.snapshot.state['pose'] == 'idle'
+
+    client.post('/play_animation', json={'id': 'spin', 'frames': ['happy'], 'duration_per_pose': 0.1,
+                                         'loop': True})
+    time.sleep(0.3)
+    assert server.store.snapshot.state['animation']['id'] == 'spin'
+
+def test_replaced_gif_keeps_its_own_deadline(client, expiry):
+    client.post('/show_gif', json={'url': 'https://example.com/short.gif', 'duration': 0.2})
+    client.post('/show_gif', json={'url': 'https://example.com/long.gif', 'duration': 30})
+    time.sleep(0.4)
+    assert server.store.snapshot.state['gif']['url'] == 'https://example.com/long.gif'
+
+def test_bad_timing_is_rejected_and_expiry_keeps_running(client, expiry):
+    response = client.post('/show_gif', json={'url': 'https://example.com/a.gif', 'duration': '5'})
+    assert response.status_code == 400
+    assert client.post('/play_animation', json={'id': 'wave', 'frames': ['happy'], 'fps': 'fast'}).status_code == 400
+    assert client.post('/batch', json={'operations': [
+        {'op': 'show_gif', 'url': 'https://example.com/a.gif', 'duration': -1}]}).status_code == 400
+    assert server.store.version == 0
+
+    # POST /state skips command validation - the scheduler must survive what it sets
+    client.post('/state', json={'gif': {'url': 'https://example.com/raw.gif', 'duration': '5', 'start_time': 'now'}})
+    time.sleep(0.1)
+    assert expiry.is_alive()
+    client.post('/show_gif', json={'url': 'https://example.com/b.gif', 'duration': 0.2})
+    assert wait_for(lambda: server.store.snapshot.state['gif'] is None)
+
+def queued(client, **command):
+    response = client.post('/queue', json=command)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+def test_appended_commands_play_in_order(client, expiry):
+    queued(client, type='animation', id='first', frames=['happy'], duration_per_pose=0.2)
+    body = queued(client, type='animation', id='second', frames=['love'], duration_per_pose=0.2)
+    assert body['current']['id'] == 'first'
+    assert [command['body']['id'] for command in body['queue']] == ['second']
+
+    assert wait_for(lambda: (server.store.snapshot.state['animation'] or {}).get('id') == 'second')
+    assert server.store.snapshot.state['queue'] == []
+    assert wait_for(lambda: server.store.snapshot.state['animation'] is None)
+
+def test_higher_priority_is_queued_first_and_replace_drops_lower(client):
+    queued(client, type='gif', url='https://example.com/playing.gif', duration=30)
+    queued(client, type='animation', id='low', frames=['idle'], priority='low')
+    queued(client, type='animation', id='normal', frames=['idle'])
+    queue = queued(client, type='animation', id='urgent', frames=['idle'], priority='high')['queue']
+    assert [command['body']['id'] for command in queue] == ['urgent', 'normal', 'low']
+
+    queue = queued(client, type='animation', id='only', frames=['idle'], policy='replace')['queue']
+    assert [command['body']['id'] for command in queue] == ['urgent', 'only']
+
+def test_interrupt_plays_now_and_keeps_the_queue(client):
+    queued(client, type='gif', url='https://example.com/playing.gif', duration=30)
+    queued(client, type='animation', id='later', frames=['idle'])
+    client.post('/play_animation', json={'id': 'now', 'frames': ['happy']})
+    view = client.get('/queue').get_json()
+    assert view['current'] == {'type': 'animation', 'id': 'now', 'loop': False}
+    assert server.store.snapshot.state['gif'] is None
+    assert [command['body']['id'] for command in view['queue']] == ['later']
+
+def test_cancelling_the_current_item_advances_the_queue(client, expiry):
+    queued(client, type='gif', url='https://example.com/playing.gif', duration=30)
+    queued(client, type='animation', id='next', frames=['happy'], duration_per_pose=5)
+    client.post('/hide_gif')
+    assert wait_for(lambda: (server.store.snapshot.state['animation'] or {}).get('id') == 'next')
+
+def test_items_that_never_expire_do_not_block_the_queue(client, expiry):
+    client.post('/play_animation', json={'id': 'empty', 'frames': []})
+    assert queued(client, type='animation', id='next', frames=['happy'])['current']['id'] == 'next'
+    client.post('/state', json={'animation': None, 'gif': {'url': 'https://example.com/raw.gif', 'duration': None}})
+    assert queued(client, type='gif', url='https://example.com/next.gif')['current']['url'] == 'https://example.com/next.gif'
+
+def test_batch_play_animation_takes_the_command_path(client):
+    client.post('/show_gif', json={'url': 'https://example.com/a.gif', 'duration': 30})
+    body = client.post('/batch', json={'operations': [
+        {'op': 'play_animation', 'id': 'wave', 'frames': ['happy']}]}).get_json()
+    # Like POST /play_animation: the animation replaces the GIF instead of overlapping it
+    assert body['state']['gif'] is None
+    assert body['state']['animation']['id'] == 'wave'
+
+def test_bad_queue_command_is_rejected(client):
+    assert client.post('/queue', json={'type': 'gif'}).status_code == 400
+    assert client.post('/queue', json={'type': 'animation', 'policy': 'shuffle'}).status_code == 400
+    assert client.post('/show_gif', json={'url': 5}).status_code == 400
+    assert client.post('/show_gif', json={'url': ['https://example.com/a.gif']}).status_code == 400
+    assert client.post('/play_animation', json={'id': 'wave', 'frames': 'happy'}).status_code == 400
+    assert client.post('/play_animation', json={'id': 'wave', 'frames': ['happy'], 'loop': 'no'}).status_code == 400
+    assert client.post('/batch', json={'operations': [{'op': 'show_gif', 'url': 5}]}).status_code == 400
+    assert server.store.version == 0
+
+def later(seconds, action):
+    timer = threading.Timer(seconds, action)
+    timer.start()
+    return timer
+
+def test_wait_returns_when_the_predicate_becomes_true(client):
+    server.store.update({'gif': {'url': 'https://example.com/a.gif'}, 'pose': None})
+    later(0.1, lambda: server.store.update({'gif': None, 'pose': 'idle'}))
+    started = time.monotonic()
+    response = client.get('/wait?gif=null&pose=idle&timeout=5')
+    body = response.get_json()
+    assert body['matched'] is True
+    assert body['state']['pose'] == 'idle'
+    assert response.headers['ETag'] == client.get('/state').headers['ETag']
+    assert time.monotonic() - started < 2
+
+def test_wait_supports_not_equal_nested_fields_and_since(client):
+    later(0.05, lambda: server.store.update({'position': {'x': 5, 'y': 6}}))
+    assert client.get('/wait?position.x=5&pose!=happy&timeout=5').get_json()['matched'] is True
+    # Already true, but since= waits for a newer version
+    later(0.05, lambda: server.store.update({'visible': False}))
+    body = client.get(f'/wait?since={server.store.version}&timeout=5').get_json()
+    assert body['matched'] is True
+    assert body['state']['visible'] is False
+
+def test_wait_times_out_without_a_match(client):
+    body = client.get('/wait?pose=happy&timeout=0.1').get_json()
+    assert body['matched'] is False
+    assert body['state']['pose'] == 'idle'
+
+def test_state_patch_is_checked_against_the_model(client):
+    assert client.post('/state', json={'mood': 'happy'}).status_code == 400
+    assert client.post('/state', json={'queue': []}).status_code == 400
+    assert client.post('/state', json={'visible': 'yes'}).status_code == 400
+    assert client.post('/state', json={'pose': 3}).status_code == 400
+    assert client.post('/state', json={'position': {'x': True, 'y': 1}}).status_code == 400
+    assert client.post('/state', json={'position': {'z': 1}}).status_code == 400
+    assert client.post('/state', json={'last_update': 'yesterday'}).status_code == 400
+    body = client.post('/batch', json={'operations': [{'op': 'set', 'visible': 1}]}).get_json()
+    assert body['error'].startswith('operation 0:')
+    assert server.store.version == 0
+
+def test_partial_position_keeps_the_other_axis(client):
+    client.post('/state', json={'position': {'x': 5}})
+    assert server.store.snapshot.state['position'] == {'x': 5, 'y': 100}
+
+def test_fractional_position_is_rounded_to_pixels(client):
+    client.post('/state', json={'position': {'x': 10.6, 'y': 20.2}})
+    assert client.get('/state').get_json()['position'] == {'x': 11, 'y': 20}
+
+def test_patch_types_follow_the_model():
+    assert PATCH_TYPES.keys() == {f.name for f in fields(AvatarState)} - {'queue'}
+
+def test_default_state_comes_from_the_model():
+    assert AvatarState().to_dict() == {
+        'visible': True, 'pose': 'idle', 'position': {'x': 1000, 'y': 100},
+        'last_update': None, 'animation': None, 'gif': None, 'queue': []
+    }
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setattr(server, 'history', server.store.subscribe(EventHistory(size=3)))
+
+def test_events_replay_changes_after_a_sequence(client, history):
+    client.post('/state', json={'pose': 'happy'})
+    client.post('/state', json={'position': {'x': 5}, 'visible': False})
+    response = client.get('/events?since=1')
+    body = response.get_json()
+    assert body['seq'] == 2 and body['gap'] is False
+    assert [event['seq'] for event in body['events']] == [2]
+    assert body['events'][0]['patch'] == {'position': {'x': 5, 'y': 100}, 'visible': False}
+    assert response.headers['ETag'] == client.get('/state').headers['ETag']
+    assert client.get('/events?since=2').get_json()['events'] == []
+
+def test_events_report_a_gap_when_evicted_or_from_a_restart(client, history):
+    for pose in ('happy', 'love', 'anger', 'thinking', 'idle'):
+        client.post('/state', json={'pose': pose})
+    body = client.get('/events?since=0').get_json()
+    assert body['gap'] is True
+    assert [event['seq'] for event in body['events']] == [3, 4, 5]
+    assert client.get('/events?since=2').get_json()['gap'] is False
+    assert client.get('/events?since=42').get_json() == {'seq': 5, 'gap': True, 'events': []}
@@ -0,0 +1,176 @@
+"""
+Concurrency stress test for the avatar state store
+Hammers the store with mixed readers and writers and checks every snapshot is consistent
+
+Run with: python -m pytest avatar/tests  (or: python test_state_store.py)
+"""
+
+import json
+import os
+import queue
+import random
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import state_service as service
+from state_model import AvatarState
+from state_store import LatestSnapshot, StateStore
+
+WRITERS = 4
+READERS = 6
+WRITES_PER_WRITER = 2000
+
+def initial_state():
+    # Writers keep x == y, starting from the origin
+    return dict(AvatarState().to_dict(), position={'x': 0, 'y': 0})
+
+def check_snapshot(snapshot):
+    """Invariants every published snapshot must satisfy"""
+    state = snapshot.state
+    if state['gif'] is not None:
+        # show_gif clears pose and animation in the same transaction
+        assert state['pose'] is None, state
+        assert state['animation'] is None, state
+    else:
+        assert state['pose'] is not None, state
+    if state['animation'] is not None:
+        assert state['visible'] is True, state
+    # Writers always move x and y together
+    assert state['position']['x'] == state['position']['y'], state
+    # Field versions never run ahead of the snapshot version
+    assert max(snapshot.field_versions.values(), default=0) == snapshot.version, snapshot
+
+def writer(store, seed):
+    rng = random.Random(seed)
+    for i in range(WRITES_PER_WRITER):
+        choice = rng.randrange(5)
+        with store.transaction() as state:
+            if choice == 0:
+                service.apply_show_gif(state, {'url': f'https://example.com/{seed}-{i}.gif'})
+            elif choice == 1:
+                service.apply_hide_gif(state)
+            elif choice == 2:
+                service.apply_play_animation(state, {'id': f'anim-{seed}-{i}', 'frames': ['happy', 'idle']})
+                state['gif'] = None
+                state['pose'] = 'idle'
+            elif choice == 3:
+                service.apply_stop_animation(state)
+                state['gif'] = None
+            else:
+                n = rng.randrange(10000)
+                service.apply_update(state, {'position': {'x': n, 'y': n}})
+
+def test_concurrent_readers_and_writers_see_consistent_snapshots():
+    store = StateStore(initial_state())
+    stop = threading.Event()
+    errors = []
+    reads = []
+
+    def reader():
+        last_version = 0
+        count = 0
+        try:
+            while not stop.is_set():
+                snapshot = store.snapshot
+                check_snapshot(snapshot)
+                assert snapshot.version >= last_version
+                last_version = snapshot.version
+                count += 1
+        except AssertionError as e:
+            errors.append(e)
+        reads.append(count)
+
+    readers = [threading.Thread(target=reader) for _ in range(READERS)]
+    writers = [threading.Thread(target=writer, args=(store, seed)) for seed in range(WRITERS)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    assert not errors, errors[0]
+    assert sum(reads) > 0
+    # Every transaction that changed something published exactly one version
+    assert 0 < store.version <= WRITERS * WRITES_PER_WRITER
+
+def test_subscribers_receive_every_version_in_order():
+    store = StateStore(initial_state())
+    subscriber = store.subscribe()
+    writers = [threading.Thread(target=writer, args=(store, seed)) for seed in range(WRITERS)]
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    store.unsubscribe(subscriber)
+
+    versions = []
+    while not subscriber.empty():
+        snapshot = subscriber.get_nowait()
+        check_snapshot(snapshot)
+        versions.append(snapshot.version)
+    assert versions == list(range(store.version + 1))
+
+def test_latest_snapshot_subscriber_keeps_only_the_newest():
+    store = StateStore(initial_state())
+    subscriber = store.subscribe(LatestSnapshot())
+    for x in range(30):
+        store.update({'position': {'x': x, 'y': 0}})  # A client that is not reading
+    assert subscriber.get(timeout=1).version == store.version
+    with pytest.raises(queue.Empty):
+        subscriber.get(timeout=0.01)
+    threading.Timer(0.05, store.update, args=({'pose': 'happy'},)).start()
+    assert subscriber.get(timeout=5).state['pose'] == 'happy'
+
+def test_published_snapshots_are_not_mutated_by_later_writes():
+    store = StateStore(initial_state())
+    before = store.snapshot
+    with store.transaction() as state:
+        state['position']['x'] = 42
+        state['pose'] = 'happy'
+    assert before.state['position'] == {'x': 0, 'y': 0}
+    assert before.state['pose'] == 'idle'
+    assert store.snapshot.state['pose'] == 'happy'
+    assert store.changes_since(before.version) == (1, {'position': {'x': 42, 'y': 0}, 'pose': 'happy'})
+
+def test_unchanged_transaction_does_not_bump_version():
+    store = StateStore(initial_state())
+    with store.transaction() as state:
+        state['pose'] = 'idle'
+    assert store.version == 0
+
+def test_wait_for_wakes_on_the_matching_change():
+    store = StateStore(initial_state())
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(
+        store.wait_for(lambda snapshot: snapshot.state['pose'] == 'happy', timeout=5)))
+    waiter.start()
+    store.update({'position': {'x': 1, 'y': 1}})  # Wakes the waiter, predicate still false
+    store.update({'pose': 'happy'})
+    waiter.join()
+    assert results[0].version == 2
+    assert results[0].state['pose'] == 'happy'
+
+def test_wait_for_times_out_with_none():
+    store = StateStore(initial_state())
+    assert store.wait_for(lambda snapshot: snapshot.state['pose'] == 'happy', timeout=0.05) is None
+    assert store.wait_for(lambda snapshot: snapshot.state['pose'] == 'idle', timeout=0).version == 0
+
+def test_snapshot_is_encoded_once_per_version():
+    store = StateStore(initial_state())
+    first = store.snapshot
+    assert first.encoded() is first.encoded()
+    assert json.loads(first.encoded()) == first.state
+    store.update({'pose': 'happy'})
+    assert json.loads(store.snapshot.encoded())['pose'] == 'happy'
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(f"PASS {name}")
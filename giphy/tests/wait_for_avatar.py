@@ -1,24 +1,26 @@
 """
 Test script to wait for GIF mode to end before playing animations
 """
+import os
+import sys
+
 import requests
-import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'avatar'))
+from local_socket import state_session  # Unix socket when the state server offers one
 
 def wait_for_avatar_ready(timeout=10):
     """Wait for avatar to be ready (not playing GIF)"""
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        try:
-            response = requests.get("http://localhost:3338/state")
-            if response.status_code == 200:
-                state = response.json()
-                # Check if GIF is not playing and pose is back to idle
-                if state.get('gif') is None and state.get('pose') == 'idle':
-                    print("Avatar is ready!")
-                    return True
-        except:
-            pass
-        time.sleep(0.5)
+    # The state server holds the request until the GIF is gone and the pose is idle
+    try:
+        response = state_session().get("http://localhost:3338/wait",
+                                       params={'gif': 'null', 'pose': 'idle', 'timeout': timeout},
+                                       timeout=timeout + 5)
+        if response.status_code == 200 and response.json().get('matched'):
+            print("Avatar is ready!")
+            return True
+    except requests.RequestException:
+        pass
     print("Timeout waiting for avatar")
     return False
 
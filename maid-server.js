@@ -202,6 +202,18 @@ server.setRequestHandler(ListToolsRequestSchema, async () => {
             id: {
               type: 'string',
               description: 'Animation ID (e.g. "idle", "happy", "treasure_hunt")'
+            },
+            policy: {
+              type: 'string',
+              enum: ['append', 'replace', 'interrupt'],
+              description: 'append: play after queued animations (default), replace: drop queued animations first, interrupt: play now',
+              default: 'append'
+            },
+            priority: {
+              type: 'string',
+              enum: ['low', 'normal', 'high'],
+              description: 'Queue priority (default: normal)',
+              default: 'normal'
             }
           },
           required: ['id']
@@ -332,18 +344,20 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
             throw new Error(`Unknown animation: ${animationId}`);
           }
           
-          await axios.post('http://localhost:3338/state', {
-            visible: true,
-            position: { x, y }
-          });
-          
-          await axios.post('http://localhost:3338/play_animation', {
-            id: animationId,
-            name: animation.name,
-            frames: animation.frames,
-            fps: animation.fps,
-            duration_per_pose: animation.duration_per_pose || 2,
-            loop: animation.loop
+          // Position and animation in one atomic update
+          await axios.post('http://localhost:3338/batch', {
+            operations: [
+              { op: 'set', visible: true, position: { x, y } },
+              {
+                op: 'play_animation',
+                id: animationId,
+                name: animation.name,
+                frames: animation.frames,
+                fps: animation.fps,
+                duration_per_pose: animation.duration_per_pose || 2,
+                loop: animation.loop
+              }
+            ]
           });
           
           return {
@@ -429,7 +443,12 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
             }
           }
           
-          await axios.post('http://localhost:3338/play_animation', {
+          // Queued on the state server so quick successive animations all play
+          const policy = args.policy || 'append';
+          const response = await axios.post('http://localhost:3338/queue', {
+            type: 'animation',
+            policy,
+            priority: args.priority || 'normal',
             id: animation.id,
             name: animation.name,
             frames: animation.frames,
@@ -437,11 +456,12 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
             duration_per_pose: animation.duration_per_pose || 2,
             loop: animation.loop
           });
+          const waiting = response.data.queue.length;
           
           return {
             content: [{
               type: 'text',
-              text: `Playing animation: ${animation.name}${animation.loop ? ' (looping)' : ''}`
+              text: `${waiting ? 'Queued' : 'Playing'} animation: ${animation.name}${animation.loop ? ' (looping)' : ''}${waiting ? ` (${waiting} waiting)` : ''}`
             }]
           };
         } catch (error) {
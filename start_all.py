@@ -1,16 +1,34 @@
 """
 Maid-MCP Complete System Launcher
 Starts all components: avatar display, state server, and voice input
+Components start together and each is waited on through its own readiness
+probe and timeout: GET /health for the state server, a ready file written by
+the display (first frame shown) and by the voice listener (microphone
+initialised). A startup timing table is printed at the end.
 """
 
+import argparse
+import json
+import shutil
 import subprocess
+import tempfile
 import time
 import os
 import sys
 import signal
+import urllib.request
 import psutil
+from dataclasses import dataclass, field
 from pathlib import Path
 
+STATE_URL = "http://localhost:3338"
+
+# Components write this file once they are ready (see signal_ready in each)
+READY_ENV = 'MAID_READY_FILE'
+
+# Seconds between readiness checks
+PROBE_INTERVAL = 0.05
+
 def kill_existing_processes():
     """Kill any existing maid-mcp processes"""
     print("Cleaning up existing processes...")
@@ -22,7 +40,7 @@ def kill_existing_processes():
         'speechListener.py'
     ]
     
-    killed_count = 0
+    killed = []
     
     # Find and kill Python processes running our scripts
     for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
@@ -35,7 +53,7 @@ def kill_existing_processes():
                         if any(script in arg for arg in cmdline):
                             print(f"  Killing {script} (PID: {proc.info['pid']})")
                             proc.kill()
-                            killed_count += 1
+                            killed.append(proc)
                             break
         except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
             pass
@@ -44,16 +62,19 @@ def kill_existing_processes():
     try:
         for conn in psutil.net_connections():
             if conn.laddr.port == 3338 and conn.status == 'LISTEN':
+                if any(proc.pid == conn.pid for proc in killed):
+                    continue
                 proc = psutil.Process(conn.pid)
                 print(f"  Killing process on port 3338 (PID: {conn.pid})")
                 proc.kill()
-                killed_count += 1
+                killed.append(proc)
     except:
         pass
     
-    if killed_count > 0:
-        print(f"✓ Cleaned up {killed_count} processes")
-        time.sleep(2)  # Wait for processes to fully terminate
+    if killed:
+        # Wait for the processes to exit rather than a fixed delay
+        psutil.wait_procs(killed, timeout=5)
+        print(f"✓ Cleaned up {len(killed)} processes")
     else:
         print("✓ No existing processes found")
 
@@ -68,43 +89,109 @@ def check_python():
         print("ERROR: Python not found. Please install Python 3.8+")
         return False
 
-def start_component(name, path, script, new_window=False):
-    """Start a component"""
-    print(f"Starting {name}...")
-    
-    # Change to component directory
-    original_dir = os.getcwd()
-    os.chdir(path)
-    
+def health_ok(url=STATE_URL):
+    """True when the state server answers GET /health"""
     try:
-        if new_window:
+        with urllib.request.urlopen(f"{url}/health", timeout=0.5) as response:
+            return json.loads(response.read()).get('status') == 'running'
+    except (OSError, ValueError):
+        return False
+
+@dataclass
+class Component:
+    """One process to launch and how to tell it is ready"""
+    name: str
+    path: Path
+    script: str
+    args: list = field(default_factory=list)
+    new_window: bool = False
+    timeout: float = 15.0  # Seconds to wait for readiness
+    ready_file: bool = False  # Waits for the component's ready file
+    health: bool = False  # Waits for GET /health
+    process: object = None
+    started: float = 0.0
+    status: str = 'pending'
+    elapsed: float = 0.0
+
+    def ready(self, ready_dir):
+        if self.ready_file and not os.path.exists(self.ready_path(ready_dir)):
+            return False
+        return not self.health or health_ok()
+
+    def ready_path(self, ready_dir):
+        return os.path.join(ready_dir, Path(self.script).stem + '.ready')
+
+def start_component(component, ready_dir):
+    """Start a component without waiting for it"""
+    env = dict(os.environ, **{READY_ENV: component.ready_path(ready_dir)})
+    command = ['python', component.script, *component.args]
+    try:
+        if component.new_window:
             # Start in new window (for voice input)
             if os.name == 'nt':  # Windows
-                subprocess.Popen(['start', f'{name}', 'cmd', '/k', 
-                                'python', script], shell=True)
+                component.process = subprocess.Popen(['start', component.name, 'cmd', '/k', *command],
+                                                     shell=True, cwd=component.path, env=env)
             else:  # Linux/Mac
-                subprocess.Popen(['gnome-terminal', '--', 'python', script])
+                component.process = subprocess.Popen(['gnome-terminal', '--', 'env',
+                                                      f"{READY_ENV}={env[READY_ENV]}", *command],
+                                                     cwd=component.path, env=env)
         else:
             # Start in background
-            subprocess.Popen([sys.executable, script])
-        
-        print(f"✓ {name} started successfully")
+            component.process = subprocess.Popen([sys.executable, *command[1:]], cwd=component.path, env=env)
+        component.started = time.perf_counter()
+        print(f"  Started {component.name}")
         return True
         
     except Exception as e:
-        print(f"✗ Failed to start {name}: {e}")
+        component.status = 'failed'
+        print(f"✗ Failed to start {component.name}: {e}")
         return False
-        
-    finally:
-        os.chdir(original_dir)
+
+def wait_until_ready(components, ready_dir):
+    """Probe every started component until it is ready, exits or times out"""
+    waiting = [c for c in components if c.status == 'pending']
+    while waiting:
+        now = time.perf_counter()
+        for component in list(waiting):
+            component.elapsed = now - component.started
+            if component.ready(ready_dir):
+                component.status = 'ready'
+            elif not component.new_window and component.process.poll() is not None:
+                component.status = f"exited ({component.process.returncode})"
+            elif component.elapsed > component.timeout:
+                component.status = 'timeout'
+            else:
+                continue
+            print(f"  {component.name}: {component.status} after {component.elapsed:.2f}s")
+            waiting.remove(component)
+        if waiting:
+            time.sleep(PROBE_INTERVAL)
+
+def print_timings(components, cleanup, total):
+    """Per-component startup table"""
+    print(f"\n{'Component':<32}{'Status':<14}{'Ready after':>12}{'Timeout':>10}")
+    for c in components:
+        print(f"{c.name:<32}{c.status:<14}{c.elapsed:>11.2f}s{c.timeout:>9.0f}s")
+    print(f"{'Cleanup':<46}{cleanup:>11.2f}s")
+    print(f"{'Total':<46}{total:>11.2f}s")
 
 def main():
     """Main launcher function"""
+    parser = argparse.ArgumentParser(description="Maid-MCP launcher")
+    parser.add_argument('--embedded', action='store_true',
+                        help="run the state server inside the avatar display (one process less)")
+    parser.add_argument('--no-voice', action='store_true', help="do not start the voice input listener")
+    parser.add_argument('--persist', action='store_true',
+                        help="keep visibility, pose and position across restarts (state journal)")
+    args = parser.parse_args()
+    
     print("=" * 40)
     print("  Maid-MCP Complete System Launcher")
     print("=" * 40)
     print()
     
+    launch_started = time.perf_counter()
+    
     # Kill existing processes first
     kill_existing_processes()
     
@@ -113,26 +200,45 @@ def main():
         input("Press Enter to exit...")
         return
     
+    cleanup = time.perf_counter() - launch_started
+    
     # Get base directory
     base_dir = Path(__file__).parent
+    persist = ['--persist'] if args.persist else []
     
-    # Start components
-    components = [
-        ("Avatar Display", base_dir / "avatar", "avatar_display.py", False),
-        ("Avatar State Server", base_dir / "avatar", "avatar_state_server.py", False),
-        ("Voice Input Listener", base_dir / "voice" / "incoming", "speechListener.py", True)
-    ]
+    # Independent components - started together, each waited on by its own probe
+    if args.embedded:
+        # The display serves the state API itself
+        components = [
+            Component("Avatar Display + State Server", base_dir / "avatar", "avatar_display.py",
+                      ['--embedded'] + persist, timeout=20, ready_file=True, health=True),
+        ]
+    else:
+        components = [
+            Component("Avatar State Server", base_dir / "avatar", "avatar_state_server.py", persist,
+                      timeout=10, health=True),
+            Component("Avatar Display", base_dir / "avatar", "avatar_display.py", timeout=20, ready_file=True),
+        ]
+    if not args.no_voice:
+        # Microphone calibration can take a while
+        components.append(Component("Voice Input Listener", base_dir / "voice" / "incoming", "speechListener.py",
+                                    new_window=True, timeout=45, ready_file=True))
     
-    for i, (name, path, script, new_window) in enumerate(components, 1):
-        print(f"\n[{i}/{len(components)}] {name}")
-        
-        if start_component(name, path, script, new_window):
-            # Wait between starts
-            if i < len(components):
-                time.sleep(2)
+    ready_dir = tempfile.mkdtemp(prefix='maid_ready_')
+    try:
+        print(f"\nStarting {len(components)} components...")
+        for component in components:
+            start_component(component, ready_dir)
+        wait_until_ready(components, ready_dir)
+    finally:
+        shutil.rmtree(ready_dir, ignore_errors=True)
+    print_timings(components, cleanup, time.perf_counter() - launch_started)
     
     print("\n" + "=" * 40)
-    print("  All systems started successfully!")
+    if all(c.status == 'ready' for c in components):
+        print("  All systems started successfully!")
+    else:
+        print("  Started with problems - see the table above")
     print("=" * 40)
     print()
     print("Avatar: Running in background")
@@ -34,6 +34,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Set by start_all.py: the file to create once the microphone is initialised
+READY_ENV = 'MAID_READY_FILE'
+
+def signal_ready():
+    """Tell the launcher the listener is up"""
+    path = os.environ.get(READY_ENV)
+    if path:
+        try:
+            with open(path, 'w') as f:
+                f.write(str(os.getpid()))
+        except OSError:
+            pass  # The launcher stopped waiting
+
 class SpeechListener:
     """Listens for speech and sends to Claude"""
     
@@ -252,6 +265,8 @@ def main():
         logger.error("Failed to initialize speech listener")
         return
     
+    signal_ready()
+    
     # Print status
     print("\n✅ Voice input ready!")
     print(f"📊 Energy threshold: {listener.recognizer.recognizer.energy_threshold}")